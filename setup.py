@@ -19,5 +19,9 @@ setup(name='sideloader.build',
           'PyYAML',
       ],
       entry_points={
-          'console_scripts': ['sideloader = sideloader.cli:main'],
+          'console_scripts': [
+              'sideloader = sideloader.cli:main',
+              'sideloader-gc = sideloader.build.cli:gc_main',
+              'sideloader-history = sideloader.build.cli:history_main',
+          ],
       })
@@ -1,5 +1,7 @@
+from .result import Artifact, BuildResult
 from .sideloader import (
-    Build, Config, Deploy, GitRepo, Package, Sideloader, Workspace)
+    Build, Config, Deploy, GitRepo, LocalSource, Package, Sideloader,
+    Workspace)
 
-__all__ = ['Build', 'Config', 'Deploy', 'GitRepo', 'Package', 'Sideloader',
-           'Workspace']
+__all__ = ['Artifact', 'Build', 'BuildResult', 'Config', 'Deploy', 'GitRepo',
+           'LocalSource', 'Package', 'Sideloader', 'Workspace']
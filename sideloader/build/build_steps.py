@@ -0,0 +1,92 @@
+import fnmatch
+import hashlib
+import os
+import tarfile
+
+from utils import hash_file, walk_sorted
+
+
+class BuildStep(object):
+    """
+    Container class for a named step of the build, declared in the deploy
+    file with the files it reads and the build output it produces, so that
+    its output can be cached and restored while its inputs don't change.
+    """
+    def __init__(self, name, run, inputs=[], outputs=[]):
+        """
+        :param: name:
+        The name of the step.
+
+        :param: run:
+        The shell command for the step, run from the workspace directory
+        with the same environment as the buildscript.
+
+        :param: inputs:
+        Glob patterns for the files in the repo that the step reads, relative
+        to the repo. '*' matches across directories and a pattern matching a
+        directory includes everything in it. A step without inputs reads the
+        whole repo, so that it isn't cached forever.
+
+        :param: outputs:
+        The paths that the step creates, relative to the build directory.
+        """
+        self.name = name
+        self.run = run
+        self.inputs = inputs
+        self.outputs = outputs
+
+    @classmethod
+    def from_yaml(cls, step_yaml):
+        for field in ('name', 'run', 'outputs'):
+            if not step_yaml.get(field):
+                raise ValueError('Build steps need a \'%s\'' % field)
+        return BuildStep(step_yaml['name'], step_yaml['run'],
+                         step_yaml.get('inputs', []), step_yaml['outputs'])
+
+    def find_inputs(self, repo_path):
+        """
+        List the files in the repo that match the input patterns, or all of
+        them if the step has none.
+        """
+        return [relpath for relpath in walk_sorted(repo_path, ('.git',))
+                if not self.inputs or _matches(relpath, self.inputs)]
+
+    def get_cache_key(self, repo_path):
+        """
+        Get a hash of the step and the paths and contents of its inputs.
+        """
+        digest = hashlib.sha256()
+        for part in [self.name, self.run] + list(self.outputs):
+            digest.update(part + '\0')
+        for relpath in self.find_inputs(repo_path):
+            path = os.path.join(repo_path, relpath)
+            digest.update(relpath + '\0')
+            if os.path.islink(path):
+                digest.update('l' + os.readlink(path))
+            else:
+                digest.update(hash_file(path))
+            digest.update('\0')
+        return digest.hexdigest()
+
+    def find_missing_outputs(self, build_path):
+        return [output for output in self.outputs
+                if not os.path.lexists(os.path.join(build_path, output))]
+
+    def pack_outputs(self, build_path, dst_path):
+        """ Archive the step's outputs to a tarball for unpack_dir. """
+        with tarfile.open(dst_path, 'w:gz') as tarball:
+            for output in self.outputs:
+                tarball.add(os.path.join(build_path, output),
+                            os.path.normpath(output))
+
+
+def _matches(relpath, patterns):
+    """ Check if a path or any of its parent directories match a pattern. """
+    parts = relpath.split(os.sep)
+    for pattern in patterns:
+        pattern = os.path.normpath(
+            pattern.replace('**/', '*').replace('**', '*'))
+        for i in range(1, len(parts) + 1):
+            if fnmatch.fnmatch(os.sep.join(parts[:i]), pattern):
+                return True
+    return False
@@ -0,0 +1,204 @@
+"""
+Structured build logs. Each record is a JSON object carrying the id of the
+build and the phase that logged it along with a timestamp and the message.
+Records are queued and written in batches by a background thread, so logging
+doesn't block the build on a syscall per message. A build's records go to a
+log file per build (rotated by size) and are rendered on the console for
+interactive use.
+
+Messages logged with utils.log go to the build log bound to the current
+thread, or straight to stdout if there is none.
+"""
+import errno
+import json
+import os
+import Queue
+import sys
+import threading
+import time
+
+from phases import PhaseListener
+
+
+_context = threading.local()
+
+
+def current_log():
+    """ Get the build log bound to the current thread, if any. """
+    return getattr(_context, 'log', None)
+
+
+def current_phase():
+    """ Get the phase running in the current thread, if any. """
+    return getattr(_context, 'phase', None)
+
+
+def bind(build_log, phase=None):
+    """ Send messages logged by the current thread to a build log. """
+    _context.log = build_log
+    _context.phase = phase
+
+
+def unbind():
+    _context.log = None
+    _context.phase = None
+
+
+def make_record(message, build=None, phase=None, **fields):
+    record = {'time': time.time(), 'build': build, 'phase': phase,
+              'message': message}
+    record.update(fields)
+    return record
+
+
+class ConsoleRenderer(object):
+    """ Renders records as timestamped lines on a stream (stdout). """
+
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def render(self, record):
+        phase = '[%s] ' % record['phase'] if record.get('phase') else ''
+        lines = ['[%s] %s%s' % (time.ctime(record['time']), phase,
+                                record['message'])]
+        lines += ['    %s' % line for line in record.get('output', [])]
+        return ''.join(line + '\n' for line in lines)
+
+    def write(self, records):
+        stream = self.stream or sys.stdout
+        stream.write(''.join(self.render(record) for record in records))
+        stream.flush()
+
+    def close(self):
+        pass
+
+
+class JSONLinesFile(object):
+    """
+    Writes records as JSON lines to a file. When the file grows past
+    max_bytes it is rotated to '<path>.1' (and older files to '<path>.2' and
+    so on), keeping at most backup_count old files.
+    """
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backup_count=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._file = None
+
+    def _open(self):
+        try:
+            os.makedirs(os.path.dirname(self.path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self._file = open(self.path, 'a')
+
+    def rotate(self):
+        self.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            src = '%s.%d' % (self.path, i)
+            if os.path.exists(src):
+                os.rename(src, '%s.%d' % (self.path, i + 1))
+        if self.backup_count > 0:
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+
+    def write(self, records):
+        if self._file is None:
+            self._open()
+        elif self.max_bytes and self._file.tell() >= self.max_bytes:
+            self.rotate()
+            self._open()
+
+        self._file.write(''.join(json.dumps(record, sort_keys=True) + '\n'
+                                 for record in records))
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class BuildLog(object):
+    """
+    The log for a single build. Records are written to each of the outputs
+    (objects with write(records) and close() methods) by a writer thread.
+    Use the log as a context manager to bind it to the current thread and
+    close it at the end.
+    """
+
+    # The most records written to the outputs at once
+    batch_size = 256
+
+    def __init__(self, build_id, outputs):
+        self.build_id = build_id
+        self.outputs = outputs
+        self._queue = Queue.Queue()
+        self._writer = threading.Thread(target=self._write,
+                                        name='sideloader-log')
+        self._writer.daemon = True
+        self._writer.start()
+
+    def emit(self, message, **fields):
+        """ Queue a record for writing. """
+        self._queue.put(make_record(message, build=self.build_id,
+                                    phase=current_phase(), **fields))
+
+    def _write(self):
+        closing = False
+        while not closing:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            if None in batch:
+                closing = True
+                batch = batch[:batch.index(None)]
+            if batch:
+                for output in self.outputs:
+                    output.write(batch)
+
+    def close(self):
+        """ Write any queued records and close the outputs. """
+        if not self._writer.is_alive():
+            return
+        self._queue.put(None)
+        self._writer.join()
+        for output in self.outputs:
+            output.close()
+
+    def __enter__(self):
+        bind(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        unbind()
+        self.close()
+
+
+class BuildLogListener(PhaseListener):
+    """
+    Binds the build log to each phase's thread so that messages are tagged
+    with the phase, and logs how long each phase took.
+    """
+
+    def __init__(self, build_log):
+        self.build_log = build_log
+
+    def phase_started(self, phase):
+        bind(self.build_log, phase.name)
+
+    def phase_finished(self, phase, duration):
+        self.build_log.emit('Finished in %.2fs' % duration, duration=duration)
+        unbind()
+
+    def phase_failed(self, phase, duration, exc_info):
+        self.build_log.emit('Failed after %.2fs: %s' % (duration, exc_info[1]),
+                            duration=duration, error=repr(exc_info[1]))
+        unbind()
@@ -0,0 +1,163 @@
+"""
+Byte-compilation of package trees at build time, so that targets don't
+compile on first import (or at all, on read-only installs). Files are
+compiled by the interpreter the target runs, in a pool of processes, with
+hash-based pycs where the interpreter supports them (3.7+) so that they
+stay valid whatever happens to the sources' timestamps.
+"""
+import json
+import multiprocessing
+import os
+import tempfile
+
+from utils import log
+
+
+# Run by the target interpreter with the path to a JSON file of
+# [source, path on the target] pairs and the number of processes to use.
+# Existing pycs are removed rather than overwritten so that trees of hard
+# links can be compiled without touching the files they were linked from.
+COMPILER = r"""
+import json
+import multiprocessing
+import os
+import py_compile
+import sys
+
+kwargs = {}
+if sys.version_info >= (3, 7):
+    kwargs['invalidation_mode'] = py_compile.PycInvalidationMode.CHECKED_HASH
+
+
+def get_cfile(source):
+    if sys.version_info >= (3,):
+        import importlib.util
+        return importlib.util.cache_from_source(source)
+    return source + 'c'
+
+
+def compile_file(paths):
+    source, dfile = paths
+    cfile = get_cfile(source)
+    try:
+        if os.path.lexists(cfile):
+            os.remove(cfile)
+        py_compile.compile(source, cfile, dfile, doraise=True, **kwargs)
+    except (py_compile.PyCompileError, IOError, OSError) as e:
+        return '%s: %s' % (dfile, str(e).strip().splitlines()[-1])
+    return None
+
+
+with open(sys.argv[1]) as files_file:
+    files = json.load(files_file)
+workers = int(sys.argv[2])
+if workers > 1 and len(files) > 1:
+    pool = multiprocessing.Pool(workers)
+    try:
+        errors = pool.map(compile_file, files, chunksize=16)
+    finally:
+        pool.close()
+        pool.join()
+else:
+    errors = [compile_file(paths) for paths in files]
+sys.stdout.write(json.dumps([error for error in errors if error]))
+"""
+
+
+def find_sources(root, target_root):
+    """
+    Find the Python sources in a tree.
+
+    :param: target_root:
+    The path the tree is installed at on the target.
+
+    :returns:
+    A sorted list of [source path, path on the target] pairs.
+    """
+    sources = []
+    for dir_path, dirs, files in os.walk(root):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(dir_path, name)
+            if name.endswith('.py') and not os.path.islink(path):
+                sources.append([path, os.path.join(
+                    target_root, os.path.relpath(path, root))])
+    return sources
+
+
+def remove_compiled(source):
+    """
+    Remove the compiled files of a Python source, for when it is removed.
+
+    :returns:
+    The paths of the removed files.
+    """
+    dir_path, name = os.path.split(source)
+    stem = os.path.splitext(name)[0]
+    paths = [source + 'c', source + 'o']
+    pycache = os.path.join(dir_path, '__pycache__')
+    if os.path.isdir(pycache):
+        paths += [os.path.join(pycache, cached)
+                  for cached in sorted(os.listdir(pycache))
+                  if cached.split('.')[0] == stem and
+                  cached.endswith(('.pyc', '.pyo'))]
+
+    removed = []
+    for path in paths:
+        if os.path.lexists(path):
+            os.remove(path)
+            removed.append(path)
+    return removed
+
+
+def compile_tree(root, target_root, python, cmd, workers=None):
+    """
+    Byte-compile the Python sources in a tree.
+
+    :param: root:
+    The tree to compile.
+
+    :param: target_root:
+    The path the tree is installed at on the target, which is recorded in
+    the compiled code for tracebacks.
+
+    :param: python:
+    The interpreter to compile with, which should be the version that the
+    target runs.
+
+    :param: cmd:
+    The function to run commands with.
+
+    :param: workers:
+    The number of processes to compile with (defaults to the number of
+    CPUs).
+
+    :returns:
+    A list of errors for files that couldn't be compiled (such as templates
+    or files for other Python versions), which are left uncompiled.
+    """
+    return compile_sources(find_sources(root, target_root), python, cmd,
+                           workers)
+
+
+def compile_sources(sources, python, cmd, workers=None):
+    """
+    Byte-compile Python sources, as found by find_sources, with the same
+    options as compile_tree.
+    """
+    if not sources:
+        return []
+
+    workers = workers or multiprocessing.cpu_count()
+    fd, files_path = tempfile.mkstemp(suffix='.json')
+    try:
+        with os.fdopen(fd, 'w') as files_file:
+            json.dump(sources, files_file)
+        output = cmd([python, '-c', COMPILER, files_path, str(workers)])
+    finally:
+        os.remove(files_path)
+
+    errors = json.loads(output) if output else []
+    log('Compiled %d of %d Python files' % (
+        len(sources) - len(errors), len(sources)), output=errors)
+    return errors
@@ -0,0 +1,435 @@
+"""
+Caches for build virtualenvs and wheels. Each entry is a single blob stored
+under a namespace and a key, the key being a hash of everything that went
+into making the entry.
+
+The local cache lives in the workspace base (where it is garbage collected
+along with the workspaces). A remote cache shared between build hosts can be
+layered on top of it. The remote protocol is deliberately plain so that a
+directory on a shared filesystem or any HTTP server that supports GET and PUT
+can implement it: the blob for an entry is stored at '<namespace>/<key>' and
+its hex sha256 digest at '<namespace>/<key>.sha256'.
+"""
+import BaseHTTPServer
+import errno
+import hashlib
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import urllib2
+
+from utils import extract_tarball, hash_file, log
+from workspace_gc import CACHE_DIR, touch_last_use
+
+
+def cache_key(*parts):
+    """ Create a cache key by hashing the given strings. """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part)
+        digest.update('\0')
+    return digest.hexdigest()
+
+
+def pack_dir(src_dir, dst_path):
+    """ Archive the contents of a directory to a gzipped tarball. """
+    with tarfile.open(dst_path, 'w:gz') as tarball:
+        for name in sorted(os.listdir(src_dir)):
+            tarball.add(os.path.join(src_dir, name), name)
+
+
+def unpack_dir(src_path, dst_dir):
+    """ Extract a tarball made by pack_dir into a directory. """
+    # Virtualenvs link to the system Python
+    extract_tarball(src_path, dst_dir, external_symlinks=True)
+
+
+def _create_temp_file(directory):
+    """
+    Create an empty file in directory to write a blob to before it is
+    renamed into place, returning its path.
+    """
+    fd, path = tempfile.mkstemp(dir=directory)
+    os.close(fd)
+    return path
+
+
+class LocalCache(object):
+    """
+    A cache in the workspace base. The entry for a key is a directory
+    containing the blob so that the garbage collector can track and evict it.
+    """
+
+    def __init__(self, workspace_base):
+        self.root = os.path.join(workspace_base, CACHE_DIR)
+
+    def _entry_dir(self, namespace, key):
+        return os.path.join(self.root, namespace, key)
+
+    def get_path(self, namespace, key):
+        """ Get the path of the blob for a key, whether or not it exists. """
+        return os.path.join(self._entry_dir(namespace, key), 'blob')
+
+    def get(self, namespace, key):
+        """
+        Look up an entry.
+
+        :returns:
+        The path to the blob, or None if there is no entry for the key.
+        """
+        path = self.get_path(namespace, key)
+        if not os.path.exists(path):
+            return None
+        touch_last_use(self._entry_dir(namespace, key))
+        return path
+
+    def put(self, namespace, key, src_path):
+        """
+        Add a blob to the cache by moving the file at src_path into it.
+
+        :returns:
+        The path to the cached blob.
+        """
+        entry_dir = self._entry_dir(namespace, key)
+        try:
+            os.makedirs(entry_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        path = self.get_path(namespace, key)
+        # Renaming is atomic so concurrent readers never see partial blobs
+        tmp_path = _create_temp_file(entry_dir)
+        shutil.move(src_path, tmp_path)
+        os.rename(tmp_path, path)
+        touch_last_use(entry_dir)
+        return path
+
+
+class RemoteCacheError(Exception):
+    """ An error talking to a remote cache. """
+
+
+class FileSystemCache(object):
+    """ A remote cache in a directory, e.g. on a shared filesystem. """
+
+    def __init__(self, path):
+        self.path = path
+
+    def download(self, namespace, key, dst_path):
+        """
+        Download a blob to dst_path.
+
+        :returns:
+        The expected sha256 of the blob, or None if there is no entry.
+        """
+        blob_path = os.path.join(self.path, namespace, key)
+        try:
+            with open(blob_path + '.sha256') as digest_file:
+                digest = digest_file.read().strip()
+            shutil.copy(blob_path, dst_path)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise RemoteCacheError(str(e))
+        return digest
+
+    def exists(self, namespace, key):
+        """ Check whether there is an entry without downloading it. """
+        return os.path.exists(
+            os.path.join(self.path, namespace, key + '.sha256'))
+
+    def upload(self, namespace, key, src_path, digest):
+        """ Upload a blob and its digest. """
+        namespace_dir = os.path.join(self.path, namespace)
+        try:
+            os.makedirs(namespace_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        blob_path = os.path.join(namespace_dir, key)
+        tmp_path = _create_temp_file(namespace_dir)
+        shutil.copy(src_path, tmp_path)
+        os.rename(tmp_path, blob_path)
+        # The digest is written last so a reader never sees a digest without
+        # the blob it describes
+        tmp_path = _create_temp_file(namespace_dir)
+        with open(tmp_path, 'w') as digest_file:
+            digest_file.write(digest)
+        # Readable by the other hosts sharing the cache, as mkstemp files
+        # are private
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, blob_path + '.sha256')
+
+
+class HTTPCache(object):
+    """ A remote cache on an HTTP server that supports GET and PUT. """
+
+    timeout = 60
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def _url(self, namespace, key):
+        return '%s/%s/%s' % (self.url, namespace, key)
+
+    def _open(self, url, data=None, method='GET', length=None):
+        """
+        Make a request. data may be a file, which is sent in blocks rather
+        than read into memory, in which case its length must be given.
+        """
+        request = urllib2.Request(url, data)
+        request.get_method = lambda: method
+        if length is not None:
+            request.add_header('Content-Length', str(length))
+        return urllib2.urlopen(request, timeout=self.timeout)
+
+    def download(self, namespace, key, dst_path):
+        url = self._url(namespace, key)
+        try:
+            digest = self._open(url + '.sha256').read().strip()
+            response = self._open(url)
+            with open(dst_path, 'wb') as dst_file:
+                shutil.copyfileobj(response, dst_file)
+        except urllib2.HTTPError as e:
+            if e.code == 404:
+                return None
+            raise RemoteCacheError('%s: %s' % (url, e))
+        except urllib2.URLError as e:
+            raise RemoteCacheError('%s: %s' % (url, e))
+        return digest
+
+    def exists(self, namespace, key):
+        # Only the digest is fetched, which is small
+        url = self._url(namespace, key) + '.sha256'
+        try:
+            self._open(url).close()
+        except urllib2.HTTPError as e:
+            if e.code == 404:
+                return False
+            raise RemoteCacheError('%s: %s' % (url, e))
+        except urllib2.URLError as e:
+            raise RemoteCacheError('%s: %s' % (url, e))
+        return True
+
+    def upload(self, namespace, key, src_path, digest):
+        url = self._url(namespace, key)
+        try:
+            with open(src_path, 'rb') as src_file:
+                self._open(url, src_file, 'PUT',
+                           os.fstat(src_file.fileno()).st_size)
+            self._open(url + '.sha256', digest, 'PUT')
+        except urllib2.URLError as e:
+            raise RemoteCacheError('%s: %s' % (url, e))
+
+
+def create_remote_cache(url):
+    """
+    Create a remote cache from a URL: http(s):// URLs use HTTPCache and
+    anything else is treated as a path for FileSystemCache.
+    """
+    if url is None:
+        return None
+    if url.startswith(('http://', 'https://')):
+        return HTTPCache(url)
+    if url.startswith('file://'):
+        url = url[len('file://'):]
+    return FileSystemCache(url)
+
+
+class BuildCache(object):
+    """
+    A local cache backed by an optional remote cache. Lookups try the local
+    cache first and then the remote one, verifying the digest of anything
+    downloaded. New entries are stored locally and uploaded in the
+    background.
+    """
+
+    def __init__(self, local, remote=None):
+        self.local = local
+        self.remote = remote
+        self._uploads = []
+        self._lock = threading.Lock()
+        # Lookup outcomes as (namespace, 'hit' | 'remote_hit' | 'miss')
+        self.outcomes = []
+
+    def _record(self, namespace, outcome):
+        with self._lock:
+            self.outcomes.append((namespace, outcome))
+
+    def get(self, namespace, key):
+        """
+        Look up an entry, downloading it from the remote cache if necessary.
+
+        :returns:
+        The path to the blob in the local cache, or None on a miss.
+        """
+        path = self.local.get(namespace, key)
+        if path is not None:
+            self._record(namespace, 'hit')
+            return path
+
+        if self.remote is not None:
+            path = self._download(namespace, key)
+            if path is not None:
+                self._record(namespace, 'remote_hit')
+                return path
+
+        self._record(namespace, 'miss')
+        return None
+
+    def probe(self, namespace, key):
+        """
+        Check where an entry would come from without downloading it or
+        recording the lookup.
+
+        :returns:
+        'hit', 'remote_hit' or 'miss'.
+        """
+        if os.path.exists(self.local.get_path(namespace, key)):
+            return 'hit'
+        if self.remote is not None:
+            try:
+                if self.remote.exists(namespace, key):
+                    return 'remote_hit'
+            except RemoteCacheError as e:
+                log('WARNING: Remote cache lookup failed: %s' % e)
+        return 'miss'
+
+    def _download(self, namespace, key):
+        tmp_path = self.new_blob_path()
+        try:
+            try:
+                digest = self.remote.download(namespace, key, tmp_path)
+            except RemoteCacheError as e:
+                log('WARNING: Remote cache lookup failed: %s' % e)
+                return None
+
+            if digest is None:
+                return None
+            if hash_file(tmp_path) != digest:
+                log('WARNING: Ignoring corrupt remote cache entry %s/%s'
+                    % (namespace, key))
+                return None
+
+            return self.local.put(namespace, key, tmp_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def get_many(self, namespace, keys):
+        """
+        Look up several entries at once, downloading them concurrently.
+
+        :returns:
+        A dict mapping each key to the path of its blob or None.
+        """
+        results = {}
+
+        def get(key):
+            results[key] = self.get(namespace, key)
+
+        threads = [threading.Thread(target=get, args=(key,)) for key in keys]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def put(self, namespace, key, src_path):
+        """
+        Add a blob to the cache by moving the file at src_path into it, and
+        start uploading it to the remote cache.
+
+        :returns:
+        The path to the blob in the local cache.
+        """
+        path = self.local.put(namespace, key, src_path)
+        if self.remote is not None:
+            thread = threading.Thread(
+                target=self._upload, args=(namespace, key, path))
+            thread.start()
+            with self._lock:
+                self._uploads.append(thread)
+        return path
+
+    def _upload(self, namespace, key, path):
+        try:
+            self.remote.upload(namespace, key, path, hash_file(path))
+        except (RemoteCacheError, IOError, OSError) as e:
+            log('WARNING: Remote cache upload failed: %s' % e)
+
+    def new_blob_path(self):
+        """ Get a temporary path to write a new blob to before put(). """
+        try:
+            os.makedirs(self.local.root)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, path = tempfile.mkstemp(dir=self.local.root)
+        os.close(fd)
+        return path
+
+    def wait(self):
+        """ Wait for the background uploads to finish. """
+        with self._lock:
+            uploads, self._uploads = self._uploads, []
+        for thread in uploads:
+            thread.join()
+
+
+class CacheRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    A minimal implementation of the remote cache protocol over HTTP that
+    stores blobs in a directory. Serve it with:
+
+        server = BaseHTTPServer.HTTPServer(('', 8000), CacheRequestHandler)
+        server.cache_dir = '/srv/sideloader-cache'
+        server.serve_forever()
+    """
+
+    def _path(self):
+        parts = [part for part in self.path.split('/') if part]
+        if not parts or any(part in ('.', '..') for part in parts):
+            return None
+        return os.path.join(self.server.cache_dir, *parts)
+
+    def do_GET(self):
+        path = self._path()
+        if path is None or not os.path.isfile(path):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.end_headers()
+        with open(path, 'rb') as blob:
+            shutil.copyfileobj(blob, self.wfile)
+
+    def do_PUT(self):
+        path = self._path()
+        if path is None:
+            self.send_error(400)
+            return
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        length = int(self.headers.getheader('Content-Length', 0))
+        tmp_path = _create_temp_file(os.path.dirname(path))
+        with open(tmp_path, 'wb') as blob:
+            while length > 0:
+                chunk = self.rfile.read(min(length, 64 * 1024))
+                if not chunk:
+                    break
+                blob.write(chunk)
+                length -= len(chunk)
+        os.rename(tmp_path, path)
+        self.send_response(201)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,179 @@
+"""
+Cancellation and deadlines for builds. Commands run by utils.cmd are started
+in their own process group and registered with the cancel token bound to
+the current thread, so cancelling a build kills every process that the
+build's commands have started. Each phase can also have a deadline, after
+which its commands are killed.
+"""
+import errno
+import os
+import signal
+import threading
+import time
+
+from phases import PhaseListener
+
+
+class BuildCancelled(Exception):
+    """ The build was cancelled. """
+
+
+class PhaseTimeout(Exception):
+    """
+    A phase ran past its deadline. Unlike a cancelled build, a build that
+    times out has failed, and its workspace is kept so that it can be
+    resumed.
+    """
+
+
+def kill_process_group(process):
+    """ Kill a process started with its own process group, and the group. """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+
+
+class CancelToken(object):
+    """ Cancels a build by killing the processes its commands started. """
+
+    def __init__(self):
+        self.reason = None
+        self.error_class = BuildCancelled
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._processes = set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self, reason='Build cancelled', error_class=BuildCancelled):
+        """
+        Cancel the build, killing any commands that are running.
+
+        :param: error_class:
+        The exception to raise in the phases that are stopped: BuildCancelled,
+        or PhaseTimeout when a phase's deadline stops the build.
+        """
+        with self._lock:
+            if self.reason is None:
+                self.reason = reason
+                self.error_class = error_class
+            self._cancelled.set()
+            processes = list(self._processes)
+        for process in processes:
+            kill_process_group(process)
+
+    def wait(self, timeout):
+        """
+        Wait for the build to be cancelled, for at most timeout seconds.
+
+        :returns:
+        Whether the build has been cancelled.
+        """
+        return self._cancelled.wait(timeout)
+
+    def check(self):
+        """
+        Raise BuildCancelled (or the error the build was cancelled with) if
+        the build has been cancelled.
+        """
+        if self.cancelled:
+            raise self.error_class(self.reason)
+
+    def register(self, process):
+        """ Track a running process, killing it if already cancelled. """
+        with self._lock:
+            self._processes.add(process)
+        if self.cancelled:
+            kill_process_group(process)
+
+    def unregister(self, process):
+        with self._lock:
+            self._processes.discard(process)
+
+
+_context = threading.local()
+
+
+def bind(token, phase=None, deadline=None):
+    """
+    Bind a cancel token and the current phase's deadline (a time.time()
+    value) to the current thread.
+    """
+    _context.token = token
+    _context.phase = phase
+    _context.deadline = deadline
+
+
+def unbind():
+    bind(None)
+
+
+def current_token():
+    """ Get the cancel token bound to the current thread, if any. """
+    return getattr(_context, 'token', None)
+
+
+def get_timeout(timeout=None):
+    """
+    Get the time a command may run for: the given timeout limited by the
+    deadline of the current phase.
+
+    :raises:
+    PhaseTimeout if the phase's deadline has already passed.
+    """
+    deadline = getattr(_context, 'deadline', None)
+    if deadline is None:
+        return timeout
+
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise PhaseTimeout('Phase %s ran past its deadline' % _context.phase)
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+class CancellationListener(PhaseListener):
+    """
+    Binds a build's cancel token to each phase's thread along with the
+    phase's deadline, and stops phases from starting once the build has been
+    cancelled.
+    """
+
+    def __init__(self, token, timeouts=None, default_timeout=None):
+        """
+        :param: timeouts:
+        A dict mapping phase names to their timeouts in seconds.
+
+        :param: default_timeout:
+        The timeout for phases that aren't in timeouts (None for no limit).
+        """
+        self.token = token
+        self.timeouts = timeouts or {}
+        self.default_timeout = default_timeout
+
+    def bind_phase(self, name):
+        """
+        Bind the token to the current thread with the deadline of the named
+        phase, starting now.
+        """
+        timeout = self.timeouts.get(name, self.default_timeout)
+        deadline = time.time() + timeout if timeout is not None else None
+        bind(self.token, name, deadline)
+
+    def phase_started(self, phase):
+        self.token.check()
+        self.bind_phase(phase.name)
+
+    def phase_finished(self, phase, duration):
+        unbind()
+
+    def phase_failed(self, phase, duration, exc_info):
+        unbind()
+        if isinstance(exc_info[1], PhaseTimeout):
+            # Stop the rest of the build rather than waiting for it. The
+            # phases that are stopped fail with the timeout too, so that the
+            # build fails with the timeout whichever of them finishes first.
+            self.token.cancel(str(exc_info[1]), PhaseTimeout)
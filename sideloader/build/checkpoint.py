@@ -0,0 +1,153 @@
+"""
+Checkpoints of the phases of a build, recorded in the workspace as phases
+complete, so that a failed build can be resumed from its first incomplete
+phase instead of starting again from the clone.
+
+Each phase is checkpointed with a digest of its inputs: the arguments and
+config of the build and the digests of the phases that produced its input
+resources. A phase is only skipped on resume if it completed with the same
+digest and every phase it depends on is skipped too, so rerunning a phase
+reruns everything downstream of it.
+"""
+import json
+import os
+import threading
+
+from cache import cache_key
+from phases import PhaseGraph, PhaseListener
+from utils import cmd, log, read_json, write_json
+
+
+""" The file in the workspace that records the completed phases. """
+CHECKPOINT_FILE = '.sideloader-checkpoints'
+
+
+def get_run_key(*args):
+    """ Create a key for the arguments of a build, which must be JSON. """
+    return cache_key(*[json.dumps(arg, sort_keys=True) for arg in args])
+
+
+def get_phase_digests(phases, run_key):
+    """
+    Compute the input digest of each phase.
+
+    :returns:
+    A dict mapping phase names to digests.
+    """
+    producers = {}
+    digests = {}
+    for phase in PhaseGraph(phases).ordered():
+        inputs = sorted('%s=%s' % (resource, digests[producers[resource]])
+                        for resource in phase.inputs)
+        digests[phase.name] = cache_key(run_key, phase.name, *inputs)
+        for resource in phase.outputs:
+            producers[resource] = phase.name
+    return digests
+
+
+class Checkpoints(PhaseListener):
+    """
+    Records the phases of a build as they complete and works out which of
+    them a resumed build can skip.
+    """
+
+    def __init__(self, path, phases, run_key, source):
+        """
+        :param: path:
+        The checkpoint file.
+
+        :param: phases:
+        The phases of the build.
+
+        :param: run_key:
+        A key for the arguments and config of the build, from get_run_key.
+
+        :param: source:
+        The GitRepo or LocalSource being built. Its revision is recorded so
+        that a resumed build starts from scratch if the source has changed.
+        """
+        self.path = path
+        self.source = source
+        self.run_key = run_key
+        self._phases = PhaseGraph(phases).ordered()
+        self._digests = get_phase_digests(phases, run_key)
+        self._completed = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """ Forget the completed phases, for a build from scratch. """
+        with self._lock:
+            self._completed = {}
+            self._save()
+
+    def resume(self, check=None):
+        """
+        Work out which phases a previous, identical build completed. Only
+        those are kept: checkpoints of phases that will run again are
+        forgotten before anything runs.
+
+        :param: check:
+        A callable that takes the names of the phases that could be skipped
+        and returns the names of those that can really be skipped, for
+        phases that have to run again if others do.
+
+        :returns:
+        The phases to skip, in the order they could have run in.
+        """
+        state = read_json(self.path)
+        if state is None or state.get('run_key') != self.run_key:
+            log('No checkpoints of an identical build, building from scratch')
+            self.reset()
+            return []
+
+        revision = state.get('revision')
+        if (revision is not None and
+                revision != self.source.lookup_revision(cmd)):
+            log('The source has changed since revision %s was built, '
+                'building from scratch' % revision)
+            self.reset()
+            return []
+
+        resumable = self._get_resumable(state.get('phases', {}))
+        if check is not None:
+            resumable = self._get_resumable(dict(
+                (name, self._digests[name]) for name in check(resumable)))
+
+        with self._lock:
+            self._completed = dict(
+                (name, self._digests[name]) for name in resumable)
+            # Saved with the checkpoints until the clone is restored
+            self.source.revision = revision
+            self._save()
+        return [phase for phase in self._phases if phase.name in resumable]
+
+    def _get_resumable(self, completed):
+        """
+        Get the names of the phases that completed with their current digest
+        and that only depend on phases that can be skipped too.
+        """
+        producers = {}
+        resumable = []
+        for phase in self._phases:
+            if (completed.get(phase.name) == self._digests[phase.name] and
+                    all(producers[resource] in resumable
+                        for resource in phase.inputs)):
+                resumable.append(phase.name)
+            for resource in phase.outputs:
+                producers[resource] = phase.name
+        return resumable
+
+    def phase_finished(self, phase, duration):
+        with self._lock:
+            self._completed[phase.name] = self._digests[phase.name]
+            self._save()
+
+    def _save(self):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            # The workspace has been cleaned up
+            return
+        write_json(self.path, {
+            'run_key': self.run_key,
+            'revision': self.source.revision,
+            'phases': self._completed,
+        })
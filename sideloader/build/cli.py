@@ -1,8 +1,15 @@
 #!/usr/bin/env python
 
+import signal
+import time
+
 import click
 
-from .sideloader import Sideloader
+from .history import BuildHistory
+from .profiling import Profiler
+from .sideloader import Config, Sideloader
+from .utils import parse_duration, parse_size
+from .workspace_gc import WorkspaceGC
 
 
 @click.command()
@@ -15,9 +22,9 @@ from .sideloader import Sideloader
 @click.option('--build-script', help='Build script relative path')
 @click.option('--postinst-script', help='Post-install script relative path')
 @click.option('--dtype', help='Deploy type', default='virtualenv',
-              type=click.Choice(['dir', 'python', 'virtualenv']))
+              type=click.Choice(['dir', 'python', 'virtualenv', 'wheel']))
 @click.option('--packman', help='Package manager', default='deb',
-              type=click.Choice(['deb', 'rpm']))
+              type=click.Choice(['deb', 'rpm', 'oci']))
 @click.option('--config', help='Sideloader config',
               default='/etc/sideloader/sideloader.yaml',
               type=click.Path())
@@ -27,8 +34,181 @@ from .sideloader import Sideloader
               help='Enable GPG signing of .deb packages (requires a key to be '
                    'configured)',
               default=True)
+@click.option('--reproducible/--no-reproducible',
+              help='Normalise timestamps, ownership and ordering so that '
+                   'identical inputs built in the same workspace path give '
+                   'byte-identical packages',
+              default=False)
+@click.option('--split-deps/--no-split-deps',
+              help='Put the virtualenv in a separate <name>-deps package '
+                   'that is only rebuilt when the requirements change '
+                   '(needs build_cache or remote_cache)',
+              default=False)
+@click.option('--coalesce/--no-coalesce',
+              help='Wait for an identical build that is already running and '
+                   'share its artifacts instead of building again',
+              default=False)
+@click.option('--cancel-superseded', is_flag=True,
+              help='Cancel a running build of an older commit of the branch '
+                   '(with --coalesce)')
+@click.option('--profile', help='Profile the build and write the profile, '
+                                'flamegraph stacks and subprocess timings to '
+                                'this directory',
+              type=click.Path(file_okay=False))
+@click.option('--plan', is_flag=True,
+              help='Show which phases would run or be served from caches and '
+                   'how long they would take, without building anything')
+@click.option('--watch', is_flag=True,
+              help='Watch a local source directory and rebuild the package '
+                   'after every change, until interrupted')
+@click.option('--resume', is_flag=True,
+              help='Continue the last build in the workspace from its first '
+                   'incomplete phase if it was an identical build of the '
+                   'same revision')
 def main(git_url, branch, build, id, deploy_file, name,
-         build_script, postinst_script, dtype, packman, config, debug, sign):
+         build_script, postinst_script, dtype, packman, config, debug, sign,
+         reproducible, split_deps, coalesce, cancel_superseded, profile,
+         plan, watch, resume):
     sideloader = Sideloader(config, git_url, branch, id, debug)
-    sideloader.run(deploy_file, dtype, packman, build, sign, name=name,
-                   buildscript=build_script, postinstall=postinst_script)
+
+    run_args = (deploy_file, dtype, packman, build, sign)
+    run_kwargs = {'reproducible': reproducible, 'split_deps': split_deps,
+                  'name': name, 'buildscript': build_script,
+                  'postinstall': postinst_script}
+
+    if plan:
+        click.echo(sideloader.plan(*run_args, **run_kwargs).render(), nl=False)
+        return
+
+    if watch:
+        try:
+            sideloader.watch(*run_args, **run_kwargs)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    def cancel(signum, frame):
+        sideloader.cancel('Received signal %d' % signum)
+    signal.signal(signal.SIGTERM, cancel)
+    signal.signal(signal.SIGINT, cancel)
+
+    run_kwargs['resume'] = resume
+    run = sideloader.run
+    if coalesce:
+        run = sideloader.run_coalesced
+        run_kwargs['cancel_superseded'] = cancel_superseded
+
+    if profile is None:
+        run(*run_args, **run_kwargs)
+        return
+
+    profiler = Profiler(profile)
+    sideloader.listeners.append(profiler)
+    profiler.run(run, *run_args, **run_kwargs)
+
+
+@click.command()
+@click.option('--config', help='Sideloader config',
+              default='/etc/sideloader/sideloader.yaml',
+              type=click.Path())
+@click.option('--budget', help='Disk budget for the workspace base, e.g. 10G '
+                               '(defaults to gc_budget from the config)')
+def gc_main(config, budget):
+    """
+    Evict the least recently used workspaces and caches until the workspace
+    base is within its disk budget.
+    """
+    config = Config.from_config_file(config)
+    budget = parse_size(budget) if budget is not None else config.gc_budget
+    if budget is None:
+        raise click.UsageError('No disk budget given or configured')
+
+    WorkspaceGC(config.workspace_base, budget, config.staging_dir).collect()
+
+
+def _format_time(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(timestamp))
+
+
+def _format_size(size):
+    if size is None:
+        return '-'
+    return '%.1fM' % (size / 1024.0 / 1024.0)
+
+
+def _open_history(config):
+    config = Config.from_config_file(config)
+    if config.history_db is None:
+        raise click.UsageError('No history database is configured')
+    return BuildHistory(config.history_db)
+
+
+@click.group()
+def history_main():
+    """ Query the history of builds on this host. """
+
+
+@history_main.command()
+@click.option('--config', help='Sideloader config',
+              default='/etc/sideloader/sideloader.yaml',
+              type=click.Path())
+@click.option('--repo', help='Only show builds of this repo')
+@click.option('--since', help='Only show builds from this long ago, e.g. 7d')
+@click.option('--limit', help='Number of builds to show', default=10)
+@click.option('--phases/--no-phases', help='Show the phases of each build',
+              default=False)
+def slowest(config, repo, since, limit, phases):
+    """ Show the slowest builds. """
+    history = _open_history(config)
+    since = time.time() - parse_duration(since) if since else None
+    for build in history.slowest(limit, repo, since):
+        click.echo('%s  %-24s %-16s %-9s %8.1fs %8s  %s' % (
+            _format_time(build['started']), build['repo'],
+            build['branch'] or '-', build['status'], build['duration'],
+            _format_size(build['artifact_size']),
+            (build['revision'] or '-')[:12]))
+        if phases:
+            for phase in history.phases(build['id']):
+                click.echo('    %-20s %8.1fs %s' % (
+                    phase['name'], phase['duration'], phase['status']))
+
+
+@history_main.command()
+@click.option('--config', help='Sideloader config',
+              default='/etc/sideloader/sideloader.yaml',
+              type=click.Path())
+@click.option('--repo', help='Only show builds of this repo')
+@click.option('--since', help='How far back to go, e.g. 30d', default='30d')
+@click.option('--period', help='The length of each period, e.g. 1d or 1w',
+              default='1d')
+def trends(config, repo, since, period):
+    """ Show build counts, failures, durations and sizes over time. """
+    history = _open_history(config)
+    since = time.time() - parse_duration(since)
+    rows = history.trends(int(parse_duration(period)), repo, since)
+    click.echo('%-24s %-16s %6s %8s %9s %9s %8s' % (
+        'repo', 'period', 'builds', 'failures', 'mean', 'max', 'size'))
+    for row in rows:
+        click.echo('%-24s %-16s %6d %8d %8.1fs %8.1fs %8s' % (
+            row['repo'], _format_time(row['period_start']), row['builds'],
+            row['failures'], row['mean_duration'], row['max_duration'],
+            _format_size(row['mean_artifact_size'])))
+
+
+@history_main.command()
+@click.option('--config', help='Sideloader config',
+              default='/etc/sideloader/sideloader.yaml',
+              type=click.Path())
+@click.option('--window', help='The length of the windows to compare, e.g. '
+                               '7d (the last window against the one before)',
+              default='7d')
+@click.option('--threshold', help='Slowdown ratio to report', default=1.2)
+@click.option('--min-builds', help='Builds each window needs to be compared',
+              default=3)
+def regressions(config, window, threshold, min_builds):
+    """ Show repos and phases that got slower. """
+    history = _open_history(config)
+    rows = history.regressions(parse_duration(window), threshold, min_builds)
+    for repo, phase, earlier, recent, ratio in rows:
+        click.echo('%-24s %-20s %8.1fs -> %8.1fs (x%.2f)' % (
+            repo, phase, earlier, recent, ratio))
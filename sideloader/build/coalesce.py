@@ -0,0 +1,229 @@
+"""
+Coalescing of duplicate build requests on a build host. A request takes an
+exclusive lock on a file named after its key (a hash of the resolved commit
+and the build options). If another process already holds the lock, an
+identical build is in flight: the request waits for it to finish and
+receives its result and artifacts instead of building again.
+
+Builds also record which commit they are building for their branch, so that
+a build for a newer commit can cancel a build of a superseded one. It does
+so by leaving a flag file for the superseded build, which watches for it and
+cancels itself with its cancel token.
+"""
+import errno
+import fcntl
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from result import BuildResult
+from utils import log, read_json, rmtree_if_exists, try_flock, write_json
+from workspace_gc import CACHE_DIR, pid_is_alive, touch_last_use
+
+
+""" The directory in the workspace base for locks and build records. """
+COALESCE_DIR = '.coalesce'
+
+
+class CoalescedBuildFailed(Exception):
+    """ The in-flight build that a request attached to failed. """
+
+
+class BuildCoalescer(object):
+    """
+    Runs builds so that identical concurrent requests share one build. The
+    artifacts of each build are linked into the cache directory of the
+    workspace base, where followers pick them up and where they are garbage
+    collected along with the other caches.
+    """
+
+    # Seconds between checks while waiting for a build or for supersession
+    poll_interval = 0.5
+
+    def __init__(self, workspace_base):
+        self.state_dir = os.path.join(workspace_base, COALESCE_DIR)
+        self.results_dir = os.path.join(workspace_base, CACHE_DIR, 'coalesced')
+
+    def _path(self, name):
+        return os.path.join(self.state_dir, name)
+
+    def run(self, key, build, branch_key=None, revision=None,
+            cancel_superseded=False, cancel_token=None):
+        """
+        Run a build unless an identical one is in flight, in which case wait
+        for that build and share its artifacts.
+
+        :param: key:
+        The key identifying identical requests.
+
+        :param: build:
+        A callable that runs the build and returns a BuildResult.
+
+        :param: branch_key:
+        A key identifying builds of the same branch, so that builds of
+        superseded commits can be found.
+
+        :param: revision:
+        The commit being built.
+
+        :param: cancel_superseded:
+        Whether to cancel an in-flight build of another commit of the branch.
+
+        :param: cancel_token:
+        The CancelToken of the build. Waiting for an identical build stops
+        (raising BuildCancelled) if it is cancelled, and it is cancelled if
+        a build of a newer commit supersedes the build.
+
+        :returns:
+        The BuildResult, with the artifacts in the shared results directory.
+        """
+        for path in (self.state_dir, self.results_dir):
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+
+        arrived = time.time()
+        with open(self._path(key + '.lock'), 'a') as lock_file:
+            if not try_flock(lock_file, fcntl.LOCK_EX):
+                log('An identical build is in progress, waiting for it')
+                # Polled rather than blocking, so that signals and
+                # cancellation get through
+                while not try_flock(lock_file, fcntl.LOCK_EX):
+                    self._wait(cancel_token)
+
+                result = read_json(self._path(key + '.json'))
+                if result is None or result['finished'] < arrived:
+                    log('The identical build did not finish, building '
+                        'instead')
+                elif result['status'] == 'unshared':
+                    log('The identical build built commit %s, '
+                        'building instead' % (result['revision'],))
+                else:
+                    return self._receive(key, result)
+
+            return self._lead(key, build, branch_key, revision,
+                              cancel_superseded, cancel_token)
+
+    def _wait(self, cancel_token):
+        if cancel_token is None:
+            time.sleep(self.poll_interval)
+        else:
+            cancel_token.wait(self.poll_interval)
+            cancel_token.check()
+
+    def _receive(self, key, result):
+        if result['status'] != 'succeeded':
+            raise CoalescedBuildFailed(
+                'The identical build failed: %s' % result.get('error'))
+        log('Using the artifacts of the identical build')
+        touch_last_use(os.path.join(self.results_dir, key))
+        build_result = BuildResult.from_dict(result['result'])
+        build_result.coalesced = True
+        return build_result
+
+    def _lead(self, key, build, branch_key, revision, cancel_superseded,
+              cancel_token):
+        claim = None
+        finished = threading.Event()
+        if branch_key is not None:
+            claim = self._claim_branch(branch_key, revision,
+                                       cancel_superseded)
+            if cancel_token is not None:
+                watcher = threading.Thread(
+                    target=self._watch_superseded,
+                    args=(claim, cancel_token, finished),
+                    name='sideloader-superseded')
+                watcher.daemon = True
+                watcher.start()
+        try:
+            try:
+                build_result = build()
+            except BaseException as e:
+                write_json(self._path(key + '.json'), {
+                    'status': 'failed', 'error': str(e) or repr(e),
+                    'finished': time.time()})
+                raise
+
+            if revision is not None and build_result.revision != revision:
+                # The source changed after the key was worked out, e.g. a
+                # local source was edited, so the artifacts aren't the ones
+                # identical requests asked for
+                log('Built commit %s rather than %s, not sharing the '
+                    'artifacts' % (build_result.revision, revision))
+                write_json(self._path(key + '.json'), {
+                    'status': 'unshared', 'revision': build_result.revision,
+                    'finished': time.time()})
+                return build_result
+
+            result_dir = os.path.join(self.results_dir, key)
+            rmtree_if_exists(result_dir)
+            os.mkdir(result_dir)
+            for artifact in build_result.artifacts:
+                dst = os.path.join(result_dir, os.path.basename(artifact.path))
+                try:
+                    os.link(artifact.path, dst)
+                except OSError:
+                    shutil.copy2(artifact.path, dst)
+            touch_last_use(result_dir)
+
+            build_result = build_result.relocate(result_dir)
+            write_json(self._path(key + '.json'), {
+                'status': 'succeeded', 'result': build_result.to_dict(),
+                'finished': time.time()})
+            return build_result
+        finally:
+            finished.set()
+            if branch_key is not None:
+                self._release_branch(branch_key, claim)
+
+    def _claim_branch(self, branch_key, revision, cancel_superseded):
+        """
+        Record that this build is building the branch, flagging the build of
+        a superseded commit to be cancelled if asked to.
+
+        :returns:
+        The build's claim on the branch, which names its flag file.
+        """
+        path = self._path(branch_key + '.branch')
+        current = read_json(path)
+        if (cancel_superseded and current is not None and
+                current['revision'] != revision and
+                current.get('claim') is not None and
+                pid_is_alive(current['pid'])):
+            log('Cancelling the build of superseded commit %s (pid %d)' % (
+                current['revision'], current['pid']))
+            write_json(self._path(current['claim'] + '.superseded'),
+                       {'revision': revision, 'pid': os.getpid()})
+
+        claim = uuid.uuid4().hex
+        write_json(path, {'revision': revision, 'pid': os.getpid(),
+                          'claim': claim})
+        return claim
+
+    def _watch_superseded(self, claim, cancel_token, finished):
+        """ Cancel the build once a build of a newer commit flags it. """
+        flag_path = self._path(claim + '.superseded')
+        while not finished.wait(self.poll_interval):
+            superseding = read_json(flag_path)
+            if superseding is not None:
+                cancel_token.cancel('Superseded by a build of commit %s' % (
+                    superseding['revision'],))
+                return
+
+    def _release_branch(self, branch_key, claim):
+        path = self._path(branch_key + '.branch')
+        current = read_json(path)
+        stale = [self._path(claim + '.superseded')]
+        if current is not None and current.get('claim') == claim:
+            stale.append(path)
+        for stale_path in stale:
+            try:
+                os.remove(stale_path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
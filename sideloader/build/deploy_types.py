@@ -8,6 +8,10 @@ class DeployType(object):
     Object that defines certain attributes of our (not fpm's) deploy types.
     """
 
+    # Whether the package tree is made by building a wheel of the project
+    # rather than by copying the build directory
+    builds_wheel = False
+
     def __init__(self, fpm_deploy_type='dir', dependencies=[],
                  provides_version=False):
         """
@@ -54,7 +58,15 @@ class DeployType(object):
 
         :returns: A list of string arguments.
         """
-        return os.listdir(ws_paths.package)
+        return sorted(os.listdir(ws_paths.package))
+
+    def get_venv_install_path(self, workspace, deploy):
+        """
+        Get the path that the build virtualenv is shipped at when it is
+        packaged (in container images and dependency packages), or None if
+        the deploy type doesn't use a virtualenv.
+        """
+        return None
 
 
 class Python(DeployType):
@@ -69,6 +81,10 @@ class Python(DeployType):
 
 class VirtualEnv(DeployType):
 
+    # Set when the virtualenv is installed by a separate dependencies package,
+    # so the postinstall script only needs to activate it
+    prebuilt_venv = False
+
     def __init__(self):
         super(VirtualEnv, self).__init__(dependencies=['python-virtualenv'])
 
@@ -78,6 +94,11 @@ class VirtualEnv(DeployType):
         frozen_requirements = os.path.join(
             workspace.install_location, '%s-requirements.pip' % deploy.name)
 
+        if self.prebuilt_venv:
+            return """# Activate the virtualenv from the dependencies package
+VENV={venv.venv}
+source {venv.activate}""".format(venv=install_venv)
+
         return """# Create and activate the virtualenv
 if [ ! -f {venv.python} ]; then
     /usr/bin/virtualenv {venv.venv}
@@ -90,6 +111,12 @@ source {venv.activate}
 {venv.pip} install --upgrade -r {frozen_requirements}""".format(
             venv=install_venv, frozen_requirements=frozen_requirements)
 
+    def get_venv_install_path(self, workspace, deploy):
+        # The build virtualenv is shipped where the postinstall script would
+        # otherwise create it
+        return os.path.join(workspace.install_location,
+                            self._get_venv_name(deploy))
+
     def _get_venv_name(self, deploy):
         if deploy.virtualenv_prefix is not None:
             # TODO: Strip '/' to avoid path shenanigans?
@@ -99,3 +126,25 @@ source {venv.activate}
 
     def get_tear_down_script(self):
         return 'deactivate'
+
+
+class Wheel(DeployType):
+    """
+    Installs the project as a Python library. A wheel is built with the
+    project's PEP 517 build backend and installed straight into the package
+    tree, so it works for projects with only a pyproject.toml.
+    """
+    builds_wheel = True
+
+    def get_install_lib(self, python_version):
+        """
+        Get the directory to install libraries to on the target (Debian's
+        dist-packages) for a Python version such as '2.7'.
+        """
+        if python_version.startswith('2.'):
+            return '/usr/lib/python%s/dist-packages' % python_version
+        return '/usr/lib/python3/dist-packages'
+
+    def get_python(self, python_version):
+        """ Get the path to the target's Python interpreter. """
+        return '/usr/bin/python%s' % python_version.split('.')[0]
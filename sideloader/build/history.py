@@ -0,0 +1,269 @@
+"""
+A history of builds in a local SQLite database: what was built, how long
+each phase took, how big the artifacts were, how the caches did and whether
+the build succeeded. The history can be queried for the slowest builds,
+trends per repo and regressions between time windows.
+"""
+import sqlite3
+import threading
+import time
+
+from phases import PhaseListener
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS builds (
+    id INTEGER PRIMARY KEY,
+    build_id TEXT NOT NULL,
+    repo TEXT NOT NULL,
+    branch TEXT,
+    revision TEXT,
+    deploy_type TEXT,
+    target TEXT,
+    started REAL NOT NULL,
+    duration REAL NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    artifact_size INTEGER
+);
+CREATE INDEX IF NOT EXISTS builds_started ON builds (started);
+CREATE INDEX IF NOT EXISTS builds_repo_started ON builds (repo, started);
+
+CREATE TABLE IF NOT EXISTS phases (
+    build INTEGER NOT NULL REFERENCES builds (id),
+    name TEXT NOT NULL,
+    duration REAL NOT NULL,
+    status TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS phases_build ON phases (build);
+
+CREATE TABLE IF NOT EXISTS cache_lookups (
+    build INTEGER NOT NULL REFERENCES builds (id),
+    cache TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    count INTEGER NOT NULL
+);
+"""
+
+""" The name used in regressions for the duration of whole builds. """
+BUILD_TOTAL = '(build)'
+
+
+class HistoryListener(PhaseListener):
+    """ Collects the duration and outcome of each phase of a build. """
+
+    def __init__(self):
+        self.phases = []
+        self._lock = threading.Lock()
+
+    def phase_finished(self, phase, duration):
+        with self._lock:
+            self.phases.append((phase.name, duration, 'succeeded'))
+
+    def phase_failed(self, phase, duration, exc_info):
+        with self._lock:
+            self.phases.append((phase.name, duration, 'failed'))
+
+
+class BuildHistory(object):
+
+    def __init__(self, path):
+        """
+        :param: path:
+        The path to the SQLite database, which is created if it doesn't
+        exist.
+        """
+        self.path = path
+
+    def _connect(self):
+        # Builds running at the same time wait for each other's writes
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        connection.executescript(SCHEMA)
+        return connection
+
+    def record(self, build_id, repo, branch, revision, deploy_type, target,
+               started, duration, status, error=None, artifact_size=None,
+               phases=(), cache_outcomes=()):
+        """
+        Record a build.
+
+        :param: status:
+        'succeeded', 'failed' or 'cancelled'.
+
+        :param: phases:
+        (name, duration, status) tuples for the phases that ran.
+
+        :param: cache_outcomes:
+        (cache, outcome) tuples for each cache lookup.
+        """
+        counts = {}
+        for cache_outcome in cache_outcomes:
+            counts[cache_outcome] = counts.get(cache_outcome, 0) + 1
+
+        connection = self._connect()
+        try:
+            with connection:
+                cursor = connection.execute(
+                    'INSERT INTO builds (build_id, repo, branch, revision, '
+                    'deploy_type, target, started, duration, status, error, '
+                    'artifact_size) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (build_id, repo, branch, revision, deploy_type, target,
+                     started, duration, status, error, artifact_size))
+                build = cursor.lastrowid
+                connection.executemany(
+                    'INSERT INTO phases (build, name, duration, status) '
+                    'VALUES (?, ?, ?, ?)',
+                    [(build,) + tuple(phase) for phase in phases])
+                connection.executemany(
+                    'INSERT INTO cache_lookups (build, cache, outcome, count) '
+                    'VALUES (?, ?, ?, ?)',
+                    [(build, cache, outcome, count)
+                     for (cache, outcome), count in sorted(counts.items())])
+            return build
+        finally:
+            connection.close()
+
+    def _query(self, sql, args=()):
+        connection = self._connect()
+        try:
+            return connection.execute(sql, args).fetchall()
+        finally:
+            connection.close()
+
+    def phases(self, build):
+        """ Get the phases of a recorded build, slowest first. """
+        return self._query(
+            'SELECT name, duration, status FROM phases WHERE build = ? '
+            'ORDER BY duration DESC', (build,))
+
+    def cache_lookups(self, build):
+        """ Get the cache lookup counts of a recorded build. """
+        return self._query(
+            'SELECT cache, outcome, count FROM cache_lookups WHERE build = ? '
+            'ORDER BY cache, outcome', (build,))
+
+    def recent_phases(self, repo, limit=20):
+        """
+        Get the successful phases of the last successful builds of a repo.
+
+        :returns:
+        Rows of (build, name, duration).
+        """
+        return self._query(
+            'SELECT build, name, duration FROM phases '
+            "WHERE status = 'succeeded' AND build IN ("
+            "SELECT id FROM builds WHERE repo = ? AND status = 'succeeded' "
+            'ORDER BY started DESC LIMIT ?)', (repo, limit))
+
+    def recent_cache_lookups(self, repo, limit=20):
+        """
+        Get the cache lookups of the last successful builds of a repo.
+
+        :returns:
+        Rows of (build, cache, outcome, count).
+        """
+        return self._query(
+            'SELECT build, cache, outcome, count FROM cache_lookups '
+            'WHERE build IN ('
+            "SELECT id FROM builds WHERE repo = ? AND status = 'succeeded' "
+            'ORDER BY started DESC LIMIT ?)', (repo, limit))
+
+    def slowest(self, limit=10, repo=None, since=None):
+        """
+        Get the slowest builds.
+
+        :param: repo:
+        Only include builds of this repo.
+
+        :param: since:
+        Only include builds started after this time.
+
+        :returns:
+        Rows of builds, slowest first.
+        """
+        sql = 'SELECT * FROM builds WHERE started >= ?'
+        args = [since or 0]
+        if repo is not None:
+            sql += ' AND repo = ?'
+            args.append(repo)
+        sql += ' ORDER BY duration DESC LIMIT ?'
+        args.append(limit)
+        return self._query(sql, args)
+
+    def trends(self, period=24 * 60 * 60, repo=None, since=None):
+        """
+        Summarise builds per repo over periods of time.
+
+        :param: period:
+        The length of each period in seconds.
+
+        :returns:
+        Rows of (repo, period_start, builds, failures, mean_duration,
+        max_duration, mean_artifact_size), oldest first.
+        """
+        sql = ('SELECT repo, '
+               'CAST(started / ? AS INTEGER) * ? AS period_start, '
+               'COUNT(*) AS builds, '
+               "SUM(status != 'succeeded') AS failures, "
+               'AVG(duration) AS mean_duration, '
+               'MAX(duration) AS max_duration, '
+               'AVG(artifact_size) AS mean_artifact_size '
+               'FROM builds WHERE started >= ?')
+        args = [period, period, since or 0]
+        if repo is not None:
+            sql += ' AND repo = ?'
+            args.append(repo)
+        sql += ' GROUP BY repo, period_start ORDER BY repo, period_start'
+        return self._query(sql, args)
+
+    def regressions(self, window=7 * 24 * 60 * 60, threshold=1.2,
+                    min_builds=3, now=None):
+        """
+        Find phases (and whole builds) of each repo that got slower: the mean
+        duration of successful runs in the last window compared to the window
+        before it.
+
+        :param: threshold:
+        The ratio of the recent to the earlier mean duration at which a
+        slowdown is reported.
+
+        :param: min_builds:
+        The number of runs each window needs for a comparison.
+
+        :returns:
+        A list of (repo, phase, earlier_mean, recent_mean, ratio) tuples,
+        biggest slowdown first. Whole builds have the phase BUILD_TOTAL.
+        """
+        now = time.time() if now is None else now
+        split = now - window
+        start = split - window
+
+        rows = self._query(
+            "SELECT repo, ? AS name, started >= ? AS recent, "
+            'AVG(duration) AS mean, COUNT(*) AS runs FROM builds '
+            "WHERE status = 'succeeded' AND started >= ? AND started < ? "
+            'GROUP BY repo, recent '
+            'UNION ALL '
+            'SELECT b.repo, p.name, b.started >= ? AS recent, '
+            'AVG(p.duration) AS mean, COUNT(*) AS runs '
+            'FROM phases p JOIN builds b ON p.build = b.id '
+            "WHERE p.status = 'succeeded' AND b.started >= ? "
+            'AND b.started < ? GROUP BY b.repo, p.name, recent',
+            (BUILD_TOTAL, split, start, now, split, start, now))
+
+        windows = {}
+        for row in rows:
+            if row['runs'] >= min_builds:
+                windows.setdefault((row['repo'], row['name']), {})[
+                    bool(row['recent'])] = row['mean']
+
+        regressions = []
+        for (repo, name), means in sorted(windows.items()):
+            if False not in means or True not in means or not means[False]:
+                continue
+            ratio = means[True] / means[False]
+            if ratio >= threshold:
+                regressions.append(
+                    (repo, name, means[False], means[True], ratio))
+        return sorted(regressions, key=lambda regression: -regression[4])
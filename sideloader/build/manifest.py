@@ -0,0 +1,134 @@
+import hashlib
+import os
+import shutil
+
+from utils import hash_file
+
+
+def get_manifest_name(deploy_name):
+    """ Get the file name of the manifest for a deploy. """
+    return '%s-manifest.txt' % deploy_name
+
+
+class ManifestEntry(object):
+    """ The size and content hash of a single file in the package tree. """
+    def __init__(self, path, size, sha256):
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+
+
+class Manifest(object):
+    """
+    Records the path, size, mode and sha256 of every file staged into the
+    package tree. Files are hashed while they are copied so the tree doesn't
+    need to be read a second time.
+    """
+
+    chunk_size = 1024 * 1024
+
+    def __init__(self, root):
+        """
+        :param: root:
+        The root of the package tree. Paths in the manifest are relative to
+        it, which makes them the absolute paths on the target without the
+        leading '/'.
+        """
+        self.root = root
+        self.entries = {}
+
+    def _relpath(self, path):
+        return os.path.relpath(path, self.root)
+
+    def copy(self, src, dst):
+        """
+        Copy a file (following symlinks) and its metadata, recording it in the
+        manifest. If dst is a directory, the file is copied into it.
+        """
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+
+        digest = hashlib.sha256()
+        size = 0
+        with open(src, 'rb') as src_file:
+            with open(dst, 'wb') as dst_file:
+                for chunk in iter(
+                        lambda: src_file.read(self.chunk_size), ''):
+                    digest.update(chunk)
+                    dst_file.write(chunk)
+                    size += len(chunk)
+        shutil.copystat(src, dst)
+
+        self.entries[self._relpath(dst)] = ManifestEntry(
+            self._relpath(dst), size, digest.hexdigest())
+        return dst
+
+    def copytree(self, src, dst):
+        """
+        Recursively copy a directory tree like shutil.copytree, recording
+        every file in the manifest.
+        """
+        os.makedirs(dst)
+        for name in sorted(os.listdir(src)):
+            src_path = os.path.join(src, name)
+            dst_path = os.path.join(dst, name)
+            if os.path.isdir(src_path):
+                self.copytree(src_path, dst_path)
+            else:
+                self.copy(src_path, dst_path)
+        shutil.copystat(src, dst)
+
+    def add(self, path):
+        """ Record a file that was written to the package tree directly. """
+        relpath = self._relpath(path)
+        self.entries[relpath] = ManifestEntry(
+            relpath, os.path.getsize(path), hash_file(path))
+
+    def get(self, path):
+        """ Get the entry for a file in the package tree, or None. """
+        return self.entries.get(self._relpath(path))
+
+    def discard(self, path):
+        """ Forget a file that was removed from the package tree. """
+        self.entries.pop(self._relpath(path), None)
+
+    def __iter__(self):
+        for relpath in sorted(self.entries):
+            yield self.entries[relpath]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def render(self):
+        """
+        Render the manifest as text, one file per line:
+        '<sha256> <size> <mode> <path>'. Modes are read when rendering so that
+        any later permission changes are included.
+        """
+        lines = []
+        for entry in self:
+            mode = os.stat(os.path.join(self.root, entry.path)).st_mode
+            lines.append('%s %d %04o %s' % (
+                entry.sha256, entry.size, mode & 0o7777, entry.path))
+        return ''.join(line + '\n' for line in lines)
+
+    def write(self, path):
+        """ Write the rendered manifest to path. """
+        with open(path, 'w') as manifest_file:
+            manifest_file.write(self.render())
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Parse a rendered manifest.
+
+        :returns:
+        A dict mapping each path to a tuple of (sha256, size, mode).
+        """
+        entries = {}
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            sha256, size, mode, path = line.split(' ', 3)
+            entries[path] = (sha256, int(size), int(mode, 8))
+        return entries
@@ -0,0 +1,308 @@
+"""
+Build metrics in the Prometheus text exposition format. Metrics can be
+written to a file for the node exporter's textfile collector after each run,
+or served over HTTP by long-running processes.
+"""
+import BaseHTTPServer
+import fcntl
+import os
+import tempfile
+import threading
+
+from phases import PhaseListener
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _format_samples(metric):
+    return [((name, _format_labels(labels)), value)
+            for name, labels, value in metric.samples()]
+
+
+class Metric(object):
+    """ Base class for a family of labelled samples. """
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if sorted(labels) != sorted(self.labelnames):
+            raise ValueError('%s requires labels %s' % (
+                self.name, ', '.join(self.labelnames)))
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """ Get a list of (name, labels, value) samples. """
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value)
+                    for key, value in sorted(self._values.items())]
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value)
+                    for key, value in sorted(self._values.items())]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    DEFAULT_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800,
+                       float('inf'))
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        if buckets[-1] != float('inf'):
+            buckets = tuple(buckets) + (float('inf'),)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * len(self.buckets), 0))
+            counts = [count + (1 if value <= bound else 0)
+                      for count, bound in zip(counts, self.buckets)]
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                for count, bound in zip(counts, self.buckets):
+                    samples.append((self.name + '_bucket',
+                                    key + (('le', _format_value(bound)),),
+                                    count))
+                samples.append((self.name + '_sum', key, total))
+                samples.append((self.name + '_count', key, counts[-1]))
+        return samples
+
+
+class Registry(object):
+    """ A collection of metrics that can be rendered together. """
+
+    def __init__(self):
+        self._metrics = []
+        # Cumulative samples carried over from other processes
+        self._baseline = None
+        # This process's cumulative samples as of its last write_textfile
+        self._written = {}
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self, snapshot=None):
+        """
+        Render all the metrics in the Prometheus text format.
+
+        :param: snapshot:
+        The counter and histogram samples to render instead of their current
+        values, from _snapshot.
+        """
+        baseline = self._baseline or {}
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+
+            carried = {}
+            if metric.type != 'gauge':
+                carried = dict(
+                    (series, value) for series, value in baseline.items()
+                    if series[0] == metric.name or
+                    series[0].startswith(metric.name + '_'))
+
+            if snapshot is not None and metric.name in snapshot:
+                current = snapshot[metric.name]
+            else:
+                current = _format_samples(metric)
+
+            samples = []
+            for series, value in current:
+                samples.append((series, value + carried.pop(series, 0)))
+            # Series seen by previous runs but not by this one
+            samples += sorted(carried.items())
+
+            for (name, labels), value in samples:
+                lines.append('%s%s %s' % (name, labels, _format_value(value)))
+        return ''.join(line + '\n' for line in lines)
+
+    def write_textfile(self, path):
+        """
+        Write the metrics to a file for the textfile collector. Counters and
+        histograms continue from the values in an existing file so that they
+        stay cumulative across runs. The file is locked while it is merged so
+        that concurrent runs don't lose each other's counts, and is replaced
+        atomically.
+        """
+        directory = os.path.dirname(path) or '.'
+        with open(path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            snapshot = self._snapshot()
+            existing = {}
+            if os.path.exists(path):
+                with open(path) as textfile:
+                    existing = parse_samples(textfile.read())
+            # What this process wrote last time is already in the file
+            self._baseline = dict(
+                (series, value - self._written.get(series, 0))
+                for series, value in existing.items())
+
+            fd, tmp_path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'w') as textfile:
+                textfile.write(self.render(snapshot))
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, path)
+            self._written = dict(sample for samples in snapshot.values()
+                                 for sample in samples)
+
+    def _snapshot(self):
+        """
+        Take the current samples of the counters and histograms, which are
+        the metrics that stay cumulative across processes.
+
+        :returns:
+        A dict mapping metric names to lists of ((name, formatted labels),
+        value) samples.
+        """
+        return dict((metric.name, _format_samples(metric))
+                    for metric in self._metrics if metric.type != 'gauge')
+
+    def start_http_server(self, port, address=''):
+        """
+        Serve the metrics over HTTP on a daemon thread.
+
+        :returns:
+        The server, so that it can be shut down.
+        """
+        registry = self
+
+        class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer((address, port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever,
+                                  name='sideloader-metrics')
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+def parse_samples(text):
+    """
+    Parse samples from the Prometheus text format.
+
+    :returns:
+    A dict mapping (name, formatted labels) to values.
+    """
+    samples = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        series, value = line.rsplit(' ', 1)
+        if '{' in series:
+            name, labels = series.split('{', 1)
+            labels = '{' + labels
+        else:
+            name, labels = series, ''
+        samples[(name, labels)] = float(value)
+    return samples
+
+
+""" The registry for the metrics below. """
+REGISTRY = Registry()
+
+BUILD_LABELS = ('repo', 'deploy_type')
+
+BUILDS = REGISTRY.counter(
+    'sideloader_builds_total', 'Number of builds started.', BUILD_LABELS)
+BUILD_FAILURES = REGISTRY.counter(
+    'sideloader_build_failures_total', 'Number of builds that failed.',
+    BUILD_LABELS)
+PHASE_DURATION = REGISTRY.histogram(
+    'sideloader_phase_duration_seconds', 'Time taken by each build phase.',
+    BUILD_LABELS + ('phase',))
+ARTIFACT_SIZE = REGISTRY.gauge(
+    'sideloader_artifact_size_bytes',
+    'Size of the last built artifact of each kind (package or deps_package).',
+    BUILD_LABELS + ('artifact_type', 'kind'))
+CACHE_LOOKUPS = REGISTRY.counter(
+    'sideloader_cache_lookups_total',
+    'Build cache lookups by cache and outcome (hit, remote_hit or miss).',
+    BUILD_LABELS + ('cache', 'outcome'))
+
+
+class MetricsListener(PhaseListener):
+    """ Records the duration of each phase of a build. """
+
+    def __init__(self, repo, deploy_type):
+        self.labels = {'repo': repo, 'deploy_type': deploy_type}
+
+    def phase_finished(self, phase, duration):
+        PHASE_DURATION.observe(duration, phase=phase.name, **self.labels)
+
+    def phase_failed(self, phase, duration, exc_info):
+        PHASE_DURATION.observe(duration, phase=phase.name, **self.labels)
@@ -0,0 +1,214 @@
+"""
+Writing OCI image tarballs without a container daemon. An image is written
+as an OCI image layout (oci-layout, index.json and content-addressed blobs)
+in a tarball, with a Docker manifest.json alongside so that `docker load`
+understands it too.
+
+Layers are written deterministically (sorted entries, root ownership and a
+fixed mtime) so the same files always give the same layer digest, and hosts
+that already have a layer don't need to pull it again.
+"""
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import StringIO
+import tarfile
+import tempfile
+import time
+
+from collections import namedtuple
+
+from utils import hash_file
+
+
+LAYER_MEDIA_TYPE = 'application/vnd.oci.image.layer.v1.tar+gzip'
+CONFIG_MEDIA_TYPE = 'application/vnd.oci.image.config.v1+json'
+MANIFEST_MEDIA_TYPE = 'application/vnd.oci.image.manifest.v1+json'
+
+""" A layer blob and the digest of its uncompressed contents. """
+Layer = namedtuple('Layer', ['path', 'digest', 'diff_id', 'size'])
+
+
+def _tree_entries(src_dir, arc_dir):
+    """
+    List (arcname, path) pairs for a directory tree, including the parent
+    directories of arc_dir, in a stable order.
+    """
+    entries = []
+    parts = arc_dir.strip('/').split('/') if arc_dir.strip('/') else []
+    for i in range(len(parts)):
+        entries.append(('/'.join(parts[:i + 1]), None))
+
+    for root, dirs, files in os.walk(src_dir):
+        dirs.sort()
+        relroot = os.path.relpath(root, src_dir)
+        for name in sorted(dirs + files):
+            relpath = os.path.normpath(os.path.join(relroot, name))
+            entries.append(('/'.join(parts + [relpath]),
+                            os.path.join(root, name)))
+    return entries
+
+
+def write_layer(trees, dst_dir, mtime=0):
+    """
+    Write a layer from directory trees.
+
+    :param: trees:
+    A list of (src_dir, arc_dir) pairs: the contents of each src_dir are
+    added at the path arc_dir in the image.
+
+    :param: dst_dir:
+    The directory to write the layer blob to.
+
+    :param: mtime:
+    The modification time to give every entry.
+
+    :returns:
+    A Layer.
+    """
+    entries = {}
+    for src_dir, arc_dir in trees:
+        for arcname, path in _tree_entries(src_dir, arc_dir):
+            entries.setdefault(arcname, path)
+
+    fd, tar_path = tempfile.mkstemp(dir=dst_dir)
+    os.close(fd)
+    try:
+        with tarfile.open(tar_path, 'w', format=tarfile.PAX_FORMAT) as tar:
+            for arcname in sorted(entries):
+                path = entries[arcname]
+                if path is None:
+                    info = tarfile.TarInfo(arcname)
+                    info.type = tarfile.DIRTYPE
+                    info.mode = 0o755
+                else:
+                    info = tar.gettarinfo(path, arcname)
+                info.uid = info.gid = 0
+                info.uname = info.gname = 'root'
+                info.mtime = mtime
+                if info.isreg():
+                    with open(path, 'rb') as src_file:
+                        tar.addfile(info, src_file)
+                else:
+                    tar.addfile(info)
+
+        diff_id = 'sha256:' + hash_file(tar_path)
+        fd, blob_path = tempfile.mkstemp(dir=dst_dir)
+        with os.fdopen(fd, 'wb') as blob_file:
+            # No filename or timestamp in the gzip header
+            with gzip.GzipFile('', 'wb', fileobj=blob_file, mtime=0) as gz:
+                with open(tar_path, 'rb') as tar_file:
+                    shutil.copyfileobj(tar_file, gz)
+    finally:
+        os.remove(tar_path)
+
+    digest = 'sha256:' + hash_file(blob_path)
+    return Layer(blob_path, digest, diff_id, os.path.getsize(blob_path))
+
+
+def _format_time(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+
+def write_image(path, layers, ref_name, env=(), working_dir=None, labels=None,
+                created=0):
+    """
+    Write an image tarball.
+
+    :param: layers:
+    The Layers of the image, from the bottom up.
+
+    :param: ref_name:
+    The name to tag the image with, e.g. 'app:1.2'.
+
+    :param: created:
+    The creation time of the image, as seconds since the epoch.
+
+    :returns:
+    The digest of the image manifest.
+    """
+    blobs = {}
+
+    def add_blob(content):
+        digest = 'sha256:' + hashlib.sha256(content).hexdigest()
+        blobs[digest] = content
+        return {'digest': digest, 'size': len(content)}
+
+    config = {
+        'created': _format_time(created),
+        'architecture': 'amd64',
+        'os': 'linux',
+        'config': {'Env': list(env), 'Labels': labels or {}},
+        'rootfs': {'type': 'layers',
+                   'diff_ids': [layer.diff_id for layer in layers]},
+        'history': [{'created': _format_time(created),
+                     'created_by': 'sideloader'} for _ in layers],
+    }
+    if working_dir is not None:
+        config['config']['WorkingDir'] = working_dir
+    config_descriptor = add_blob(_dump_json(config))
+    config_descriptor['mediaType'] = CONFIG_MEDIA_TYPE
+
+    manifest = {
+        'schemaVersion': 2,
+        'mediaType': MANIFEST_MEDIA_TYPE,
+        'config': config_descriptor,
+        'layers': [{'mediaType': LAYER_MEDIA_TYPE, 'digest': layer.digest,
+                    'size': layer.size} for layer in layers],
+    }
+    manifest_descriptor = add_blob(_dump_json(manifest))
+    manifest_descriptor['mediaType'] = MANIFEST_MEDIA_TYPE
+    manifest_descriptor['annotations'] = {
+        'org.opencontainers.image.ref.name': ref_name}
+
+    index = {'schemaVersion': 2, 'manifests': [manifest_descriptor]}
+    docker_manifest = [{
+        'Config': _blob_name(config_descriptor['digest']),
+        'RepoTags': [ref_name],
+        'Layers': [_blob_name(layer.digest) for layer in layers],
+    }]
+
+    files = [
+        ('oci-layout', _dump_json({'imageLayoutVersion': '1.0.0'})),
+        ('index.json', _dump_json(index)),
+        ('manifest.json', _dump_json(docker_manifest)),
+    ]
+    files += [(_blob_name(digest), content)
+              for digest, content in sorted(blobs.items())]
+
+    with tarfile.open(path, 'w', format=tarfile.PAX_FORMAT) as tar:
+        for name in ('blobs', 'blobs/sha256'):
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            info.mtime = created
+            tar.addfile(info)
+        for name, content in files:
+            _add_bytes(tar, name, content, created)
+        for layer in sorted(set(layers), key=lambda layer: layer.digest):
+            info = tarfile.TarInfo(_blob_name(layer.digest))
+            info.size = layer.size
+            info.mode = 0o644
+            info.mtime = created
+            with open(layer.path, 'rb') as blob_file:
+                tar.addfile(info, blob_file)
+
+    return manifest_descriptor['digest']
+
+
+def _blob_name(digest):
+    return 'blobs/%s' % digest.replace(':', '/')
+
+
+def _dump_json(obj):
+    return json.dumps(obj, sort_keys=True, separators=(',', ':'))
+
+
+def _add_bytes(tar, name, content, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = len(content)
+    info.mode = 0o644
+    info.mtime = mtime
+    tar.addfile(info, StringIO.StringIO(content))
@@ -0,0 +1,207 @@
+import Queue
+import sys
+import threading
+import time
+
+
+class Phase(object):
+    """
+    A single stage of the build pipeline. Phases declare the resources they
+    need (inputs) and the resources they produce (outputs); a phase can run as
+    soon as all of its inputs have been produced.
+    """
+    def __init__(self, name, run, inputs=(), outputs=(), restore=None):
+        """
+        :param: name:
+        A unique name for the phase, e.g. 'clone' or 'fpm'.
+
+        :param: run:
+        A callable that takes no arguments and performs the phase.
+
+        :param: inputs:
+        Names of the resources that must exist before the phase can run.
+
+        :param: outputs:
+        Names of the resources that exist once the phase has run.
+
+        :param: restore:
+        A callable that restores any state the phase keeps in memory, for
+        when a resumed build skips the phase because it already completed.
+        """
+        self.name = name
+        self.run = run
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.restore = restore
+
+    def __repr__(self):
+        return '<Phase %s>' % self.name
+
+
+class PhaseListener(object):
+    """
+    Receives notifications as phases run. Subclasses override the methods
+    they are interested in. Listeners are called from the thread that runs
+    the phase.
+    """
+
+    def phase_started(self, phase):
+        pass
+
+    def phase_finished(self, phase, duration):
+        pass
+
+    def phase_failed(self, phase, duration, exc_info):
+        pass
+
+
+class PhaseGraph(object):
+    """
+    A dependency graph of phases. Phases whose inputs are all available run
+    concurrently on a pool of threads, so independent stages (e.g. creating
+    the build virtualenv and cloning the repo) overlap.
+    """
+
+    def __init__(self, phases, available=()):
+        """
+        :param: phases:
+        The phases in the graph.
+
+        :param: available:
+        Names of resources that exist before any phase runs.
+        """
+        self.phases = list(phases)
+        self.available = frozenset(available)
+        self._validate()
+
+    def _validate(self):
+        names = set()
+        producers = {}
+        for phase in self.phases:
+            if phase.name in names:
+                raise ValueError('Duplicate phase \'%s\'' % phase.name)
+            names.add(phase.name)
+            for output in phase.outputs:
+                if output in producers or output in self.available:
+                    raise ValueError(
+                        'Resource \'%s\' is produced more than once' % output)
+                producers[output] = phase
+
+        for phase in self.phases:
+            for resource in phase.inputs:
+                if (resource not in producers and
+                        resource not in self.available):
+                    raise ValueError(
+                        'Phase \'%s\' requires \'%s\' which no phase produces'
+                        % (phase.name, resource))
+
+        # Raises if there is a cycle
+        self.ordered()
+
+    def ordered(self):
+        """
+        Get the phases in an order in which they could be run one at a time.
+        Ties are broken by the order in which the phases were given.
+        """
+        produced = set(self.available)
+        pending = list(self.phases)
+        ordered = []
+        while pending:
+            ready = [phase for phase in pending
+                     if produced.issuperset(phase.inputs)]
+            if not ready:
+                raise ValueError('Phases %s have cyclic dependencies' % (
+                    ', '.join(phase.name for phase in pending)))
+            phase = ready[0]
+            pending.remove(phase)
+            ordered.append(phase)
+            produced.update(phase.outputs)
+        return ordered
+
+    def run(self, max_workers=4, listeners=()):
+        """
+        Run all the phases, starting each one as soon as its inputs have been
+        produced. If a phase fails, no further phases are started, the
+        running ones are allowed to finish and the first error is re-raised.
+
+        :param: max_workers:
+        The maximum number of phases to run at once. With 1, the phases run
+        one at a time in order.
+
+        :param: listeners:
+        PhaseListener instances to notify as phases start and finish.
+
+        :returns:
+        A dict mapping each phase name to its duration in seconds.
+        """
+        produced = set(self.available)
+        pending = list(self.phases)
+        durations = {}
+        completed = Queue.Queue()
+        running = 0
+        failure = None
+
+        while pending or running:
+            if failure is None:
+                ready = [phase for phase in pending
+                         if produced.issuperset(phase.inputs)]
+                for phase in ready[:max(max_workers - running, 0)]:
+                    pending.remove(phase)
+                    running += 1
+                    self._start(phase, completed, listeners)
+
+            if not running:
+                # Either a phase failed or nothing else can ever run
+                break
+
+            phase, duration, exc_info = self._wait(completed)
+            running -= 1
+            durations[phase.name] = duration
+            if exc_info is not None:
+                if failure is None:
+                    failure = exc_info
+            else:
+                produced.update(phase.outputs)
+
+        if failure is not None:
+            raise failure[0], failure[1], failure[2]
+
+        return durations
+
+    def _start(self, phase, completed, listeners):
+        thread = threading.Thread(
+            target=self._run_phase, args=(phase, completed, listeners),
+            name='phase-%s' % phase.name)
+        thread.daemon = True
+        thread.start()
+
+    def _wait(self, completed):
+        # Waiting with a timeout keeps the main thread interruptible
+        while True:
+            try:
+                return completed.get(timeout=1)
+            except Queue.Empty:
+                pass
+
+    def _run_phase(self, phase, completed, listeners):
+        start = time.time()
+        exc_info = None
+        try:
+            for listener in listeners:
+                listener.phase_started(phase)
+            phase.run()
+        except BaseException:
+            exc_info = sys.exc_info()
+
+        duration = time.time() - start
+        try:
+            for listener in listeners:
+                if exc_info is None:
+                    listener.phase_finished(phase, duration)
+                else:
+                    listener.phase_failed(phase, duration, exc_info)
+        except BaseException:
+            if exc_info is None:
+                exc_info = sys.exc_info()
+
+        completed.put((phase, duration, exc_info))
@@ -0,0 +1,146 @@
+"""
+Build plans: which phases a build would run and which would be served from
+caches or reuse existing work, with estimates of how long each would take
+based on the build history.
+"""
+from collections import namedtuple
+
+
+""" The cache namespace that decides whether each phase does real work. """
+PHASE_CACHES = {
+    'pip': 'venvs',
+    'build_steps': 'steps',
+    'wheel': 'wheels',
+    'deps_package': 'packages',
+}
+
+""" Actions for phases that do little or no work. """
+CHEAP_ACTIONS = ('cached', 'reuse', 'pool')
+
+""" A phase in a plan, with an estimate in seconds (None if unknown). """
+PlannedPhase = namedtuple('PlannedPhase',
+                          ['name', 'action', 'reason', 'estimate'])
+
+
+def _median(values):
+    if not values:
+        return None
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def estimate_durations(history, repo, limit=20):
+    """
+    Estimate the duration of each phase from the last successful builds of
+    a repo. Phases with a cache are estimated separately for the builds
+    where the cache was hit and the builds where it was missed.
+
+    :returns:
+    A dict mapping phase names to dicts mapping 'run', 'cached' and 'any'
+    to median durations (or None where there were no such builds).
+    """
+    missed = set()
+    looked_up = set()
+    for lookup in history.recent_cache_lookups(repo, limit):
+        looked_up.add((lookup['build'], lookup['cache']))
+        if lookup['outcome'] == 'miss':
+            missed.add((lookup['build'], lookup['cache']))
+
+    samples = {}
+    for phase in history.recent_phases(repo, limit):
+        cache = PHASE_CACHES.get(phase['name'])
+        if cache is None or (phase['build'], cache) not in looked_up:
+            kind = None
+        elif (phase['build'], cache) in missed:
+            kind = 'run'
+        else:
+            kind = 'cached'
+        phase_samples = samples.setdefault(phase['name'], {
+            'run': [], 'cached': [], 'any': []})
+        phase_samples['any'].append(phase['duration'])
+        if kind is not None:
+            phase_samples[kind].append(phase['duration'])
+
+    return dict(
+        (name, dict((kind, _median(durations))
+                    for kind, durations in phase_samples.items()))
+        for name, phase_samples in samples.items())
+
+
+class BuildPlan(object):
+    """ The phases a build would run and how long it would take. """
+
+    def __init__(self, repo, branch, revision, phases, actions, durations):
+        """
+        :param: phases:
+        The build's Phases in an order they could run in.
+
+        :param: actions:
+        A dict mapping phase names to (action, reason) tuples for the phases
+        that wouldn't simply run: 'skip', 'cached', 'reuse', 'pool' or
+        'maybe'.
+
+        :param: durations:
+        Phase durations from the history, from estimate_durations.
+        """
+        self.repo = repo
+        self.branch = branch
+        self.revision = revision
+        self._graph = phases
+        self.phases = []
+        for phase in phases:
+            action, reason = actions.get(phase.name, ('run', ''))
+            self.phases.append(PlannedPhase(
+                phase.name, action, reason,
+                self._estimate(durations.get(phase.name), action)))
+
+    @staticmethod
+    def _estimate(durations, action):
+        if action == 'skip':
+            return 0
+        if durations is None:
+            return None
+        kind = 'cached' if action in CHEAP_ACTIONS else 'run'
+        if durations.get(kind) is not None:
+            return durations[kind]
+        return durations['any']
+
+    def get_duration(self):
+        """
+        Estimate the duration of the build: the longest chain of phases that
+        depend on each other, as independent phases run at the same time.
+        Phases without an estimate count as taking no time.
+        """
+        estimates = dict((planned.name, planned.estimate or 0)
+                         for planned in self.phases)
+        ready = {}
+        finished = {}
+        for phase in self._graph:
+            start = max([ready.get(resource, 0) for resource in phase.inputs]
+                        or [0])
+            finished[phase.name] = start + estimates[phase.name]
+            for resource in phase.outputs:
+                ready[resource] = finished[phase.name]
+        return max(finished.values() or [0])
+
+    def render(self):
+        """ Render the plan as a table for humans. """
+        lines = ['Plan for %s %s at %s' % (self.repo, self.branch,
+                                           self.revision or 'unknown'),
+                 '%-16s %-8s %9s  %s' % ('phase', 'action', 'estimate',
+                                         'reason')]
+        for planned in self.phases:
+            estimate = ('%8.1fs' % planned.estimate
+                        if planned.estimate is not None else '        ?')
+            lines.append('%-16s %-8s %9s  %s' % (
+                planned.name, planned.action, estimate, planned.reason))
+
+        unknown = [planned.name for planned in self.phases
+                   if planned.estimate is None]
+        lines.append('Estimated duration: %.1fs' % self.get_duration())
+        if unknown:
+            lines.append('No history for: %s' % ', '.join(unknown))
+        return ''.join(line + '\n' for line in lines)
@@ -0,0 +1,180 @@
+"""
+Profiling for builds. Writes a cProfile dump that can be loaded with pstats
+or snakeviz, collapsed stacks for flamegraph.pl and a report of the time
+spent in subprocesses.
+"""
+import collections
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+
+import utils
+
+from phases import PhaseListener
+from sideloader import Build, Package, Workspace
+from utils import log
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+
+def _is_cmd_frame(frame):
+    return frame.f_code is utils.cmd.__code__
+
+
+class Profiler(PhaseListener):
+    """
+    Profiles a build. Python code is profiled with cProfile (in the main
+    thread and in every phase thread) and the stacks of all threads are
+    sampled to produce flamegraph-compatible collapsed stacks, in which time
+    spent waiting for commands appears as '[subprocess <command>]' frames.
+    The wall time of every command is also attributed to the Workspace,
+    Build or Package method that ran it.
+
+    Add the profiler as a phase listener of the Sideloader before calling
+    run() so that the phase threads are profiled.
+    """
+
+    sample_interval = 0.005
+    attributed_classes = (Workspace, Build, Package)
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._profiles = []
+        self._stacks = collections.Counter()
+        self._commands = collections.defaultdict(lambda: [0, 0.0])
+        self._sampling = threading.Event()
+
+    def run(self, func, *args, **kwargs):
+        """ Run func under the profiler and write the results. """
+        main_profile = cProfile.Profile()
+        self._profiles.append(main_profile)
+
+        sampler = threading.Thread(target=self._sample,
+                                   name='sideloader-profiler')
+        sampler.daemon = True
+        self._sampling.set()
+        sampler.start()
+        utils.command_observers.append(self._observe_command)
+        try:
+            return main_profile.runcall(func, *args, **kwargs)
+        finally:
+            utils.command_observers.remove(self._observe_command)
+            self._sampling.clear()
+            sampler.join()
+            self.write()
+
+    def phase_started(self, phase):
+        profile = cProfile.Profile()
+        self._local.profile = profile
+        profile.enable()
+
+    def phase_finished(self, phase, duration):
+        profile = getattr(self._local, 'profile', None)
+        if profile is None:
+            return
+        profile.disable()
+        self._local.profile = None
+        with self._lock:
+            self._profiles.append(profile)
+
+    def phase_failed(self, phase, duration, exc_info):
+        self.phase_finished(phase, duration)
+
+    def _sample(self):
+        own_ident = threading.current_thread().ident
+        while self._sampling.is_set():
+            names = dict((thread.ident, thread.name)
+                         for thread in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = self._collapse(frame, names.get(ident, 'thread'))
+                with self._lock:
+                    self._stacks[stack] += 1
+            time.sleep(self.sample_interval)
+
+    def _collapse(self, frame, thread_name):
+        """ Collapse a stack into 'thread;outer;...;inner'. """
+        names = []
+        leaf = None
+        while frame is not None:
+            if leaf is None and _is_cmd_frame(frame):
+                args = frame.f_locals.get('args')
+                if isinstance(args, list) and args:
+                    leaf = '[subprocess %s]' % os.path.basename(str(args[0]))
+            names.append(_frame_name(frame))
+            frame = frame.f_back
+
+        names.append(thread_name)
+        names.reverse()
+        if leaf is not None:
+            names.append(leaf)
+        return ';'.join(name.replace(';', ':') for name in names)
+
+    def _observe_command(self, args, duration):
+        """ Attribute a command's wall time to the method that ran it. """
+        caller = 'unknown'
+        frame = sys._getframe(1)
+        while frame is not None:
+            owner = frame.f_locals.get('self')
+            if isinstance(owner, self.attributed_classes):
+                caller = '%s.%s' % (type(owner).__name__,
+                                    frame.f_code.co_name)
+                break
+            frame = frame.f_back
+
+        command = os.path.basename(str(args[0] if args else args))
+        with self._lock:
+            stats = self._commands[(caller, command)]
+            stats[0] += 1
+            stats[1] += duration
+
+    def render_command_report(self):
+        """
+        Render the subprocess wall time per calling method, longest first.
+        """
+        lines = ['%10s %6s  %-40s %s' % ('seconds', 'calls', 'method',
+                                         'command')]
+        for (caller, command), (calls, seconds) in sorted(
+                self._commands.items(), key=lambda item: -item[1][1]):
+            lines.append('%10.3f %6d  %-40s %s' % (
+                seconds, calls, caller, command))
+        return '\n'.join(lines) + '\n'
+
+    def render_collapsed_stacks(self):
+        """
+        Render the sampled stacks in the collapsed format used by
+        flamegraph.pl, weighted in milliseconds.
+        """
+        weight = self.sample_interval * 1000
+        return ''.join('%s %d\n' % (stack, max(int(count * weight), 1))
+                       for stack, count in sorted(self._stacks.items()))
+
+    def write(self):
+        """ Write the profile, collapsed stacks and subprocess report. """
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+
+        stats = pstats.Stats(self._profiles[0])
+        for profile in self._profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(os.path.join(self.output_dir, 'sideloader.prof'))
+
+        with open(os.path.join(self.output_dir, 'sideloader.collapsed'),
+                  'w') as collapsed_file:
+            collapsed_file.write(self.render_collapsed_stacks())
+
+        with open(os.path.join(self.output_dir, 'subprocesses.txt'),
+                  'w') as report_file:
+            report_file.write(self.render_command_report())
+
+        log('Profile written to %s' % self.output_dir)
@@ -0,0 +1,156 @@
+"""
+Structured results of builds, so that programs driving builds can find out
+what was built without scanning the workspace or parsing the build log.
+"""
+import os
+
+from collections import namedtuple
+
+from utils import hash_file
+
+
+""" The duration in seconds and outcome of a phase of a build. """
+PhaseTiming = namedtuple('PhaseTiming', ['name', 'duration', 'status'])
+
+
+class Artifact(object):
+    """ A file produced by a build. """
+
+    def __init__(self, path, kind, size, sha256):
+        """
+        :param: kind:
+        'package' for the package (or image) itself, 'deps_package' for the
+        dependencies package or 'manifest' for the published manifest.
+        """
+        self.path = path
+        self.kind = kind
+        self.size = size
+        self.sha256 = sha256
+
+    @classmethod
+    def from_path(cls, path, kind='package'):
+        """ Describe the file at path, hashing its contents. """
+        return Artifact(path, kind, os.path.getsize(path), hash_file(path))
+
+    def to_dict(self):
+        return {'path': self.path, 'kind': self.kind, 'size': self.size,
+                'sha256': self.sha256}
+
+    @classmethod
+    def from_dict(cls, artifact_dict):
+        return Artifact(artifact_dict['path'], artifact_dict['kind'],
+                        artifact_dict['size'], artifact_dict['sha256'])
+
+
+class BuildResult(object):
+    """ What a successful build produced and how it went. """
+
+    def __init__(self, build_id=None, repo=None, branch=None, revision=None,
+                 version=None, deploy_type=None, target=None, started=None,
+                 duration=None, artifacts=[], phases=[], cache_outcomes=[],
+                 coalesced=False):
+        """
+        :param: revision:
+        The commit that was built (or the content hash of a local source).
+
+        :param: version:
+        The version of the package, or None if fpm took it from the source.
+
+        :param: started:
+        The time the build started, as seconds since the epoch.
+
+        :param: artifacts:
+        A list of Artifacts.
+
+        :param: phases:
+        A list of PhaseTimings in the order the phases finished.
+
+        :param: cache_outcomes:
+        (cache, outcome) tuples for each cache lookup.
+
+        :param: coalesced:
+        Whether the result was shared by an identical build rather than
+        built for this request.
+        """
+        self.build_id = build_id
+        self.repo = repo
+        self.branch = branch
+        self.revision = revision
+        self.version = version
+        self.deploy_type = deploy_type
+        self.target = target
+        self.started = started
+        self.duration = duration
+        self.artifacts = artifacts
+        self.phases = phases
+        self.cache_outcomes = cache_outcomes
+        self.coalesced = coalesced
+
+    def get_artifact(self, kind='package'):
+        """ Get the first artifact of a kind, or None if there isn't one. """
+        for artifact in self.artifacts:
+            if artifact.kind == kind:
+                return artifact
+        return None
+
+    def get_paths(self, kinds=('package', 'deps_package')):
+        """ Get the paths to the artifacts of the given kinds. """
+        return [artifact.path for artifact in self.artifacts
+                if artifact.kind in kinds]
+
+    def get_cache_summary(self):
+        """
+        Count the cache lookups.
+
+        :returns:
+        A dict mapping cache namespaces to dicts mapping outcomes to counts.
+        """
+        summary = {}
+        for cache, outcome in self.cache_outcomes:
+            counts = summary.setdefault(cache, {})
+            counts[outcome] = counts.get(outcome, 0) + 1
+        return summary
+
+    def relocate(self, artifact_dir):
+        """
+        Get a copy of the result with the artifacts in another directory
+        (under the same names).
+        """
+        artifacts = [
+            Artifact(os.path.join(artifact_dir,
+                                  os.path.basename(artifact.path)),
+                     artifact.kind, artifact.size, artifact.sha256)
+            for artifact in self.artifacts]
+        result = BuildResult.from_dict(self.to_dict())
+        result.artifacts = artifacts
+        return result
+
+    def to_dict(self):
+        """ Convert the result to a dict that can be serialised as JSON. """
+        return {
+            'build_id': self.build_id,
+            'repo': self.repo,
+            'branch': self.branch,
+            'revision': self.revision,
+            'version': self.version,
+            'deploy_type': self.deploy_type,
+            'target': self.target,
+            'started': self.started,
+            'duration': self.duration,
+            'artifacts': [artifact.to_dict() for artifact in self.artifacts],
+            'phases': [list(phase) for phase in self.phases],
+            'cache_outcomes': [list(lookup)
+                               for lookup in self.cache_outcomes],
+            'coalesced': self.coalesced,
+        }
+
+    @classmethod
+    def from_dict(cls, result_dict):
+        kwargs = dict(result_dict)
+        kwargs['artifacts'] = [Artifact.from_dict(artifact)
+                               for artifact in result_dict['artifacts']]
+        kwargs['phases'] = [PhaseTiming(*phase)
+                            for phase in result_dict['phases']]
+        kwargs['cache_outcomes'] = [tuple(lookup) for lookup
+                                    in result_dict['cache_outcomes']]
+        return BuildResult(**kwargs)
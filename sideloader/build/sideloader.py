@@ -1,14 +1,47 @@
+import inspect
+import json
 import os
+import re
 import shutil
+import sqlite3
+import tempfile
+import time
+import uuid
 import yaml
 
 from collections import namedtuple
 from urlparse import urlparse
 
+import buildlog
+import bytecode
+import cancellation
 import deploy_types
-
+import history
+import metrics
+import oci
+import plan
+import slimming
+import watch
+import wheels
+
+from cache import (
+    BuildCache, LocalCache, cache_key, create_remote_cache, pack_dir,
+    unpack_dir)
+from build_steps import BuildStep
+from checkpoint import CHECKPOINT_FILE, Checkpoints, get_run_key
+from coalesce import BuildCoalescer
 from config_files import ConfigFiles
-from utils import cmd, create_venv_paths, listdir_abs, log, rmtree_if_exists
+from manifest import Manifest, get_manifest_name
+from phases import Phase, PhaseGraph
+from result import Artifact, BuildResult, PhaseTiming
+from utils import (
+    cmd, create_venv_paths, dir_size, extract_tarball, hash_file, hash_tree,
+    link_tree, listdir_abs, log, normalize_tree, parse_size, reflink_tree,
+    relocate_venv, rmtree_if_exists, walk_sorted)
+from venv_pool import VENV_POOL_DIR, VenvPool
+from workspace_gc import (
+    WorkspaceGC, clear_in_use, get_staging_name, mark_in_use, touch_last_use)
+from workspace_lock import lease_workspace
 
 
 class Workspace(object):
@@ -20,6 +53,11 @@ class Workspace(object):
     debug = False
     _cmd = lambda self, *args, **kwargs: cmd(*args, debug=self.debug, **kwargs)
 
+    # In-memory staging of the build and package directories (disabled unless
+    # a staging directory such as /dev/shm is set)
+    staging_dir = None
+    staging_cap = None
+
     def __init__(self, workspace_id, workspace_base, install_location, repo):
         self.install_location = install_location
         self.repo = repo
@@ -34,6 +72,7 @@ class Workspace(object):
         dirs = {
             'repo': os.path.join(self._dir, self.repo.name),
             'build': os.path.join(self._dir, 'build'),
+            'artifacts': os.path.join(self._dir, 'artifacts'),
             'package': package_path,
             'install': os.path.join(package_path,
                                     install_location.lstrip('/'))
@@ -45,7 +84,37 @@ class Workspace(object):
         Create the workspace and fetch the repo.
         """
         self.create_clean_workspace()
+        self.fetch_source()
+
+    def phases(self):
+        """ Get the phases that set up the workspace. """
+        return [
+            Phase('workspace', self.create_clean_workspace,
+                  outputs=['workspace']),
+            Phase('clone', self.fetch_source,
+                  inputs=['workspace'], outputs=['repo'],
+                  restore=self.resolve_revision),
+        ]
+
+    def fetch_source(self):
+        """ Fetch the repo and record its revision. """
         self.fetch_repo()
+        self.resolve_revision()
+
+    def acquire(self):
+        """
+        Mark the workspace as in use so that it isn't garbage collected while
+        the build is running.
+        """
+        if not os.path.exists(self._dir):
+            os.makedirs(self._dir)
+        mark_in_use(self._dir)
+        touch_last_use(self._dir)
+
+    def release(self):
+        """ Mark the workspace as no longer in use. """
+        touch_last_use(self._dir)
+        clear_in_use(self._dir)
 
     def create_clean_workspace(self):
         """
@@ -59,13 +128,51 @@ class Workspace(object):
     def clean_workspace(self):
         """ Clean up the workspace directory (but not the virtualenv). """
         for path in self._dirs:
-            rmtree_if_exists(path)
+            self._remove_dir(path)
+        if self.staging_dir is not None:
+            rmtree_if_exists(self._get_staged_path())
+        checkpoint_path = self.get_path(CHECKPOINT_FILE)
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
 
     def fetch_repo(self):
-        """ Clone the repo and checkout the desired branch. """
-        log('Fetching github repo')
-        self._cmd(['git', 'clone', self.repo.url, self._dirs.repo])
-        self._cmd(['git', '-C', self._dirs.repo, 'checkout', self.repo.branch])
+        """ Fetch the source into the repo directory. """
+        self.repo.fetch(self._dirs.repo, self._cmd)
+
+    def restage_source(self, relpaths):
+        """
+        Bring the repo directory up to date with changes to a local source.
+
+        :param: relpaths:
+        The paths that changed, relative to the source.
+        """
+        self.repo.restage(self._dirs.repo, relpaths)
+
+    def resolve_revision(self):
+        """
+        Record the revision of the fetched source: the commit SHA for git
+        repos or a content hash for local sources.
+        """
+        self.repo.resolve_revision(self._dirs.repo, self._cmd)
+        log('Building revision %s' % (self.repo.revision,))
+
+    def get_source_date_epoch(self):
+        """
+        Get the timestamp to use for reproducible builds: SOURCE_DATE_EPOCH
+        from the environment if set, otherwise the time of the checked out
+        commit, otherwise the epoch itself.
+        """
+        epoch = os.environ.get('SOURCE_DATE_EPOCH')
+        if epoch:
+            return int(epoch)
+
+        if os.path.isdir(self.get_repo_path('.git')):
+            output = self._cmd(
+                ['git', '-C', self._dirs.repo, 'log', '-1', '--format=%ct'])
+            if output:
+                return int(output.strip())
+
+        return 0
 
     def load_deploy(self, deploy_file='.deploy.yaml'):
         """
@@ -87,14 +194,138 @@ class Workspace(object):
         Create the build directory (the workspace directory should already
         exist).
         """
-        os.mkdir(self._dirs.build)
+        self._make_staged_dir(self._dirs.build)
 
     def make_package_dir(self):
         """
         Create the package directory (the workspace directory should already
         exist).
         """
-        os.mkdir(self._dirs.package)
+        self._make_staged_dir(self._dirs.package)
+
+    def _make_staged_dir(self, path):
+        """
+        Create a directory in the workspace, replacing any left by an earlier
+        attempt at the build. If in-memory staging is enabled and there is
+        enough room, the directory is created in the staging directory and
+        symlinked into the workspace.
+        """
+        self._remove_dir(path)
+        if not self._can_stage():
+            os.mkdir(path)
+            return
+
+        staged_path = self._get_staged_path(os.path.basename(path))
+        rmtree_if_exists(staged_path)
+        os.makedirs(staged_path)
+        try:
+            os.symlink(staged_path, path)
+        except OSError:
+            rmtree_if_exists(staged_path)
+            raise
+
+    def _remove_dir(self, path):
+        if os.path.islink(path):
+            # A directory that was staged in memory
+            rmtree_if_exists(os.path.realpath(path))
+            os.remove(path)
+        else:
+            rmtree_if_exists(path)
+
+    def _can_stage(self):
+        if self.staging_dir is None or self.staging_cap is None:
+            return False
+        if not os.path.isdir(self.staging_dir):
+            log('WARNING: Staging directory %s not found, staging on disk'
+                % self.staging_dir)
+            return False
+
+        if self._get_staging_space() < self.staging_cap:
+            log('Not enough space to stage in %s, staging on disk'
+                % self.staging_dir)
+            return False
+        return True
+
+    def _get_staging_space(self):
+        """ Get the number of bytes free in the staging directory. """
+        stat = os.statvfs(self.staging_dir)
+        return stat.f_bavail * stat.f_frsize
+
+    def _get_staged_path(self, *paths):
+        """ Get a path within this workspace's in-memory staging area. """
+        return os.path.join(self.staging_dir, get_staging_name(self._dir),
+                            *paths)
+
+    def _staged_dirs(self):
+        return [path for path in (self._dirs.build, self._dirs.package)
+                if os.path.islink(path)]
+
+    def has_lost_staging(self):
+        """
+        Check whether directories staged in memory have been lost since they
+        were created, e.g. by a reboot.
+        """
+        return any(not os.path.exists(path) for path in self._staged_dirs())
+
+    def check_staging(self):
+        """
+        Move the in-memory build and package directories to disk if together
+        they have grown past the staging size cap, or if the staging directory
+        no longer has room for them to grow up to it. It is checked before
+        the phases that write a lot, so that they fall back to disk before
+        running out of space rather than failing.
+        """
+        staged = self._staged_dirs()
+        if not staged:
+            return
+
+        size = sum(dir_size(os.path.realpath(path)) for path in staged)
+        if size > self.staging_cap:
+            log('Staged files exceed %d bytes, moving them to disk'
+                % self.staging_cap)
+        elif self._get_staging_space() < self.staging_cap - size:
+            log('Not enough space left in %s, moving staged files to disk'
+                % self.staging_dir)
+        else:
+            return
+        self.unstage()
+
+    def unstage(self):
+        """
+        Move the in-memory build and package directories to disk and free
+        the staging area, e.g. when a build fails, so that they can be
+        resumed from disk.
+        """
+        staged = self._staged_dirs()
+        for path in staged:
+            staged_path = os.path.realpath(path)
+            if not os.path.exists(staged_path):
+                # Lost, e.g. by a reboot (has_lost_staging still says so)
+                continue
+            os.remove(path)
+            shutil.move(staged_path, path)
+        if staged:
+            rmtree_if_exists(self._get_staged_path())
+
+    def persist_staging(self):
+        """
+        Move the finished artifacts out of the in-memory package directory to
+        the package directory on disk and free the staging area.
+        """
+        staged = self._staged_dirs()
+        for path in staged:
+            staged_path = os.path.realpath(path)
+            os.remove(path)
+            os.mkdir(path)
+            if path == self._dirs.package:
+                for name in os.listdir(staged_path):
+                    artifact = os.path.join(staged_path, name)
+                    if os.path.isfile(artifact):
+                        shutil.move(artifact, path)
+            rmtree_if_exists(staged_path)
+
+        if staged:
+            rmtree_if_exists(self._get_staged_path())
 
     def make_install_dir(self):
         """
@@ -117,6 +348,13 @@ class Workspace(object):
         """ Get a path within the package directory. """
         return os.path.join(self._dirs.package, *paths)
 
+    def get_artifact_path(self, *paths):
+        """
+        Get a path within the directory for artifacts that are built outside
+        the package directory, so that they don't end up in the package.
+        """
+        return os.path.join(self._dirs.artifacts, *paths)
+
     def get_build_path(self, *paths):
         """ Get a path within the build directory. """
         return os.path.join(self._dirs.build, *paths)
@@ -133,6 +371,18 @@ class Workspace(object):
 class Build(object):
 
     debug = False
+    # Set to a timestamp to make the build reproducible
+    source_date_epoch = None
+    # The number of independent build phases to run at once
+    max_workers = 1
+    # A BuildCache for virtualenvs and wheels (caching is off if None)
+    cache = None
+    # A VenvPool to take new virtualenvs from (None to create them)
+    venv_pool = None
+    # The interpreter for new virtualenvs (None for virtualenv's default)
+    python = None
+    # The number of processes to compile bytecode with (None for one per CPU)
+    bytecode_workers = None
     _cmd = lambda self, *args, **kwargs: cmd(*args, debug=self.debug, **kwargs)
 
     def __init__(self, workspace, deploy, deploy_type):
@@ -152,17 +402,215 @@ class Build(object):
         self.deploy_type = deploy_type
 
         self.venv_paths = create_venv_paths(workspace.get_path())
+        self.manifest = Manifest(workspace.get_package_path())
+        # The environment of the buildscript and build steps
+        self.build_env = {}
 
     def build(self):
         """
         Build the workspace. Gets everything into a state that is ready for
-        packaging.
+        packaging. The workspace should already be set up.
+        """
+        graph = PhaseGraph(self.phases(),
+                           available=['workspace', 'repo', 'deploy'])
+        graph.run(self.max_workers)
+
+    def phases(self):
+        """
+        Get the phases of the build. They depend on the 'workspace', 'repo'
+        and 'deploy' resources and produce the 'package_tree' resource.
+        """
+        phases = [
+            Phase('virtualenv', self.create_virtualenv,
+                  inputs=['workspace'], outputs=['venv']),
+            Phase('pip', self.install_dependencies,
+                  inputs=['venv', 'deploy'], outputs=['dependencies']),
+            Phase('build_dir', self.make_build_dir,
+                  inputs=['workspace', 'repo', 'deploy'],
+                  outputs=['build_dir'], restore=self.put_env_variables),
+            Phase('build_steps', self.run_build_steps,
+                  inputs=['build_dir', 'dependencies'],
+                  outputs=['step_outputs']),
+            Phase('buildscript', self.run_buildscript_and_check,
+                  inputs=['build_dir', 'dependencies', 'step_outputs'],
+                  outputs=['build_output']),
+            Phase('package_dir', self.make_package_dir,
+                  inputs=['workspace'], outputs=['package_dir']),
+            Phase('copy_build', self.copy_build,
+                  inputs=['build_output', 'package_dir'],
+                  outputs=['install_tree'], restore=self.restore_manifest),
+            Phase('copy_config', self.copy_config_files,
+                  inputs=['build_output', 'install_tree'],
+                  outputs=['config_files']),
+            Phase('freeze', self.freeze_virtualenv,
+                  inputs=['build_output', 'install_tree'],
+                  outputs=['requirements']),
+            Phase('slim', self.slim_install_tree,
+                  inputs=['install_tree', 'config_files', 'requirements'],
+                  outputs=['slim_tree']),
+            Phase('postinstall', self.create_postinstall_script,
+                  inputs=['repo', 'deploy'], outputs=['postinstall']),
+            Phase('bytecode', self.compile_bytecode,
+                  inputs=['slim_tree', 'venv'], outputs=['bytecode']),
+            Phase('finalize', self.finalize_package_tree,
+                  inputs=['bytecode', 'postinstall'],
+                  outputs=['package_tree']),
+        ]
+        if self.deploy_type.builds_wheel:
+            # The wheel replaces the build directory and the requirements
+            phases = [phase for phase in phases
+                      if phase.name not in ('copy_build', 'freeze')]
+            phases.append(Phase('wheel', self.install_wheel,
+                                inputs=['build_output', 'package_dir'],
+                                outputs=['install_tree', 'requirements'],
+                                restore=self.restore_manifest))
+        return phases
+
+    def check_resumable(self, names):
+        """
+        Work out which of the build phases that a previous build completed
+        a resumed build can skip. The build and package directories are
+        written to by several phases, so they are created again (and the
+        phases that fill them run again) unless the last phase to write to
+        the build directory and the first to write to the package directory
+        completed, rather than being picked up partway.
+
+        :param: names:
+        The names of the phases that completed.
+
+        :returns:
+        The names of the phases that can be skipped.
+        """
+        rerun = set()
+        if 'buildscript' not in names:
+            rerun.update(['build_dir', 'build_steps'])
+        if 'copy_build' not in names and 'wheel' not in names:
+            rerun.add('package_dir')
+        return [name for name in names if name not in rerun]
+
+    def plan_phases(self, repo_path):
         """
-        self.prepare_environment()
+        Work out which build phases would be skipped or served from caches
+        or existing work, without running anything but the build
+        virtualenv's interpreter. Caches are probed without being updated.
+
+        :param: repo_path:
+        A checkout of the repo that the build would use.
+
+        :returns:
+        A dict mapping phase names to (action, reason) tuples for the phases
+        that wouldn't simply run.
+        """
+        actions = {}
+        python_version = None
+        if os.path.exists(self.venv_paths.python):
+            actions['virtualenv'] = ('reuse', 'the workspace has one')
+            python_version = self._cmd(
+                [self.venv_paths.python, '-c',
+                 'import sys; print(sys.version)'])
+        elif self.venv_pool is not None and self.venv_pool.count():
+            actions['virtualenv'] = ('pool', 'one is ready in the pool')
+
+        if not self.deploy.pip:
+            actions['pip'] = ('skip', 'no pip dependencies')
+        elif self.cache is None:
+            actions['pip'] = ('run', 'caching is off')
+        elif python_version is None:
+            actions['pip'] = (
+                'run', 'new virtualenv, the cache key is not known yet')
+        else:
+            outcome = self.cache.probe(
+                'venvs', self.get_virtualenv_cache_key(python_version))
+            if outcome != 'miss':
+                actions['pip'] = ('cached', 'virtualenv %s' % outcome)
+            else:
+                deps = [dep for dep in self.deploy.pip
+                        if not self._is_repo_dependency(dep)]
+                hits = [dep for dep in deps if self.cache.probe(
+                    'wheels', cache_key(python_version, dep)) != 'miss']
+                actions['pip'] = ('run', '%d of %d wheels cached' % (
+                    len(hits), len(deps)))
+
+        if not self.deploy.build_steps:
+            actions['build_steps'] = ('skip', 'no build steps')
+        else:
+            changed = [
+                step.name for step in self.deploy.build_steps
+                if self.cache is None or self.cache.probe(
+                    'steps', step.get_cache_key(repo_path)) == 'miss']
+            if changed:
+                actions['build_steps'] = (
+                    'run', 'no cached outputs for %s' % ', '.join(changed))
+            else:
+                actions['build_steps'] = ('cached', 'inputs unchanged')
+
+        if not self.deploy.buildscript:
+            actions['buildscript'] = ('skip', 'no buildscript')
+
+        if self.deploy_type.builds_wheel:
+            if self.cache is None:
+                actions['wheel'] = ('run', 'caching is off')
+            elif python_version is None:
+                actions['wheel'] = (
+                    'run', 'new virtualenv, the cache key is not known yet')
+            else:
+                version = '.'.join(python_version.split()[0].split('.')[:2])
+                outcome = self.cache.probe('wheels', cache_key(
+                    'pep517', version, hash_tree(repo_path)))
+                actions['wheel'] = (
+                    ('cached', 'wheel %s' % outcome) if outcome != 'miss'
+                    else ('run', 'the repo has changed'))
+
+        return actions
+
+    def make_build_dir(self):
+        """
+        Create the build directory and set up the environment for the
+        buildscript.
+        """
+        self.workspace.make_build_dir()
+        self.put_env_variables()
+
+    def restore_manifest(self):
+        """
+        Rebuild the manifest from the files in the package tree, for a
+        resumed build that skips the phases that staged them.
+        """
+        package_path = self.workspace.get_package_path()
+        shipped_path = self.workspace.get_install_path(
+            get_manifest_name(self.deploy.name))
+        self.manifest = Manifest(package_path)
+        for dir_path, _, files in os.walk(package_path):
+            if dir_path == package_path:
+                # Only artifacts are written to the package directory itself
+                continue
+            for name in files:
+                path = os.path.join(dir_path, name)
+                if path != shipped_path:
+                    self.manifest.add(path)
+
+    def run_buildscript_and_check(self):
+        """
+        Run the buildscript and move the staged build to disk if it has grown
+        too big or might run out of room.
+        """
+        self.workspace.check_staging()
         self.run_buildscript()
-        self.copy_files()
-        self.freeze_virtualenv()
-        self.create_postinstall_script()
+        self.workspace.check_staging()
+
+    def make_package_dir(self):
+        """ Create the package directory. """
+        log('Preparing package')
+        self.workspace.make_package_dir()
+
+    def finalize_package_tree(self):
+        """
+        Get the package tree ready for packaging once everything has been
+        copied into it.
+        """
+        self.workspace.check_staging()
+        self.normalize_files()
+        self.write_manifest()
 
     def prepare_environment(self):
         """
@@ -176,36 +624,168 @@ class Build(object):
 
     def create_build_virtualenv(self):
         """ Create a virtualenv for the build and install the dependencies. """
+        self.create_virtualenv()
+        self.install_dependencies()
+
+    def create_virtualenv(self):
+        """
+        Create a virtualenv for the build (if there isn't one already) and
+        upgrade pip. This doesn't depend on the deploy so it can happen while
+        the repo is being fetched. New virtualenvs are taken from the pool if
+        there is one.
+        """
         log('Creating virtualenv')
 
         # Create clean virtualenv
         if not os.path.exists(self.venv_paths.python):
-            self._cmd(['virtualenv', self.venv_paths.venv])
+            if self.venv_pool is not None:
+                taken = self.venv_pool.take(self.venv_paths.venv)
+                self.venv_pool.refill_in_background()
+                if taken:
+                    log('Took a virtualenv from the pool')
+                    return
+            virtualenv = ['virtualenv']
+            if self.python is not None:
+                virtualenv += ['-p', self.python]
+            self._cmd(virtualenv + [self.venv_paths.venv])
 
         log('Upgrading pip')
         self._cmd([self.venv_paths.pip, 'install', '--upgrade', 'pip'])
 
+    def install_dependencies(self):
+        """ Install the pip dependencies from the deploy. """
         log('Installing pip dependencies')
+        if self.cache is not None and self.deploy.pip:
+            self.install_cached_dependencies()
+            return
+
         # Install things
         for dep in self.deploy.pip:
             log('Installing %s' % (dep))
             self._cmd([self.venv_paths.pip, 'install', '--upgrade', dep])
 
+    def install_cached_dependencies(self):
+        """
+        Install the pip dependencies using the cache. The whole virtualenv is
+        restored if the same dependencies have been installed before.
+        Otherwise each dependency is installed from cached wheels, building
+        and caching them on a miss, and the resulting virtualenv is cached.
+
+        Cache keys are based on the requirement strings, so unpinned
+        requirements won't be upgraded until their cache entry is evicted.
+        """
+        python_version = self._cmd(
+            [self.venv_paths.python, '-c', 'import sys; print(sys.version)'])
+        venv_key = self.get_virtualenv_cache_key(python_version)
+        blob = self.cache.get('venvs', venv_key)
+        if blob is not None:
+            log('Restoring build virtualenv from cache')
+            rmtree_if_exists(self.venv_paths.venv)
+            unpack_dir(blob, self.venv_paths.venv)
+            return
+
+        wheel_keys = dict(
+            (dep, cache_key(python_version, dep)) for dep in self.deploy.pip
+            if not self._is_repo_dependency(dep))
+        wheel_blobs = self.cache.get_many('wheels', wheel_keys.values())
+
+        for dep in self.deploy.pip:
+            log('Installing %s' % (dep))
+            if dep not in wheel_keys:
+                self._cmd([self.venv_paths.pip, 'install', '--upgrade', dep])
+                continue
+
+            wheel_dir = tempfile.mkdtemp(dir=self.workspace.get_path())
+            try:
+                blob = wheel_blobs[wheel_keys[dep]]
+                if blob is not None:
+                    unpack_dir(blob, wheel_dir)
+                else:
+                    self._cmd([self.venv_paths.pip, 'wheel',
+                               '--wheel-dir', wheel_dir, dep])
+                    blob_path = self.cache.new_blob_path()
+                    pack_dir(wheel_dir, blob_path)
+                    self.cache.put('wheels', wheel_keys[dep], blob_path)
+
+                self._cmd([self.venv_paths.pip, 'install', '--upgrade',
+                           '--no-index', '--find-links', wheel_dir, dep])
+            finally:
+                rmtree_if_exists(wheel_dir)
+
+        blob_path = self.cache.new_blob_path()
+        pack_dir(self.venv_paths.venv, blob_path)
+        self.cache.put('venvs', venv_key, blob_path)
+
+    def get_virtualenv_cache_key(self, python_version):
+        """
+        Get the cache key for the build virtualenv. Virtualenvs aren't
+        relocatable so the key includes the virtualenv's path. If any
+        dependency comes from the repo, the repo revision is included too.
+        """
+        parts = [python_version, self.venv_paths.venv] + list(self.deploy.pip)
+        if any(self._is_repo_dependency(dep) for dep in self.deploy.pip):
+            parts.append(self.workspace.repo.revision or '')
+        return cache_key(*parts)
+
+    def _is_repo_dependency(self, dep):
+        """
+        Check whether a pip dependency refers to files (e.g. '-r
+        requirements.txt' or '-e .') rather than to a requirement.
+        """
+        return dep.startswith(('-', '.', '/', 'file:'))
+
     def put_env_variables(self):
-        """ Initialises the current working environment. """
+        """
+        Initialise the environment for the buildscript and build steps. It
+        is passed to their commands rather than set in this process, where
+        it would leak into the commands of phases running at the same time.
+        """
         env = {
             'VENV': self.venv_paths.venv,
             'PIP': self.venv_paths.pip,
             'REPO': self.workspace.repo.name,
             'BRANCH': self.workspace.repo.branch,
+            'REVISION': self.workspace.repo.revision or '',
             'WORKSPACE': self.workspace.get_path(),
             'BUILDDIR': self.workspace.get_build_path(),
             'INSTALLDIR': self.workspace.get_install_path(),
             'NAME': self.deploy.name,
             'PATH': ':'.join([self.venv_paths.bin, os.getenv('PATH')])
         }
-        for k, v in env.items():
-            os.environ[k] = v
+        if self.source_date_epoch is not None:
+            env['SOURCE_DATE_EPOCH'] = str(self.source_date_epoch)
+        self.build_env = env
+
+    def run_build_steps(self):
+        """
+        Run the build steps from the deploy in order. The outputs of a step
+        are cached by a hash of its inputs, and restored into the build
+        directory instead of running the step while the inputs don't change.
+        """
+        for step in self.deploy.build_steps:
+            self.workspace.check_staging()
+            key = step.get_cache_key(self.workspace.get_repo_path())
+            blob = (self.cache.get('steps', key)
+                    if self.cache is not None else None)
+            if blob is not None:
+                log('Inputs of build step %s unchanged, restoring its '
+                    'outputs' % step.name)
+                unpack_dir(blob, self.workspace.get_build_path())
+                continue
+
+            log('Running build step %s' % step.name)
+            self._cmd(['sh', '-c', step.run], env=self.build_env,
+                      cwd=self.workspace.get_path())
+            missing = step.find_missing_outputs(
+                self.workspace.get_build_path())
+            if missing:
+                raise ValueError('Build step %s did not create %s' % (
+                    step.name, ', '.join(missing)))
+
+            if self.cache is not None:
+                blob_path = self.cache.new_blob_path()
+                step.pack_outputs(self.workspace.get_build_path(), blob_path)
+                self.cache.put('steps', key, blob_path)
 
     def run_buildscript(self):
         """
@@ -218,30 +798,202 @@ class Build(object):
             self.deploy.buildscript)
         self._cmd(['chmod', 'a+x', buildscript_path])
 
-        # Push package directory before running build script
-        old_cwd = os.getcwd()
-        os.chdir(self.workspace.get_path())
-
-        self._cmd([buildscript_path])
-
-        # Pop directory
-        os.chdir(old_cwd)
+        # Run from the workspace directory (without changing the working
+        # directory of this process, as other phases may be running)
+        self._cmd([buildscript_path], env=self.build_env,
+                  cwd=self.workspace.get_path())
 
     def copy_files(self):
         """ Copy the build and nginx/supervisor config files. """
-        log('Preparing package')
-        self.workspace.make_package_dir()
+        self.make_package_dir()
 
         self.copy_build()
         self.copy_config_files()
 
     def copy_build(self):
-        """ Copy build contents to install location. """
+        """
+        Copy build contents to install location, recording them in the
+        manifest.
+        """
+        self.workspace.check_staging()
+        self.workspace.make_install_dir()
+
+        for name in sorted(os.listdir(self.workspace.get_build_path())):
+            build_path = self.workspace.get_build_path(name)
+            if os.path.isdir(build_path):
+                self.manifest.copytree(
+                    build_path, self.workspace.get_install_path(name))
+            else:
+                self.manifest.copy(
+                    build_path, self.workspace.get_install_path(name))
+
+    def rebuild(self, steps):
+        """
+        Bring the package tree of a finished build up to date after the
+        source has changed, rerunning only some of the build.
+
+        :param: steps:
+        The steps to rerun, from watch.plan_rebuild: 'pip' reinstalls the
+        dependencies and 'build' rebuilds the build directory and syncs the
+        install directory with it, 'postinstall' regenerates the postinstall
+        script.
+        """
+        if 'pip' in steps:
+            self.install_dependencies()
+        if 'pip' in steps or 'build' in steps:
+            old_files = set(walk_sorted(self.workspace.get_build_path()))
+            rmtree_if_exists(self.workspace.get_build_path())
+            self.make_build_dir()
+            self.run_build_steps()
+            self.run_buildscript()
+            self.sync_install_tree(old_files)
+            self.freeze_virtualenv()
+        if 'postinstall' in steps:
+            self.create_postinstall_script()
+        self.finalize_package_tree()
+
+    def sync_install_tree(self, old_files):
+        """
+        Bring the install directory (and config files) up to date with a
+        rebuilt build directory. Files whose contents differ from the
+        manifest are copied, files that are no longer built are removed and
+        everything else is left alone. Changed Python sources are compiled,
+        but shared objects aren't stripped.
+
+        :param: old_files:
+        The paths of the files in the build directory before it was rebuilt,
+        relative to it.
+
+        :returns:
+        The paths in the package tree that were copied or removed.
+        """
+        build_path = self.workspace.get_build_path()
+        patterns = self.get_exclude_patterns()
+        new_files = set(walk_sorted(build_path))
+        synced = []
+        for relpath in sorted(old_files - new_files):
+            path = self.workspace.get_install_path(relpath)
+            if os.path.isdir(path) and not os.path.islink(path):
+                for removed in walk_sorted(path):
+                    self.manifest.discard(os.path.join(path, removed))
+                rmtree_if_exists(path)
+            elif os.path.lexists(path):
+                os.remove(path)
+                self.manifest.discard(path)
+            else:
+                continue
+            synced.append(path)
+            if path.endswith('.py'):
+                for compiled in bytecode.remove_compiled(path):
+                    self.manifest.discard(compiled)
+
+        for relpath in sorted(new_files):
+            if slimming.is_excluded(relpath, patterns):
+                continue
+            src_path = os.path.join(build_path, relpath)
+            path = self.workspace.get_install_path(relpath)
+            if os.path.isdir(src_path):
+                # Symlinked directories are copied like copy_build does
+                rmtree_if_exists(path)
+                self.manifest.copytree(src_path, path)
+                synced.append(path)
+            elif self._sync_file(src_path, path):
+                synced.append(path)
+
+        for config_files in self.deploy.config_files:
+            config_dir_path = self.workspace.get_package_path(
+                config_files.config_dir_path)
+            for config_file in config_files.files:
+                path = os.path.join(config_dir_path,
+                                    os.path.basename(config_file))
+                if self._sync_file(self.workspace.get_build_path(config_file),
+                                   path):
+                    synced.append(path)
+
+        log('Synced %d changed files into the package tree' % len(synced))
+        self._compile_synced_sources(synced)
+        return synced
+
+    def _sync_file(self, src_path, path):
+        """ Copy a file into the package tree unless it is unchanged. """
+        entry = self.manifest.get(path)
+        if (entry is not None and os.path.exists(path) and
+                entry.sha256 == hash_file(src_path)):
+            return False
+
+        if os.path.lexists(path):
+            os.remove(path)
+        elif not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.manifest.copy(src_path, path)
+        return True
+
+    def _compile_synced_sources(self, paths):
+        """ Byte-compile the synced Python sources that still exist. """
+        package_path = self.workspace.get_package_path()
+        sources = [
+            [path, os.path.join('/', os.path.relpath(path, package_path))]
+            for path in paths if path.endswith('.py') and os.path.isfile(path)]
+        if not sources:
+            return
+
+        self.normalize_files()
+        bytecode.compile_sources(sources, self.venv_paths.python, self._cmd,
+                                 self.bytecode_workers)
+        for source, _ in sources:
+            dir_path, name = os.path.split(source)
+            candidates = [source + 'c']
+            pycache = os.path.join(dir_path, '__pycache__')
+            if os.path.isdir(pycache):
+                candidates += [os.path.join(pycache, cached)
+                               for cached in os.listdir(pycache)
+                               if cached.split('.')[0] == name[:-3]]
+            for compiled in candidates:
+                if os.path.isfile(compiled):
+                    self.manifest.add(compiled)
+
+    def install_wheel(self):
+        """
+        Build a wheel of the repo with its PEP 517 build backend and install
+        it into the package tree, recording the files in the manifest. Wheels
+        are cached by a hash of the repo contents so that unchanged projects
+        aren't rebuilt.
+        """
+        self.workspace.check_staging()
         self.workspace.make_install_dir()
 
-        for directory in os.listdir(self.workspace.get_build_path()):
-            shutil.copytree(self.workspace.get_build_path(directory),
-                            self.workspace.get_install_path(directory))
+        python_version = self._cmd([
+            self.venv_paths.python, '-c',
+            'import sys; print("%d.%d" % sys.version_info[:2])']).strip()
+        repo_path = self.workspace.get_repo_path()
+        key = cache_key('pep517', python_version, hash_tree(repo_path))
+        blob = self.cache.get('wheels', key) if self.cache else None
+
+        wheel_dir = tempfile.mkdtemp(dir=self.workspace.get_path())
+        try:
+            if blob is not None:
+                log('Using cached wheel')
+                unpack_dir(blob, wheel_dir)
+            else:
+                log('Building wheel')
+                wheels.build_wheel(repo_path, wheel_dir,
+                                   self.workspace.get_path('wheel-env'),
+                                   self._cmd)
+                if self.cache is not None:
+                    blob_path = self.cache.new_blob_path()
+                    pack_dir(wheel_dir, blob_path)
+                    self.cache.put('wheels', key, blob_path)
+
+            wheel_path = wheels.find_wheel(wheel_dir)
+            log('Installing %s' % os.path.basename(wheel_path))
+            installed = wheels.install_wheel(
+                wheel_path, self.workspace.get_package_path(),
+                self.deploy_type.get_install_lib(python_version),
+                self.deploy_type.get_python(python_version))
+            for path in installed:
+                self.manifest.add(path)
+        finally:
+            rmtree_if_exists(wheel_dir)
 
     def copy_config_files(self):
         """
@@ -251,20 +1003,110 @@ class Build(object):
         for config_files in self.deploy.config_files:
             config_dir_path = self.workspace.get_package_path(
                 config_files.config_dir_path)
-            os.makedirs(config_dir_path)
+            if not os.path.isdir(config_dir_path):
+                os.makedirs(config_dir_path)
 
             for config_file in config_files.files:
-                shutil.copy(self.workspace.get_build_path(config_file),
-                            config_dir_path)
+                self.manifest.copy(self.workspace.get_build_path(config_file),
+                                   config_dir_path)
+
+    def slim_install_tree(self):
+        """
+        Remove the files excluded by the deploy from the install directory
+        and, if the deploy asks for a slim package, the usual files that
+        aren't needed at runtime too, and strip the debug symbols from shared
+        objects. Then report what takes up the space.
+        """
+        install_path = self.workspace.get_install_path()
+        patterns = self.get_exclude_patterns()
+        if patterns:
+            removed = slimming.remove_excluded(install_path, patterns)
+            for path in removed:
+                self.manifest.discard(path)
+            log('Excluded %d files from the package' % len(removed))
+
+        if self.deploy.slim:
+            stripped = slimming.strip_shared_objects(install_path, self._cmd)
+            for path, _ in stripped:
+                self.manifest.add(path)
+            log('Stripped %d shared objects, saving %s' % (
+                len(stripped), slimming.format_size(
+                    sum(saved for _, saved in stripped))))
+
+        slimming.log_size_report(install_path)
+
+    def get_exclude_patterns(self):
+        """ Get the patterns of files to leave out of the package. """
+        patterns = list(self.deploy.exclude)
+        if self.deploy.slim:
+            patterns += slimming.DEFAULT_EXCLUDES
+        return patterns
+
+    def compile_bytecode(self):
+        """
+        Byte-compile the Python sources in the package tree with the build
+        virtualenv's interpreter, so that targets don't compile them on first
+        import. The pycs are added to the manifest.
+        """
+        log('Compiling Python bytecode')
+        # Python 2 pycs record the modification times of their sources, so
+        # those are normalised first
+        self.normalize_files()
+
+        package_path = self.workspace.get_package_path()
+        bytecode.compile_tree(package_path, '/', self.venv_paths.python,
+                              self._cmd, self.bytecode_workers)
+        for dir_path, _, files in os.walk(package_path):
+            for name in files:
+                if name.endswith('.pyc'):
+                    self.manifest.add(os.path.join(dir_path, name))
 
     def freeze_virtualenv(self):
         """ Freeze post build requirements. """
         freeze_output = self._cmd([self.venv_paths.pip, 'freeze'])
+        if self.source_date_epoch is not None:
+            freeze_output = self.normalize_freeze_output(freeze_output)
 
         requirements_path = self.workspace.get_install_path(
             '%s-requirements.pip' % self.deploy.name)
         with open(requirements_path, 'w') as requirements_file:
             requirements_file.write(freeze_output)
+        self.manifest.add(requirements_path)
+
+    def normalize_freeze_output(self, freeze_output):
+        """
+        Remove build-time paths from the frozen requirements. Paths in the
+        install directory are mapped to the install location and any other
+        workspace paths are replaced with a placeholder.
+        """
+        freeze_output = freeze_output.replace(
+            self.workspace.get_install_path(),
+            self.workspace.install_location)
+        freeze_output = freeze_output.replace(
+            self.workspace.get_path(), '@WORKSPACE@')
+        lines = [line for line in freeze_output.splitlines() if line.strip()]
+        return '\n'.join(sorted(lines)) + '\n'
+
+    def normalize_files(self):
+        """
+        In reproducible builds, normalise the timestamps and permissions of
+        everything that goes into the package.
+        """
+        if self.source_date_epoch is None:
+            return
+
+        log('Normalising file metadata for a reproducible build')
+        normalize_tree(self.workspace.get_package_path(),
+                       self.source_date_epoch)
+
+    def write_manifest(self):
+        """
+        Write the manifest of the package tree into the install directory so
+        that it ships with the package.
+        """
+        log('Writing manifest of %d files' % len(self.manifest))
+        self.manifest.write(self.workspace.get_install_path(
+            get_manifest_name(self.deploy.name)))
 
     def create_postinstall_script(self):
         """ Generate the postinstall script and write it to disk. """
@@ -329,6 +1171,12 @@ class Package(object):
 
     debug = False
     sign = True
+    # Set to a timestamp to make the package reproducible
+    source_date_epoch = None
+    # Ship the virtualenv in a separate '<name>-deps' package
+    split_deps = False
+    # A BuildCache for dependencies packages (required to split them out)
+    cache = None
     _cmd = lambda self, *args, **kwargs: cmd(*args, debug=self.debug, **kwargs)
 
     def __init__(self, workspace, deploy, deploy_type, target='deb',
@@ -338,10 +1186,90 @@ class Package(object):
         self.deploy_type = deploy_type
         self.target = target
         self.gpg_key = gpg_key
+        # The path and version of the dependencies package, once built
+        self.deps_package_path = None
+        self.deps_version = None
+        # The paths to the packages (or image) built by this run
+        self.package_paths = None
 
     def package(self):
-        self.run_fpm()
+        if self.target == 'oci':
+            self.build_image()
+        else:
+            if self.split_deps:
+                self.build_deps_package()
+            self.run_fpm()
+        self.publish_manifest()
         self.sign_debs()
+        self.workspace.persist_staging()
+
+    def phases(self):
+        """
+        Get the phases of packaging. They depend on the 'package_tree'
+        resource produced by the build.
+        """
+        if self.target == 'oci':
+            package_phase = Phase(
+                'image', self.build_image_and_publish_manifest,
+                inputs=['package_tree'], outputs=['package'])
+        elif self.split_deps:
+            package_phase = Phase('fpm', self.run_fpm_and_publish_manifest,
+                                  inputs=['package_tree', 'deps_package'],
+                                  outputs=['package'])
+        else:
+            package_phase = Phase('fpm', self.run_fpm_and_publish_manifest,
+                                  inputs=['package_tree'], outputs=['package'])
+
+        phases = [
+            package_phase,
+            Phase('sign', self.sign_debs,
+                  inputs=['package'], outputs=['signed_package']),
+            Phase('persist', self.workspace.persist_staging,
+                  inputs=['signed_package'], outputs=['artifacts']),
+        ]
+        if self.split_deps and self.target != 'oci':
+            phases.append(Phase('deps_package', self.build_deps_package,
+                                inputs=['package_tree'],
+                                outputs=['deps_package'],
+                                restore=self.set_deps_version))
+        return phases
+
+    def plan_phases(self):
+        """
+        Work out which packaging phases would be skipped or reuse earlier
+        work.
+
+        :returns:
+        A dict mapping phase names to (action, reason) tuples for the phases
+        that wouldn't simply run.
+        """
+        actions = {}
+        if self.gpg_key is None:
+            actions['sign'] = ('skip', 'no GPG key configured')
+        elif self.target != 'deb':
+            actions['sign'] = ('skip', 'only debs are signed')
+        if self.split_deps and self.target != 'oci':
+            actions['deps_package'] = (
+                'maybe', 'reused if the frozen requirements are unchanged')
+        return actions
+
+    def repackage(self):
+        """
+        Package the package tree again after it has been rebuilt. The
+        artifacts and manifest of the previous run are removed first so that
+        they don't end up in the package. The dependencies package comes from
+        the cache while the requirements don't change.
+        """
+        published = [self.workspace.get_package_path(
+            get_manifest_name(self.deploy.name))]
+        for path in self.list_artifacts() + published:
+            if os.path.exists(path):
+                os.remove(path)
+        self.package()
+
+    def run_fpm_and_publish_manifest(self):
+        self.run_fpm()
+        self.publish_manifest()
 
     def run_fpm(self):
         """ Run the fpm command that builds the package. """
@@ -361,20 +1289,215 @@ class Package(object):
         if not self.deploy_type.provides_version:
             fpm += ['-v', self.deploy.version]
 
-        fpm += sum([['-d', dep] for dep in self.list_all_dependencies()], [])
+        deps = self.list_all_dependencies()
+        if self.deps_version is not None:
+            deps.append('%s (= %s)' % (self.get_deps_package_name(),
+                                       self.deps_version))
+        fpm += sum([['-d', dep] for dep in deps], [])
 
-        if self.deploy.user:
-            fpm += ['--%s-user' % self.target, self.deploy.user]
+        fpm += self._get_ownership_args()
 
         if self.debug:
             fpm.append('--debug')
 
         fpm += self.deploy_type.get_fpm_args(self.workspace._dirs)
 
-        self._cmd(fpm)
+        # fpm names the package itself (python deploys take the version from
+        # setup.py), so the package is whatever new file it leaves behind
+        existing = set(os.listdir(self.workspace.get_package_path()))
+        self._cmd(fpm, env=self._get_fpm_env())
+        self.package_paths = [
+            self.workspace.get_package_path(name)
+            for name in sorted(os.listdir(self.workspace.get_package_path()))
+            if name not in existing and
+            name.endswith(self.get_artifact_suffix())]
 
         log('Build completed successfully')
 
+    def _get_ownership_args(self):
+        """ Get the fpm options for file ownership and timestamps. """
+        args = []
+        if self.deploy.user:
+            args += ['--%s-user' % self.target, self.deploy.user]
+
+        if self.source_date_epoch is not None:
+            if not self.deploy.user:
+                args += ['--%s-user' % self.target, 'root']
+            args += ['--%s-group' % self.target, 'root',
+                     '--source-date-epoch-default',
+                     str(self.source_date_epoch)]
+        return args
+
+    def _get_fpm_env(self):
+        if self.source_date_epoch is None:
+            return None
+        return {'SOURCE_DATE_EPOCH': str(self.source_date_epoch)}
+
+    def build_deps_package(self):
+        """
+        Build the '<name>-deps' package containing the build virtualenv. It
+        is versioned by a digest of the frozen requirements and is reused
+        from the cache while the requirements don't change, so that it is
+        only rebuilt (and redistributed) when they do.
+        """
+        venv_path = self.deploy_type.get_venv_install_path(self.workspace,
+                                                           self.deploy)
+        if venv_path is None:
+            raise ValueError(
+                'Only virtualenv deploys have a dependencies package')
+
+        self.set_deps_version()
+        # Only this run's dependencies package is kept
+        rmtree_if_exists(self.workspace.get_artifact_path())
+        os.mkdir(self.workspace.get_artifact_path())
+        name = self.get_deps_package_name()
+        key = cache_key(self.target, name, self.deps_version, venv_path,
+                        self.gpg_key or '', str(self.deploy.slim))
+        blob = self.cache.get('packages', key) if self.cache else None
+        if blob is not None:
+            log('Requirements unchanged, reusing %s %s' % (
+                name, self.deps_version))
+            shutil.copy(blob, self.deps_package_path)
+            return
+
+        log('Building .%s package %s %s' % (
+            self.target, name, self.deps_version))
+        deps_dir = self.workspace.get_path('deps-package')
+        rmtree_if_exists(deps_dir)
+        self.stage_virtualenv(
+            os.path.join(deps_dir, venv_path.lstrip('/')), venv_path)
+        if self.source_date_epoch is not None:
+            normalize_tree(deps_dir, self.source_date_epoch)
+
+        fpm = [
+            'fpm',
+            '-C', deps_dir,
+            '-p', self.deps_package_path,
+            '-s', 'dir',
+            '-t', self.target,
+            '-a', 'amd64',
+            '-n', name,
+            '-v', self.deps_version,
+        ]
+        fpm += self._get_ownership_args()
+        fpm += sorted(os.listdir(deps_dir))
+        self._cmd(fpm, env=self._get_fpm_env())
+        rmtree_if_exists(deps_dir)
+
+        if self.target == 'deb':
+            self.sign_deb(self.deps_package_path)
+        if self.cache is not None:
+            blob_path = self.cache.new_blob_path()
+            shutil.copy(self.deps_package_path, blob_path)
+            self.cache.put('packages', key, blob_path)
+
+    def set_deps_version(self):
+        """
+        Version the dependencies package by a digest of the frozen
+        requirements.
+        """
+        requirements_path = self.workspace.get_install_path(
+            '%s-requirements.pip' % self.deploy.name)
+        digest = hash_file(requirements_path)
+        self.deps_version = '0.%s' % digest[:16]
+        self.deps_package_path = self.workspace.get_artifact_path(
+            '%s_%s_amd64.%s' % (self.get_deps_package_name(),
+                                self.deps_version, self.target))
+
+    def get_deps_package_name(self):
+        return '%s-deps' % self.deploy.name
+
+    def build_image_and_publish_manifest(self):
+        self.build_image()
+        self.publish_manifest()
+
+    def build_image(self):
+        """
+        Build an OCI image tarball from the package tree without a container
+        daemon. The build virtualenv (relocated to where the deploy type
+        installs it) goes in a dependency layer below an application layer
+        with the package tree, so when only the code changes hosts that have
+        the dependency layer only pull the application layer.
+        """
+        log('Building OCI image')
+        image_dir = self.workspace.get_path('image')
+        rmtree_if_exists(image_dir)
+        os.mkdir(image_dir)
+        mtime = self.source_date_epoch or 0
+
+        layers = []
+        env = ['PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:'
+               '/sbin:/bin']
+        venv_path = self.deploy_type.get_venv_install_path(self.workspace,
+                                                           self.deploy)
+        if venv_path is not None:
+            deps_dir = os.path.join(image_dir, 'deps')
+            self.stage_virtualenv(deps_dir, venv_path)
+            layers.append(oci.write_layer([(deps_dir, venv_path)], image_dir,
+                                          mtime))
+            env = ['VIRTUAL_ENV=%s' % venv_path,
+                   'PATH=%s:%s' % (os.path.join(venv_path, 'bin'),
+                                   env[0][len('PATH='):])]
+
+        # Top-level files are artifacts of previous runs, not package content
+        package_path = self.workspace.get_package_path()
+        app_trees = [(os.path.join(package_path, name), name)
+                     for name in sorted(os.listdir(package_path))
+                     if os.path.isdir(os.path.join(package_path, name))]
+        layers.append(oci.write_layer(app_trees, image_dir, mtime))
+
+        install_dir = os.path.relpath(self.workspace.get_install_path(),
+                                      package_path)
+        labels = {'org.opencontainers.image.version': self.deploy.version}
+        if self.workspace.repo.revision:
+            labels['org.opencontainers.image.revision'] = (
+                self.workspace.repo.revision)
+        image_path = self.workspace.get_package_path(self.get_image_name())
+        digest = oci.write_image(
+            image_path, layers,
+            '%s:%s' % (self.deploy.name, self.deploy.version), env=env,
+            working_dir='/' + install_dir, labels=labels, created=mtime)
+        rmtree_if_exists(image_dir)
+        self.package_paths = [image_path]
+
+        log('Built image %s' % digest)
+
+    def stage_virtualenv(self, dst_dir, venv_path):
+        """
+        Copy the build virtualenv to dst_dir, relocated so that it works
+        from venv_path, slimmed if the deploy asks for a slim package and
+        byte-compiled for venv_path.
+        """
+        build_venv = create_venv_paths(self.workspace.get_path())
+        link_tree(build_venv.venv, dst_dir)
+        relocate_venv(dst_dir, build_venv.venv, venv_path)
+        if self.deploy.slim:
+            slimming.remove_excluded(dst_dir, slimming.DEFAULT_EXCLUDES)
+            slimming.strip_shared_objects(dst_dir, self._cmd)
+        bytecode.compile_tree(dst_dir, venv_path, build_venv.python,
+                              self._cmd)
+
+    def get_image_name(self):
+        """ Get the file name of the OCI image tarball. """
+        return '%s_%s.oci.tar' % (self.deploy.name, self.deploy.version)
+
+    def get_artifact_suffix(self):
+        """ Get the file name suffix of the artifacts for the target. """
+        if self.target == 'oci':
+            return '.oci.tar'
+        return '.%s' % self.target
+
+    def publish_manifest(self):
+        """
+        Copy the manifest shipped in the package to sit next to the package
+        file, so it can be used without unpacking the package.
+        """
+        manifest_name = get_manifest_name(self.deploy.name)
+        manifest_path = self.workspace.get_install_path(manifest_name)
+        if os.path.exists(manifest_path):
+            shutil.copy(manifest_path,
+                        self.workspace.get_package_path(manifest_name))
+
     def list_all_dependencies(self):
         """ Get a list of all the package dependencies. """
         deps = []
@@ -390,20 +1513,57 @@ class Package(object):
 
         return deps
 
+    def list_artifacts(self):
+        """ List the package files built in the package directory. """
+        return [path for path in listdir_abs(self.workspace.get_package_path())
+                if path.endswith(self.get_artifact_suffix())]
+
+    def get_package_paths(self):
+        """
+        Get the paths to the packages (or image) built by this run, not
+        including the dependencies package. If nothing has been built, the
+        packages in the package directory are assumed to be this run's.
+        """
+        if self.package_paths is not None:
+            return self.package_paths
+        return sorted(self.list_artifacts())
+
+    def get_build_artifacts(self):
+        """
+        Describe the artifacts of this run: the packages, the dependencies
+        package and the published manifest.
+
+        :returns:
+        A list of Artifacts.
+        """
+        artifacts = [Artifact.from_path(path)
+                     for path in self.get_package_paths()]
+        if self.deps_package_path is not None:
+            artifacts.append(
+                Artifact.from_path(self.deps_package_path, 'deps_package'))
+        manifest_path = self.workspace.get_package_path(
+            get_manifest_name(self.deploy.name))
+        if os.path.exists(manifest_path):
+            artifacts.append(Artifact.from_path(manifest_path, 'manifest'))
+        return artifacts
+
     def sign_debs(self):
-        """ Sign the .deb file with the configured gpg key. """
+        """ Sign the .deb files built by fpm with the configured gpg key. """
         if self.gpg_key is None:
             log('No GPG key configured, skipping signing')
             return
         log('Signing package')
-        # Find all the .debs in the directory and indiscriminately sign them
-        # (there should only be 1)
-        # TODO: Get the actual package name from fpm
-        debs = [path for path in listdir_abs(self.workspace.get_package_path())
-                if os.path.splitext(path)[1] == '.deb']
-        for deb in debs:
-            self._cmd(
-                ['dpkg-sig', '-k', self.gpg_key, '--sign', 'builder', deb])
+        # The dependencies package is signed when it is built so that cached
+        # copies stay identical
+        for path in self.get_package_paths():
+            if os.path.splitext(path)[1] == '.deb':
+                self.sign_deb(path)
+
+    def sign_deb(self, deb):
+        """ Sign a .deb file with the configured gpg key, if any. """
+        if self.gpg_key is None:
+            return
+        self._cmd(['dpkg-sig', '-k', self.gpg_key, '--sign', 'builder', deb])
 
 
 class Sideloader(object):
@@ -411,35 +1571,468 @@ class Sideloader(object):
     def __init__(self, config_path, github_url, branch=None, workspace_id=None,
                  debug=False):
         self.config = Config.from_config_file(config_path)
-        self.repo = self._create_git_repo(github_url, branch)
+        self.repo = self._create_source(github_url, branch)
         self.workspace_id = (workspace_id if workspace_id is not None
                              else self.repo.name)
         self.debug = debug
-
-    def _create_git_repo(self, github_url, branch):
+        self.cache = self._create_cache()
+        # Additional PhaseListeners for each run, e.g. a profiler
+        self.listeners = []
+        # The CancelToken of the current run
+        self.cancel_token = None
+
+    def _create_cache(self):
+        if not self.config.build_cache and self.config.remote_cache is None:
+            return None
+        return BuildCache(LocalCache(self.config.workspace_base),
+                          create_remote_cache(self.config.remote_cache))
+
+    def _create_source(self, source, branch):
         branch = branch if branch is not None else self.config.default_branch
-        return GitRepo.from_github_url(github_url, branch)
+        if LocalSource.is_local(source):
+            return LocalSource.from_path(source, branch)
+        return GitRepo.from_github_url(source, branch)
 
     def run(self, deploy_file='.deploy.yaml', dtype='virtualenv', target='deb',
-            build_num=None, sign=True, **deploy_overrides):
+            build_num=None, sign=True, reproducible=False, split_deps=False,
+            resume=False, **deploy_overrides):
+        """
+        Build and package the repo.
+
+        :param: resume:
+        Skip the phases that the last build in the workspace completed, if
+        it was an identical build of the same revision, and continue from
+        the first phase that didn't complete.
+
+        :returns:
+        A BuildResult.
+        """
+        # Created before the lease is taken so that waiting for it can be
+        # cancelled too
+        self.cancel_token = cancellation.CancelToken()
+        return self._lease_and_run(deploy_file, dtype, target, build_num,
+                                   sign, reproducible, split_deps, resume,
+                                   deploy_overrides)
+
+    def _lease_and_run(self, *args):
+        """
+        Take the lease on the workspace and run the build in it, with the
+        arguments of _run that follow the workspace.
+        """
+        lease = lease_workspace(self.config.workspace_base, self.workspace_id,
+                                self.config.workspace_conflict,
+                                self.cancel_token)
+        try:
+            workspace = self._create_workspace(lease.workspace_id)
+            return self._run(workspace, *args)
+        finally:
+            lease.release()
+
+    def _run(self, workspace, deploy_file, dtype, target, build_num, sign,
+             reproducible, split_deps, resume, deploy_overrides):
+        build, package, phases = self._create_phases(
+            workspace, deploy_file, dtype, target, build_num, sign,
+            reproducible, split_deps, deploy_overrides)
+        checkpoints = Checkpoints(
+            workspace.get_path(CHECKPOINT_FILE), phases,
+            get_run_key(self.repo.url, self.repo.branch, deploy_file, dtype,
+                        target, build_num, sign, reproducible, split_deps,
+                        deploy_overrides, vars(self.config)),
+            self.repo)
+
+        build_log = self._create_build_log()
+        labels = {'repo': self.repo.name, 'deploy_type': dtype}
+        metrics.BUILDS.inc(**labels)
+        cancellation_listener = cancellation.CancellationListener(
+            self.cancel_token, self.config.phase_timeouts,
+            self.config.default_phase_timeout)
+        listeners = [
+            buildlog.BuildLogListener(build_log),
+            cancellation_listener,
+            metrics.MetricsListener(self.repo.name, dtype),
+        ]
+        history_listener = history.HistoryListener()
+        listeners.append(history_listener)
+        listeners += self.listeners
+        listeners.append(checkpoints)
+        cache_outcomes = len(self.cache.outcomes) if self.cache else 0
+
+        with build_log:
+            started = time.time()
+            artifacts = []
+            status, error = 'succeeded', None
+            workspace.acquire()
+            try:
+                resumed = self._restore_checkpoints(
+                    workspace, build, checkpoints, resume,
+                    cancellation_listener)
+                graph = PhaseGraph(
+                    [phase for phase in phases if phase not in resumed],
+                    available=[resource for phase in resumed
+                               for resource in phase.outputs])
+                graph.run(self.config.phase_workers, listeners)
+                if self.cache is not None:
+                    self.cache.wait()
+
+                artifacts = package.get_build_artifacts()
+                for artifact in artifacts:
+                    if artifact.kind != 'manifest':
+                        metrics.ARTIFACT_SIZE.set(
+                            artifact.size, artifact_type=target,
+                            kind=artifact.kind, **labels)
+            except BaseException as e:
+                status, error = 'failed', str(e) or repr(e)
+                if isinstance(e, Exception):
+                    metrics.BUILD_FAILURES.inc(**labels)
+                if isinstance(e, cancellation.BuildCancelled):
+                    status = 'cancelled'
+                    log('%s, cleaning up the workspace' % (e,))
+                    workspace.clean_workspace()
+                else:
+                    self._unstage_failed(workspace)
+                raise
+            finally:
+                workspace.release()
+                outcomes = []
+                if self.cache is not None:
+                    outcomes = self.cache.outcomes[cache_outcomes:]
+                    for cache, outcome in outcomes:
+                        metrics.CACHE_LOOKUPS.inc(
+                            cache=cache, outcome=outcome, **labels)
+                self.write_metrics()
+                self._record_history(
+                    build_log.build_id, dtype, target, started, status, error,
+                    artifacts, history_listener.phases, outcomes)
+
+            self.collect_garbage()
+
+        version = (None if package.deploy_type.provides_version
+                   else package.deploy.version)
+        return BuildResult(
+            build_log.build_id, self.repo.name, self.repo.branch,
+            self.repo.revision, version, dtype, target, started,
+            time.time() - started, artifacts,
+            [PhaseTiming(*phase) for phase in history_listener.phases],
+            outcomes)
+
+    def _unstage_failed(self, workspace):
+        """
+        Free the staging area of a failed build, keeping what it staged on
+        disk so that it can be resumed. A failure to do so is only logged, so
+        that it doesn't hide why the build failed.
+        """
+        try:
+            workspace.unstage()
+        except EnvironmentError as e:
+            log('WARNING: Failed to move the staged build to disk: %s' % e)
+
+    def _restore_checkpoints(self, workspace, build, checkpoints, resume,
+                             cancellation_listener):
+        """
+        Restore the phases that a resumed build can skip, or forget the
+        checkpoints of the last build if the build isn't resuming. The source
+        is looked up with the clone's deadline and can be cancelled like it.
+
+        :returns:
+        The phases to skip.
+        """
+        if not resume:
+            checkpoints.reset()
+            return []
+        if workspace.has_lost_staging():
+            log('The staged build directories were lost, building from '
+                'scratch')
+            checkpoints.reset()
+            return []
+
+        cancellation_listener.bind_phase('clone')
+        try:
+            resumed = checkpoints.resume(build.check_resumable)
+        finally:
+            cancellation.unbind()
+        if resumed:
+            log('Resuming after %d completed phases' % len(resumed),
+                output=[phase.name for phase in resumed])
+        for phase in resumed:
+            if phase.restore is not None:
+                phase.restore()
+        return resumed
+
+    def plan(self, deploy_file='.deploy.yaml', dtype='virtualenv',
+             target='deb', build_num=None, sign=True, reproducible=False,
+             split_deps=False, **deploy_overrides):
+        """
+        Work out what run() would do with the same arguments without building
+        anything. The repo is fetched into a temporary workspace to resolve
+        the commit and load the deploy file, the caches are probed without
+        being updated and durations are estimated from the build history.
+
+        :returns:
+        A BuildPlan.
+        """
         workspace = self._create_workspace()
-        workspace.set_up()
+        build, package, phases = self._create_phases(
+            workspace, deploy_file, dtype, target, build_num, sign,
+            reproducible, split_deps, deploy_overrides)
+
+        if not os.path.exists(self.config.workspace_base):
+            os.makedirs(self.config.workspace_base)
+        # Hidden so that the garbage collector leaves it alone
+        plan_base = tempfile.mkdtemp(prefix='.plan-',
+                                     dir=self.config.workspace_base)
+        try:
+            checkout = Workspace(self.workspace_id, plan_base,
+                                 self.config.install_location, self.repo)
+            checkout.debug = self.debug
+            checkout.set_up()
+            deploy = self._load_deploy(checkout, deploy_file, build_num,
+                                       **deploy_overrides)
+            build.deploy = package.deploy = deploy
+            actions = build.plan_phases(checkout.get_repo_path())
+            actions.update(package.plan_phases())
+        finally:
+            rmtree_if_exists(plan_base)
+
+        durations = {}
+        if (self.config.history_db is not None and
+                os.path.exists(self.config.history_db)):
+            try:
+                durations = plan.estimate_durations(
+                    history.BuildHistory(self.config.history_db),
+                    self.repo.name)
+            except sqlite3.Error as e:
+                log('WARNING: Reading the build history failed: %s' % e)
+
+        return plan.BuildPlan(self.repo.name, self.repo.branch,
+                              self.repo.revision, PhaseGraph(phases).ordered(),
+                              actions, durations)
+
+    def watch(self, deploy_file='.deploy.yaml', dtype='virtualenv',
+              target='deb', build_num=None, sign=True, reproducible=False,
+              split_deps=False, **deploy_overrides):
+        """
+        Build a local source directory, then watch it for changes and
+        rebuild after each one, rerunning only the steps of the build that
+        the change affects and repackaging. Runs until interrupted. Failed
+        builds are logged and followed by a full build on the next change.
+        If a metrics port is configured, the metrics are served on it while
+        watching.
+        """
+        if not (isinstance(self.repo, LocalSource) and
+                os.path.isdir(self.repo.path)):
+            raise ValueError('Only local source directories can be watched')
+
+        watcher = watch.create_watcher(self.repo.path)
+        lease = lease_workspace(self.config.workspace_base, self.workspace_id,
+                                self.config.workspace_conflict)
+        workspace = self._create_workspace(lease.workspace_id)
+        # The package tree is kept between builds and persisting the staging
+        # area would throw it away
+        workspace.staging_dir = None
+        workspace.acquire()
+        # Watching runs for as long as the user likes, so the workspace base
+        # is kept within its budget as it goes
+        gc_stop = None
+        if self.config.gc_budget is not None:
+            gc_stop = WorkspaceGC(self.config.workspace_base,
+                                  self.config.gc_budget,
+                                  self.config.staging_dir).start_background()
+        metrics_server = None
+        if self.config.metrics_port is not None:
+            metrics_server = metrics.REGISTRY.start_http_server(
+                self.config.metrics_port)
+        labels = {'repo': self.repo.name, 'deploy_type': dtype}
+        listeners = ([metrics.MetricsListener(self.repo.name, dtype)] +
+                     self.listeners)
+        try:
+            build = package = changed = None
+            while True:
+                steps = set(['full'])
+                if build is not None:
+                    steps = watch.plan_rebuild(
+                        changed, build.deploy, deploy_file,
+                        build.deploy_type.builds_wheel)
+
+                started = time.time()
+                metrics.BUILDS.inc(**labels)
+                try:
+                    if 'full' in steps:
+                        build, package, phases = self._create_phases(
+                            workspace, deploy_file, dtype, target, build_num,
+                            sign, reproducible, split_deps, deploy_overrides)
+                        PhaseGraph(phases).run(self.config.phase_workers,
+                                               listeners)
+                    else:
+                        log('Rebuilding: %s' % ', '.join(sorted(steps)))
+                        workspace.restage_source(changed)
+                        build.rebuild(steps)
+                        package.repackage()
+                except Exception as e:
+                    build = package = None
+                    metrics.BUILD_FAILURES.inc(**labels)
+                    log('Build failed: %s' % (str(e) or repr(e)))
+                else:
+                    log('Package ready in %.1fs' % (time.time() - started),
+                        output=package.get_package_paths())
+
+                log('Watching %s for changes' % self.repo.path)
+                changed = watcher.wait()
+                log('%d paths changed' % len(changed), output=changed)
+        finally:
+            if gc_stop is not None:
+                gc_stop.set()
+            if metrics_server is not None:
+                metrics_server.shutdown()
+            watcher.close()
+            workspace.release()
+            lease.release()
+
+    def _create_phases(self, workspace, deploy_file, dtype, target,
+                       build_num, sign, reproducible, split_deps,
+                       deploy_overrides):
+        """
+        Create the build and package for a run and the phases that make them.
 
-        deploy = self._load_deploy(workspace, deploy_file, build_num,
-                                   **deploy_overrides)
+        :returns:
+        A tuple of (build, package, phases).
+        """
         deploy_type = self._get_deploy_type(dtype)
+        if split_deps:
+            if dtype != 'virtualenv':
+                raise ValueError(
+                    'Only virtualenv deploys can have a dependencies package')
+            if self.cache is None:
+                # Rebuilding it would give different bytes under the same
+                # name and version, which package repos reject
+                raise ValueError(
+                    'A dependencies package is versioned by its requirements '
+                    'and needs build_cache or remote_cache to be reused')
+            deploy_type.prebuilt_venv = True
+
+        # The deploy is filled in once the repo has been fetched
+        build = self._create_build(workspace, None, deploy_type)
+        package = self._create_package(workspace, None, deploy_type, target,
+                                       sign)
+        package.split_deps = split_deps
+
+        def load_deploy():
+            deploy = self._load_deploy(workspace, deploy_file, build_num,
+                                       **deploy_overrides)
+            build.deploy = package.deploy = deploy
+            if reproducible:
+                build.source_date_epoch = package.source_date_epoch = (
+                    workspace.get_source_date_epoch())
+
+        phases = workspace.phases()
+        phases.append(Phase('deploy', load_deploy,
+                            inputs=['repo'], outputs=['deploy'],
+                            restore=load_deploy))
+        phases += build.phases()
+        phases += package.phases()
+        return build, package, phases
+
+    def run_coalesced(self, *args, **kwargs):
+        """
+        Run a build with the same arguments as run(), unless an identical
+        build is already running on this host, in which case wait for it and
+        share its artifacts. Builds are identical if they are of the same
+        commit with the same arguments (other than the build number).
 
-        build = self._create_build(workspace, deploy, deploy_type)
-        build.build()
+        :param: cancel_superseded:
+        Cancel a running build of another commit of the same branch.
 
-        package = self._create_package(workspace, deploy, deploy_type, target,
-                                       sign)
-        package.package()
+        :returns:
+        A BuildResult with the artifacts in the shared results directory.
+        """
+        cancel_superseded = kwargs.pop('cancel_superseded', False)
+        callargs = inspect.getcallargs(self.run, *args, **kwargs)
+        run_args = [callargs[name]
+                    for name in inspect.getargspec(self.run).args[1:]]
+        run_args.append(callargs['deploy_overrides'])
+        request = dict(callargs)
+        request.pop('self')
+        request.pop('build_num')
+        request.pop('resume')
+
+        revision = self.repo.lookup_revision(cmd)
+        if isinstance(self.repo, GitRepo):
+            # Build the commit the key is for even if the branch moves on
+            self.repo.pinned_revision = revision
+        key = cache_key(self.repo.url, revision,
+                        json.dumps(request, sort_keys=True))
+        branch_key = cache_key(self.repo.url, self.repo.branch,
+                               json.dumps(request, sort_keys=True))
+
+        # Shared by waiting for an identical build and running this one, so
+        # that either can be cancelled
+        self.cancel_token = cancellation.CancelToken()
+        coalescer = BuildCoalescer(self.config.workspace_base)
+        return coalescer.run(key, lambda: self._lease_and_run(*run_args),
+                             branch_key, revision, cancel_superseded,
+                             self.cancel_token)
+
+    def cancel(self, reason='Build cancelled'):
+        """
+        Cancel the running build from another thread (or a signal handler).
+        Running commands are killed and the build's workspace is cleaned up.
+        """
+        if self.cancel_token is not None:
+            self.cancel_token.cancel(reason)
 
-    def _create_workspace(self):
-        workspace = Workspace(self.workspace_id, self.config.workspace_base,
+    def _create_build_log(self):
+        """
+        Create the log for a build, writing to the console and, if a log
+        directory is configured, to '<log_dir>/<workspace id>/<build id>.log'.
+        """
+        build_id = '%s-%s' % (time.strftime('%Y%m%dT%H%M%S'),
+                              uuid.uuid4().hex[:8])
+        outputs = [buildlog.ConsoleRenderer()]
+        if self.config.log_dir is not None:
+            outputs.append(buildlog.JSONLinesFile(
+                os.path.join(self.config.log_dir, self.workspace_id,
+                             '%s.log' % build_id),
+                self.config.log_max_bytes, self.config.log_backups))
+        return buildlog.BuildLog(build_id, outputs)
+
+    def _record_history(self, build_id, dtype, target, started, status,
+                        error, artifacts, phases, cache_outcomes):
+        """ Record a build in the history database if one is configured. """
+        if self.config.history_db is None:
+            return
+        artifact_size = (sum(artifact.size for artifact in artifacts
+                             if artifact.kind != 'manifest')
+                         if artifacts else None)
+        try:
+            history.BuildHistory(self.config.history_db).record(
+                build_id, self.repo.name, self.repo.branch, self.repo.revision,
+                dtype, target, started, time.time() - started, status, error,
+                artifact_size, phases, cache_outcomes)
+        except sqlite3.Error as e:
+            # The history is no reason to fail a build
+            log('WARNING: Recording the build history failed: %s' % e)
+
+    def write_metrics(self):
+        """ Write the metrics textfile if one is configured. """
+        if self.config.metrics_textfile is not None:
+            metrics.REGISTRY.write_textfile(self.config.metrics_textfile)
+
+    def collect_garbage(self):
+        """
+        Evict old workspaces and caches if a workspace budget is configured.
+        """
+        if self.config.gc_budget is None:
+            return []
+        gc = WorkspaceGC(self.config.workspace_base, self.config.gc_budget,
+                         self.config.staging_dir)
+        return gc.collect()
+
+    def _create_workspace(self, workspace_id=None):
+        workspace = Workspace(workspace_id or self.workspace_id,
+                              self.config.workspace_base,
                               self.config.install_location, self.repo)
         workspace.debug = self.debug
+        workspace.staging_dir = self.config.staging_dir
+        workspace.staging_cap = self.config.staging_size_cap
         return workspace
 
     def _load_deploy(self, workspace, deploy_file, build_num,
@@ -458,12 +2051,21 @@ class Sideloader(object):
             return deploy_types.Python()
         elif deploy_type_str == 'virtualenv':
             return deploy_types.VirtualEnv()
+        elif deploy_type_str == 'wheel':
+            return deploy_types.Wheel()
 
         return deploy_types.DeployType()
 
     def _create_build(self, workspace, deploy, deploy_type):
         build = Build(workspace, deploy, deploy_type)
         build.debug = self.debug
+        build.cache = self.cache
+        build.python = self.config.python
+        if self.config.venv_pool_size:
+            build.venv_pool = VenvPool(
+                os.path.join(self.config.workspace_base, VENV_POOL_DIR),
+                self.config.venv_pool_size, self.config.python)
+            build.venv_pool.debug = self.debug
 
         return build
 
@@ -472,6 +2074,7 @@ class Sideloader(object):
                           self.config.gpg_key)
         package.sign = sign
         package.debug = self.debug
+        package.cache = self.cache
 
         return package
 
@@ -481,22 +2084,72 @@ class Config(object):
     Container class for Sideloader config, typically loaded from 'config.yaml'.
     """
     def __init__(self, install_location, default_branch, workspace_base,
-                 gpg_key):
+                 gpg_key, gc_budget=None, staging_dir=None,
+                 staging_size_cap=None, phase_workers=4, build_cache=False,
+                 remote_cache=None, metrics_textfile=None, log_dir=None,
+                 log_max_bytes=None, log_backups=5, phase_timeouts=None,
+                 default_phase_timeout=None, venv_pool_size=0,
+                 history_db=None, workspace_conflict='wait',
+                 metrics_port=None, python=None):
         self.install_location = install_location
         self.default_branch = default_branch
         self.workspace_base = workspace_base
         self.gpg_key = gpg_key
+        self.gc_budget = gc_budget
+        self.staging_dir = staging_dir
+        self.staging_size_cap = staging_size_cap
+        self.phase_workers = phase_workers
+        self.build_cache = build_cache
+        self.remote_cache = remote_cache
+        self.metrics_textfile = metrics_textfile
+        self.log_dir = log_dir
+        self.log_max_bytes = log_max_bytes
+        self.log_backups = log_backups
+        # Seconds each phase may run for, by phase name
+        self.phase_timeouts = phase_timeouts or {}
+        self.default_phase_timeout = default_phase_timeout
+        # Blank virtualenvs to keep ready for new workspaces (0 for none)
+        self.venv_pool_size = venv_pool_size
+        # The SQLite database to record builds in (None to not record them)
+        self.history_db = history_db
+        # What a run does when another run is using its workspace: 'wait'
+        # for it or 'suffix' to use another workspace
+        self.workspace_conflict = workspace_conflict
+        # The port to serve metrics on while watching (None to not serve them)
+        self.metrics_port = metrics_port
+        # The interpreter for build virtualenvs (None for virtualenv's
+        # default)
+        self.python = python
 
     @classmethod
     def from_config_file(cls, config_file_path):
         with open(config_file_path) as config_file:
             config_yaml = yaml.load(config_file)
 
+        workspace_base = config_yaml.get('workspace_base', '/workspace')
         return Config(
             config_yaml['install_location'],
             config_yaml.get('default_branch', 'develop'),
-            config_yaml.get('workspace_base', '/workspace'),
-            config_yaml.get('gpg_key')
+            workspace_base,
+            config_yaml.get('gpg_key'),
+            parse_size(config_yaml.get('gc_budget')),
+            config_yaml.get('staging_dir'),
+            parse_size(config_yaml.get('staging_size_cap', '256M')),
+            config_yaml.get('phase_workers', 4),
+            config_yaml.get('build_cache', False),
+            config_yaml.get('remote_cache'),
+            config_yaml.get('metrics_textfile'),
+            config_yaml.get('log_dir'),
+            parse_size(config_yaml.get('log_max_bytes', '10M')),
+            config_yaml.get('log_backups', 5),
+            config_yaml.get('phase_timeouts'),
+            config_yaml.get('default_phase_timeout'),
+            config_yaml.get('venv_pool_size', 0),
+            config_yaml.get('history_db',
+                            os.path.join(workspace_base, '.history.db')),
+            config_yaml.get('workspace_conflict', 'wait'),
+            config_yaml.get('metrics_port'),
+            config_yaml.get('python')
         )
 
 
@@ -505,6 +2158,10 @@ class GitRepo(object):
         self.url = url
         self.branch = branch
         self.name = name
+        self.revision = None
+        # The commit to check out instead of the head of the branch, e.g.
+        # the one a coalesced build was keyed on
+        self.pinned_revision = None
 
     @classmethod
     def from_github_url(cls, github_url, branch):
@@ -515,12 +2172,159 @@ class GitRepo(object):
 
         return GitRepo(github_url, branch, name)
 
+    def lookup_revision(self, cmd):
+        """
+        Look up the SHA of the commit that fetching would check out, without
+        cloning the repo.
+        """
+        if re.match(r'^[0-9a-f]{40}$', self.branch):
+            return self.branch
+
+        output = cmd(['git', 'ls-remote', self.url, self.branch])
+        refs = dict(reversed(line.split('\t', 1))
+                    for line in output.splitlines() if '\t' in line)
+        for ref in ['refs/heads/%s', 'refs/tags/%s^{}', 'refs/tags/%s']:
+            if ref % self.branch in refs:
+                return refs[ref % self.branch]
+        raise ValueError('Branch %s not found in %s' % (self.branch,
+                                                        self.url))
+
+    def fetch(self, path, cmd):
+        """ Clone the repo and checkout the desired branch. """
+        log('Fetching github repo')
+        cmd(['git', 'clone', self.url, path])
+        cmd(['git', '-C', path, 'checkout',
+             self.pinned_revision or self.branch])
+
+    def resolve_revision(self, path, cmd):
+        """ Record the SHA of the checked out commit. """
+        output = cmd(['git', '-C', path, 'rev-parse', 'HEAD'])
+        self.revision = output.strip() if output else None
+        return self.revision
+
+
+class LocalSource(object):
+    """
+    A source that is already on disk, either as a directory (such as a CI
+    checkout) or as a tarball. It is staged into the workspace without
+    cloning and identified by a hash of its contents rather than a commit.
+    """
+
+    TARBALL_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2')
+
+    def __init__(self, path, branch, name):
+        self.path = os.path.abspath(path)
+        self.url = self.path
+        self.branch = branch
+        self.name = name
+        self.revision = None
+
+    @classmethod
+    def is_local(cls, source):
+        """ Check whether source is a local directory or tarball. """
+        return os.path.isdir(source) or (
+            os.path.isfile(source) and cls._is_tarball(source))
+
+    @classmethod
+    def _is_tarball(cls, path):
+        return path.endswith(cls.TARBALL_EXTENSIONS)
+
+    @classmethod
+    def from_path(cls, path, branch):
+        name = os.path.basename(os.path.abspath(path))
+        for extension in cls.TARBALL_EXTENSIONS:
+            if name.endswith(extension):
+                name = name[:-len(extension)]
+                break
+
+        return LocalSource(path, branch, name)
+
+    def lookup_revision(self, cmd):
+        """ Get a content hash of the source without staging it. """
+        if os.path.isdir(self.path):
+            return hash_tree(self.path)
+        return hash_file(self.path)
+
+    def fetch(self, path, cmd):
+        """
+        Stage the source into the workspace. Directories are cloned with
+        copy-on-write where the filesystem supports it and copied otherwise,
+        so that nothing the build does can change the source. Tarballs are
+        extracted.
+        """
+        if os.path.isdir(self.path):
+            log('Staging local source directory')
+            if not reflink_tree(self.path, path):
+                shutil.copytree(self.path, path, symlinks=True)
+        else:
+            log('Extracting local source tarball')
+            self._extract(path)
+
+        self.revision = hash_tree(path)
+
+    def restage(self, path, relpaths):
+        """
+        Bring a staged copy of the source directory up to date with changes
+        to some of its paths, then update the revision.
+
+        :param: relpaths:
+        The paths that changed, relative to the source.
+        """
+        for relpath in relpaths:
+            src_path = os.path.join(self.path, relpath)
+            dst_path = os.path.join(path, relpath)
+            if os.path.isdir(dst_path) and not os.path.islink(dst_path):
+                if os.path.isdir(src_path) and not os.path.islink(src_path):
+                    continue
+                rmtree_if_exists(dst_path)
+            elif os.path.lexists(dst_path):
+                os.remove(dst_path)
+
+            if not os.path.lexists(src_path):
+                continue
+            parent = os.path.dirname(dst_path)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            if os.path.islink(src_path):
+                os.symlink(os.readlink(src_path), dst_path)
+            elif os.path.isdir(src_path):
+                # The files in new directories are restaged separately
+                os.mkdir(dst_path)
+            else:
+                shutil.copy2(src_path, dst_path)
+
+        self.revision = hash_tree(path)
+
+    def _extract(self, path):
+        """
+        Extract the tarball to path. If everything in the tarball is inside a
+        single top-level directory, that directory becomes path.
+        """
+        extract_dir = tempfile.mkdtemp(dir=os.path.dirname(path))
+        try:
+            extract_tarball(self.path, extract_dir)
+
+            children = os.listdir(extract_dir)
+            root = extract_dir
+            if (len(children) == 1 and
+                    os.path.isdir(os.path.join(extract_dir, children[0]))):
+                root = os.path.join(extract_dir, children[0])
+            os.rename(root, path)
+        finally:
+            rmtree_if_exists(extract_dir)
+
+    def resolve_revision(self, path, cmd):
+        """ Record the content hash of the staged source. """
+        if self.revision is None:
+            self.revision = hash_tree(path)
+        return self.revision
+
 
 class Deploy(object):
     def __init__(self, name=None, buildscript=None, postinstall=None,
                  config_files=[], pip=[], dependencies=[],
                  virtualenv_prefix=None, allow_broken_build=False, user=None,
-                 version=None):
+                 version=None, exclude=[], slim=False, build_steps=[]):
         """
         Container class for deploy prefernces, typically loaded from the
         project's '.deploy.yaml' file.
@@ -535,6 +2339,12 @@ class Deploy(object):
         self.allow_broken_build = allow_broken_build
         self.user = user
         self.version = version
+        # Patterns of files to leave out of the package
+        self.exclude = exclude
+        # Leave out files that aren't needed at runtime and strip binaries
+        self.slim = slim
+        # BuildSteps to run (and cache) before the buildscript
+        self.build_steps = build_steps
 
     @classmethod
     def from_deploy_file(cls, deploy_file_path):
@@ -556,11 +2366,15 @@ class Deploy(object):
             deploy_yaml.get('postinstall'),
             config_files,
             deploy_yaml.get('pip', []),
-            deploy_yaml.get('dependencies'),
+            deploy_yaml.get('dependencies', []),
             deploy_yaml.get('virtualenv_prefix'),
             deploy_yaml.get('allow_broken_build', False),
             deploy_yaml.get('user'),
-            deploy_yaml.get('version')
+            deploy_yaml.get('version'),
+            deploy_yaml.get('exclude', []),
+            deploy_yaml.get('slim', False),
+            [BuildStep.from_yaml(step_yaml)
+             for step_yaml in deploy_yaml.get('build_steps', [])]
         )
 
     def override(self, **overrides):
@@ -570,7 +2384,7 @@ class Deploy(object):
         """
         attrs = ['name', 'buildscript', 'postinstall', 'config_files', 'pip',
                  'dependencies', 'virtualenv_prefix', 'allow_broken_build',
-                 'user', 'version']
+                 'user', 'version', 'exclude', 'slim', 'build_steps']
         for override in overrides.keys():
             if override not in attrs:
                 raise ValueError('Deploy has no attribute \'%s\'' % override)
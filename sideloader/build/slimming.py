@@ -0,0 +1,180 @@
+"""
+Slimming of package trees before they are packaged: removing files that
+aren't needed at runtime, stripping debug symbols from shared objects and
+reporting what takes up the space.
+"""
+import fnmatch
+import os
+import subprocess
+
+from utils import log
+
+
+""" Files that are rarely needed at runtime, excluded by 'slim: true'. """
+DEFAULT_EXCLUDES = (
+    '__pycache__', '*.pyc', '*.pyo', '.git', '.hg', '.svn', 'tests', 'docs',
+    '*.c', '*.h', '*.pyx')
+
+ELF_MAGIC = '\x7fELF'
+
+
+def is_excluded(relpath, patterns):
+    """
+    Check whether a path matches any of the exclude patterns. Patterns
+    without a '/' match the name of a file or directory at any depth and
+    other patterns match the whole path relative to the root.
+    """
+    name = os.path.basename(relpath)
+    for pattern in patterns:
+        if '/' in pattern:
+            if fnmatch.fnmatch(relpath, pattern.strip('/')):
+                return True
+        elif fnmatch.fnmatch(name, pattern):
+            return True
+    return False
+
+
+def remove_excluded(root, patterns):
+    """
+    Remove the files and directories under root that match the exclude
+    patterns.
+
+    :returns:
+    The paths of the files that were removed (including the files in
+    removed directories).
+    """
+    removed = []
+    if not patterns:
+        return removed
+
+    for dir_path, dirs, files in os.walk(root):
+        for name in sorted(dirs):
+            path = os.path.join(dir_path, name)
+            if is_excluded(os.path.relpath(path, root), patterns):
+                dirs.remove(name)
+                removed += _remove_tree(path)
+        for name in sorted(files):
+            path = os.path.join(dir_path, name)
+            if is_excluded(os.path.relpath(path, root), patterns):
+                os.remove(path)
+                removed.append(path)
+    return removed
+
+
+def _remove_tree(path):
+    """ Remove a directory tree, returning the paths of its files. """
+    if os.path.islink(path):
+        os.remove(path)
+        return [path]
+
+    removed = []
+    for dir_path, dirs, files in os.walk(path, topdown=False):
+        for name in files:
+            os.remove(os.path.join(dir_path, name))
+            removed.append(os.path.join(dir_path, name))
+        for name in dirs:
+            dir_name = os.path.join(dir_path, name)
+            if os.path.islink(dir_name):
+                os.remove(dir_name)
+                removed.append(dir_name)
+            else:
+                os.rmdir(dir_name)
+    os.rmdir(path)
+    return removed
+
+
+def is_shared_object(path):
+    """ Check whether a file is an ELF shared object ('*.so', '*.so.1'). """
+    name = os.path.basename(path)
+    if not (name.endswith('.so') or '.so.' in name):
+        return False
+    if os.path.islink(path) or not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as so_file:
+        return so_file.read(len(ELF_MAGIC)) == ELF_MAGIC
+
+
+def strip_shared_objects(root, cmd):
+    """
+    Strip the debug symbols from the shared objects under root. Stripped
+    files replace the originals rather than being modified in place, so
+    trees of hard links can be stripped without touching the files they
+    were linked from.
+
+    :returns:
+    A list of (path, bytes saved) tuples for the stripped files.
+    """
+    stripped = []
+    for dir_path, _, files in os.walk(root):
+        for name in sorted(files):
+            path = os.path.join(dir_path, name)
+            if not is_shared_object(path):
+                continue
+
+            tmp_path = path + '.stripped'
+            try:
+                cmd(['strip', '--strip-debug', '-o', tmp_path, path])
+            except subprocess.CalledProcessError:
+                log('WARNING: Could not strip %s' % path)
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                continue
+
+            size = os.path.getsize(path)
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+            os.rename(tmp_path, path)
+            stripped.append((path, size - os.path.getsize(path)))
+    return stripped
+
+
+def size_report(root, depth=2, limit=10):
+    """
+    Find the largest contributors to the size of a tree.
+
+    :param: depth:
+    The number of path components to group files by, e.g. 2 groups
+    'static/js/app.js' under 'static/js'.
+
+    :param: limit:
+    The number of groups and files to report.
+
+    :returns:
+    A tuple of (total size, the largest groups, the largest files), where
+    groups and files are lists of (relative path, size) tuples.
+    """
+    total = 0
+    groups = {}
+    files = []
+    for dir_path, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(dir_path, name)
+            relpath = os.path.relpath(path, root)
+            size = os.lstat(path).st_size
+            total += size
+            group = os.path.join(*relpath.split(os.sep)[:depth])
+            groups[group] = groups.get(group, 0) + size
+            files.append((relpath, size))
+
+    def largest(items):
+        return sorted(items, key=lambda item: (-item[1], item[0]))[:limit]
+
+    return total, largest(groups.items()), largest(files)
+
+
+def format_size(size):
+    """ Format a size in bytes for humans. """
+    for unit in ('B', 'K', 'M', 'G'):
+        if abs(size) < 1024 or unit == 'G':
+            break
+        size /= 1024.0
+    return ('%d%s' if unit == 'B' else '%.1f%s') % (size, unit)
+
+
+def log_size_report(root, depth=2, limit=10):
+    """ Log the largest contributors to the size of a tree. """
+    total, groups, files = size_report(root, depth, limit)
+    lines = ['%8s  %s' % (format_size(size), path) for path, size in groups]
+    lines.append('Largest files:')
+    lines += ['%8s  %s' % (format_size(size), path) for path, size in files]
+    log('Package tree is %s, largest contributors:' % format_size(total),
+        output=lines)
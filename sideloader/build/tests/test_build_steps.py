@@ -0,0 +1,66 @@
+import pytest
+
+from sideloader.build.build_steps import BuildStep
+
+
+def _create_repo(tmpdir):
+    repo = tmpdir.mkdir('repo')
+    repo.ensure('package.json').write('{}')
+    repo.ensure('assets', 'js', 'app.js').write('app()')
+    repo.ensure('assets', 'app.css').write('body {}')
+    repo.ensure('app', 'views.py').write('')
+    repo.ensure('.git', 'HEAD').write('ref: refs/heads/develop')
+    return repo
+
+
+def test_find_inputs(tmpdir):
+    """
+    Input patterns match files at any depth and everything in matching
+    directories.
+    """
+    repo = _create_repo(tmpdir)
+    step = BuildStep('assets', 'make', ['package.json', 'assets/**/*.js'],
+                     ['static'])
+    assert step.find_inputs(str(repo)) == ['package.json', 'assets/js/app.js']
+
+    step.inputs = ['assets']
+    assert step.find_inputs(str(repo)) == ['assets/app.css',
+                                           'assets/js/app.js']
+
+
+def test_get_cache_key(tmpdir):
+    """ The key only changes when the step or its inputs change. """
+    repo = _create_repo(tmpdir)
+    step = BuildStep('assets', 'make', ['package.json', 'assets'], ['static'])
+    key = step.get_cache_key(str(repo))
+
+    repo.join('app', 'views.py').write('changed')
+    assert step.get_cache_key(str(repo)) == key
+
+    repo.join('assets', 'app.css').write('changed')
+    assert step.get_cache_key(str(repo)) != key
+
+    key = step.get_cache_key(str(repo))
+    step.run = 'make all'
+    assert step.get_cache_key(str(repo)) != key
+
+
+def test_get_cache_key_without_inputs(tmpdir):
+    """ A step without inputs is keyed on the whole repo. """
+    repo = _create_repo(tmpdir)
+    step = BuildStep('assets', 'make', outputs=['static'])
+    assert step.find_inputs(str(repo)) == [
+        'package.json', 'app/views.py', 'assets/app.css', 'assets/js/app.js']
+    key = step.get_cache_key(str(repo))
+
+    repo.join('app', 'views.py').write('changed')
+    assert step.get_cache_key(str(repo)) != key
+
+
+def test_from_yaml():
+    step = BuildStep.from_yaml({'name': 'assets', 'run': 'make',
+                                'outputs': ['static']})
+    assert step.inputs == []
+
+    with pytest.raises(ValueError):
+        BuildStep.from_yaml({'name': 'assets', 'run': 'make'})
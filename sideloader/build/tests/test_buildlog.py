@@ -0,0 +1,67 @@
+import json
+import StringIO
+
+from sideloader.build.buildlog import (
+    BuildLog, BuildLogListener, ConsoleRenderer, JSONLinesFile)
+from sideloader.build.phases import Phase, PhaseGraph
+from sideloader.build.utils import cmd, log
+
+
+def _read_records(path):
+    return [json.loads(line) for line in path.read().splitlines()]
+
+
+def test_build_log(tmpdir):
+    """
+    Messages logged during a build are written as JSON lines tagged with the
+    build id and the phase that logged them, and rendered on the console.
+    """
+    console = StringIO.StringIO()
+    path = tmpdir.join('logs', 'build.log')
+    build_log = BuildLog('build-1', [ConsoleRenderer(console),
+                                     JSONLinesFile(str(path))])
+
+    def clone():
+        log('Fetching github repo')
+        cmd(['echo', 'hello'], debug=True)
+
+    with build_log:
+        log('Starting')
+        PhaseGraph([Phase('clone', clone)]).run(
+            1, [BuildLogListener(build_log)])
+
+    records = _read_records(path)
+    assert [(r['build'], r['phase'], r['message']) for r in records] == [
+        ('build-1', None, 'Starting'),
+        ('build-1', 'clone', 'Fetching github repo'),
+        ('build-1', 'clone', 'echo hello'),
+        ('build-1', 'clone', records[3]['message']),
+        ('build-1', 'clone', records[4]['message']),
+    ]
+    assert records[3]['output'] == ['hello']
+    assert records[4]['message'].startswith('Finished in ')
+
+    lines = console.getvalue().splitlines()
+    assert lines[1].endswith('] [clone] Fetching github repo')
+    assert lines[4] == '    hello'
+
+
+def test_log_without_build_log(capsys):
+    """ Messages logged outside of a build go to stdout. """
+    log('Hello')
+    out, _ = capsys.readouterr()
+    assert out.startswith('[') and out.endswith('] Hello\n')
+
+
+def test_rotation(tmpdir):
+    """ Log files are rotated when they grow too big. """
+    path = tmpdir.join('build.log')
+    log_file = JSONLinesFile(str(path), max_bytes=1, backup_count=2)
+    for i in range(4):
+        log_file.write([{'message': str(i)}])
+    log_file.close()
+
+    assert _read_records(path) == [{'message': '3'}]
+    assert _read_records(tmpdir.join('build.log.1')) == [{'message': '2'}]
+    assert _read_records(tmpdir.join('build.log.2')) == [{'message': '1'}]
+    assert not tmpdir.join('build.log.3').check()
@@ -0,0 +1,59 @@
+import marshal
+import os
+import struct
+import sys
+
+from distutils.spawn import find_executable
+
+import pytest
+
+from sideloader.build.bytecode import compile_tree
+from sideloader.build.utils import cmd
+
+
+def _write_sources(tmpdir):
+    tmpdir.ensure('app', '__init__.py').write('x = 1\n')
+    tmpdir.ensure('app', 'views.py').write('def view():\n    return 1\n')
+    tmpdir.ensure('app', 'template.py').write('{% if x %}\n')
+
+
+def test_compile_tree(tmpdir):
+    """
+    Sources are compiled for their path on the target, and files that don't
+    compile are reported and skipped.
+    """
+    _write_sources(tmpdir)
+    # A pyc hard linked from elsewhere is replaced rather than overwritten
+    tmpdir.join('linked.pyc').write('linked')
+    os.link(str(tmpdir.join('linked.pyc')),
+            str(tmpdir.join('app', 'views.pyc')))
+
+    errors = compile_tree(str(tmpdir.join('app')), '/opt/app', sys.executable,
+                          cmd, workers=2)
+
+    assert len(errors) == 1 and errors[0].startswith('/opt/app/template.py')
+    assert not tmpdir.join('app', 'template.pyc').check()
+    assert tmpdir.join('linked.pyc').read() == 'linked'
+    with open(str(tmpdir.join('app', 'views.pyc')), 'rb') as pyc:
+        pyc.read(8)
+        code = marshal.load(pyc)
+    assert code.co_filename == '/opt/app/views.py'
+
+
+@pytest.mark.skipif(not find_executable('python3'), reason='needs python3')
+def test_compile_tree_hash_based(tmpdir):
+    """ Python 3.7+ pycs are hash-based, so they don't depend on mtimes. """
+    python3 = find_executable('python3')
+    if cmd([python3, '-c', 'import sys; print(sys.version_info >= (3, 7))'],
+           ).strip() != 'True':
+        pytest.skip('needs python 3.7+')
+    _write_sources(tmpdir)
+
+    compile_tree(str(tmpdir.join('app')), '/opt/app', python3, cmd)
+
+    [pyc] = tmpdir.join('app', '__pycache__').listdir('views.*.pyc')
+    with open(str(pyc), 'rb') as pyc_file:
+        pyc_file.read(4)
+        flags, = struct.unpack('<I', pyc_file.read(4))
+    # Hash-based and checked against the source
+    assert flags == 3
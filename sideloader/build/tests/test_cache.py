@@ -0,0 +1,140 @@
+import BaseHTTPServer
+import threading
+
+import pytest
+
+from sideloader.build.cache import (
+    BuildCache, CacheRequestHandler, FileSystemCache, HTTPCache, LocalCache,
+    cache_key)
+
+
+def _new_blob(cache, content):
+    path = cache.new_blob_path()
+    with open(path, 'w') as blob:
+        blob.write(content)
+    return path
+
+
+def test_cache_key():
+    """ Cache keys depend on every part and on how they are split. """
+    assert cache_key('a', 'b') == cache_key('a', 'b')
+    assert cache_key('a', 'b') != cache_key('a', 'c')
+    assert cache_key('ab', 'c') != cache_key('a', 'bc')
+
+
+def test_local_cache(tmpdir):
+    """
+    Blobs put in the local cache can be looked up again, and live in a
+    directory per entry so that they are garbage collected.
+    """
+    cache = BuildCache(LocalCache(str(tmpdir)))
+    assert cache.get('wheels', 'abc') is None
+
+    cache.put('wheels', 'abc', _new_blob(cache, 'wheel data'))
+
+    path = cache.get('wheels', 'abc')
+    assert open(path).read() == 'wheel data'
+    assert tmpdir.join('.cache', 'wheels', 'abc', 'blob').check()
+    assert cache.outcomes == [('wheels', 'miss'), ('wheels', 'hit')]
+
+
+def test_remote_cache_shared_between_hosts(tmpdir):
+    """
+    Blobs put in a cache with a remote backend are uploaded, so another
+    host's cache can download them.
+    """
+    remote = FileSystemCache(str(tmpdir.join('remote')))
+    host1 = BuildCache(LocalCache(str(tmpdir.mkdir('host1'))), remote)
+    host2 = BuildCache(LocalCache(str(tmpdir.mkdir('host2'))), remote)
+
+    host1.put('venvs', 'abc', _new_blob(host1, 'venv data'))
+    host1.wait()
+
+    assert host2.get_many('venvs', ['abc', 'def']) == {
+        'abc': str(tmpdir.join('host2', '.cache', 'venvs', 'abc', 'blob')),
+        'def': None,
+    }
+    assert open(host2.get('venvs', 'abc')).read() == 'venv data'
+    assert sorted(host2.outcomes) == [
+        ('venvs', 'hit'), ('venvs', 'miss'), ('venvs', 'remote_hit')]
+
+
+def test_remote_cache_integrity_check(tmpdir):
+    """ Remote blobs that don't match their digest are treated as misses. """
+    remote = FileSystemCache(str(tmpdir.join('remote')))
+    host1 = BuildCache(LocalCache(str(tmpdir.mkdir('host1'))), remote)
+    host1.put('venvs', 'abc', _new_blob(host1, 'venv data'))
+    host1.wait()
+
+    tmpdir.join('remote', 'venvs', 'abc').write('corrupted')
+
+    host2 = BuildCache(LocalCache(str(tmpdir.mkdir('host2'))), remote)
+    assert host2.get('venvs', 'abc') is None
+    assert not tmpdir.join('host2', '.cache', 'venvs', 'abc').check()
+
+
+def test_probe(tmpdir):
+    """
+    Probing tells where an entry would come from without downloading it or
+    recording an outcome.
+    """
+    remote = FileSystemCache(str(tmpdir.join('remote')))
+    host1 = BuildCache(LocalCache(str(tmpdir.mkdir('host1'))), remote)
+    host1.put('venvs', 'abc', _new_blob(host1, 'venv data'))
+    host1.wait()
+    host2 = BuildCache(LocalCache(str(tmpdir.mkdir('host2'))), remote)
+
+    assert host1.probe('venvs', 'abc') == 'hit'
+    assert host2.probe('venvs', 'abc') == 'remote_hit'
+    assert host2.probe('venvs', 'def') == 'miss'
+    assert not tmpdir.join('host2', '.cache', 'venvs', 'abc').check()
+    assert host2.outcomes == []
+
+
+@pytest.fixture
+def cache_server(tmpdir):
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), CacheRequestHandler)
+    server.cache_dir = str(tmpdir.mkdir('server'))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:%d/' % server.server_address[1]
+    server.shutdown()
+
+
+def test_http_cache(tmpdir, cache_server):
+    """ The HTTP backend works against the reference cache server. """
+    remote = HTTPCache(cache_server)
+    host1 = BuildCache(LocalCache(str(tmpdir.mkdir('host1'))), remote)
+    host1.put('wheels', 'abc', _new_blob(host1, 'wheel data'))
+    host1.wait()
+
+    host2 = BuildCache(LocalCache(str(tmpdir.mkdir('host2'))), remote)
+    assert open(host2.get('wheels', 'abc')).read() == 'wheel data'
+    assert host2.get('wheels', 'missing') is None
+    assert remote.exists('wheels', 'abc')
+    assert not remote.exists('wheels', 'missing')
+
+
+def test_http_cache_streams_uploads(tmpdir, cache_server, monkeypatch):
+    """
+    Blobs are uploaded from their files in blocks rather than read into
+    memory first.
+    """
+    remote = HTTPCache(cache_server)
+    bodies = []
+    open_url = remote._open
+
+    def spy_open(url, data=None, *args):
+        bodies.append(data)
+        return open_url(url, data, *args)
+
+    monkeypatch.setattr(remote, '_open', spy_open)
+    blob = tmpdir.join('blob')
+    blob.write('x' * (1024 * 1024 + 1))
+    remote.upload('wheels', 'abc', str(blob), 'digest')
+
+    assert isinstance(bodies[0], file)
+    dst = tmpdir.join('dst')
+    assert remote.download('wheels', 'abc', str(dst)) == 'digest'
+    assert dst.size() == 1024 * 1024 + 1
@@ -0,0 +1,102 @@
+import errno
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from sideloader.build.cancellation import (
+    BuildCancelled, CancellationListener, CancelToken, PhaseTimeout, bind,
+    unbind)
+from sideloader.build.phases import Phase, PhaseGraph
+from sideloader.build.utils import cmd
+
+
+def test_cmd_timeout():
+    """
+    Commands that run out of time are killed along with their children.
+    """
+    start = time.time()
+    with pytest.raises(PhaseTimeout):
+        # The background sleep keeps stdout open unless it's killed too
+        cmd(['sh', '-c', 'sleep 30 & sleep 30'], timeout=0.2)
+    assert time.time() - start < 5
+
+
+def test_cmd_failure():
+    """ Failing commands still raise CalledProcessError. """
+    with pytest.raises(subprocess.CalledProcessError):
+        cmd(['false'])
+    assert cmd(['echo', 'hello']) == 'hello\n'
+
+
+def test_cmd_own_process_group():
+    """
+    Commands lead their own process group, so that they can be killed along
+    with their children, but stay in this session.
+    """
+    output = cmd([sys.executable, '-c',
+                  'import os; print(os.getpgid(0) == os.getpid(), '
+                  'os.getsid(0))'])
+    assert output == '(True, %d)\n' % (os.getsid(0),)
+
+
+def test_cmd_missing_executable():
+    """ Running a command that doesn't exist raises OSError. """
+    with pytest.raises(OSError) as excinfo:
+        cmd(['sideloader-no-such-command'])
+    assert excinfo.value.errno == errno.ENOENT
+
+
+def test_cancel_running_command():
+    """ Cancelling kills the commands running for the cancel token. """
+    token = CancelToken()
+    bind(token)
+    try:
+        threading.Timer(0.2, token.cancel).start()
+        start = time.time()
+        with pytest.raises(BuildCancelled):
+            cmd(['sleep', '30'])
+        assert time.time() - start < 5
+
+        # Nothing else runs once the build has been cancelled
+        with pytest.raises(BuildCancelled):
+            cmd(['true'])
+    finally:
+        unbind()
+
+
+def test_phase_deadlines():
+    """
+    Phases are given deadlines by the listener, and a phase that runs past
+    its deadline cancels the rest of the build.
+    """
+    token = CancelToken()
+    listener = CancellationListener(token, timeouts={'clone': 0.2})
+    graph = PhaseGraph([
+        Phase('clone', lambda: cmd(['sleep', '30'])),
+        Phase('virtualenv', lambda: cmd(['sleep', '30'])),
+    ])
+
+    start = time.time()
+    with pytest.raises(PhaseTimeout):
+        graph.run(2, [listener])
+    assert time.time() - start < 5
+    assert token.cancelled
+
+
+def test_bind_phase():
+    """
+    Work outside the phase graph can be bound to the deadline of a phase.
+    """
+    listener = CancellationListener(CancelToken(), timeouts={'clone': 0.2})
+    listener.bind_phase('clone')
+    try:
+        start = time.time()
+        with pytest.raises(PhaseTimeout):
+            cmd(['sleep', '30'])
+        assert time.time() - start < 5
+    finally:
+        unbind()
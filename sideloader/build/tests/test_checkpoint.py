@@ -0,0 +1,157 @@
+import json
+
+from sideloader.build.checkpoint import (
+    Checkpoints, get_phase_digests, get_run_key)
+from sideloader.build.phases import Phase
+
+
+class FakeSource(object):
+    def __init__(self, revision):
+        self.revision = None
+        self.current_revision = revision
+
+    def lookup_revision(self, cmd):
+        return self.current_revision
+
+
+def noop():
+    pass
+
+
+def _phases():
+    return [
+        Phase('workspace', noop, outputs=['workspace']),
+        Phase('clone', noop, inputs=['workspace'], outputs=['repo']),
+        Phase('venv', noop, inputs=['workspace'], outputs=['venv']),
+        Phase('build', noop, inputs=['repo', 'venv'], outputs=['tree']),
+        Phase('fpm', noop, inputs=['tree'], outputs=['package']),
+        Phase('sign', noop, inputs=['package'], outputs=['signed']),
+    ]
+
+
+def _complete(checkpoints, phases, names):
+    for phase in phases:
+        if phase.name in names:
+            checkpoints.phase_finished(phase, 1.0)
+
+
+def _resumed_names(checkpoints):
+    return [phase.name for phase in checkpoints.resume()]
+
+
+def test_phase_digests_depend_on_inputs():
+    """
+    A phase's digest changes with the run key and with the digests of the
+    phases it depends on, but not with unrelated phases.
+    """
+    phases = _phases()
+    digests = get_phase_digests(phases, get_run_key('a'))
+    other = get_phase_digests(phases, get_run_key('b'))
+    assert digests['fpm'] != other['fpm']
+
+    phases[2] = Phase('venv', None, inputs=['workspace', 'repo'],
+                      outputs=['venv'])
+    changed = get_phase_digests(phases, get_run_key('a'))
+    assert changed['venv'] != digests['venv']
+    assert changed['build'] != digests['build']
+    assert changed['clone'] == digests['clone']
+
+
+def test_resume_skips_completed_phases(tmpdir):
+    """
+    A resumed build skips the phases that completed and continues with the
+    one that failed.
+    """
+    path = str(tmpdir.join('checkpoints'))
+    phases = _phases()
+    source = FakeSource('abc')
+    checkpoints = Checkpoints(path, phases, get_run_key('a'), source)
+    checkpoints.reset()
+    _complete(checkpoints, phases, ['workspace', 'clone'])
+    source.revision = 'abc'
+    _complete(checkpoints, phases, ['venv', 'build', 'fpm'])
+
+    source = FakeSource('abc')
+    checkpoints = Checkpoints(path, phases, get_run_key('a'), source)
+    assert _resumed_names(checkpoints) == [
+        'workspace', 'clone', 'venv', 'build', 'fpm']
+    assert source.revision == 'abc'
+
+
+def test_resume_reruns_downstream_of_incomplete_phases(tmpdir):
+    """
+    Phases that depend on a phase that didn't complete are run again even
+    if they completed, and their checkpoints are forgotten.
+    """
+    path = str(tmpdir.join('checkpoints'))
+    phases = _phases()
+    checkpoints = Checkpoints(path, phases, get_run_key('a'),
+                              FakeSource('abc'))
+    _complete(checkpoints, phases, ['workspace', 'clone', 'build', 'fpm'])
+
+    checkpoints = Checkpoints(path, phases, get_run_key('a'),
+                              FakeSource('abc'))
+    assert _resumed_names(checkpoints) == ['workspace', 'clone']
+    with open(path) as checkpoint_file:
+        assert sorted(json.load(checkpoint_file)['phases']) == [
+            'clone', 'workspace']
+
+
+def test_resume_check_reruns_phases(tmpdir):
+    """
+    Phases that the check says can't be skipped are run again, along with
+    the phases that depend on them.
+    """
+    path = str(tmpdir.join('checkpoints'))
+    phases = _phases()
+    checkpoints = Checkpoints(path, phases, get_run_key('a'),
+                              FakeSource('abc'))
+    _complete(checkpoints, phases, ['workspace', 'clone', 'venv', 'build'])
+
+    checkpoints = Checkpoints(path, phases, get_run_key('a'),
+                              FakeSource('abc'))
+    checked = []
+
+    def check(names):
+        checked.append(names)
+        return [name for name in names if name != 'venv']
+
+    assert [phase.name for phase in checkpoints.resume(check)] == [
+        'workspace', 'clone']
+    assert checked == [['workspace', 'clone', 'venv', 'build']]
+
+
+def test_resume_different_build_starts_from_scratch(tmpdir):
+    """
+    Nothing is skipped if the build's arguments or the source's revision
+    changed, or if there are no checkpoints at all.
+    """
+    path = str(tmpdir.join('checkpoints'))
+    phases = _phases()
+    assert _resumed_names(Checkpoints(path, phases, get_run_key('a'),
+                                      FakeSource('abc'))) == []
+
+    source = FakeSource('abc')
+    checkpoints = Checkpoints(path, phases, get_run_key('a'), source)
+    source.revision = 'abc'
+    _complete(checkpoints, phases, ['workspace', 'clone', 'venv'])
+
+    assert _resumed_names(Checkpoints(path, phases, get_run_key('b'),
+                                      FakeSource('abc'))) == []
+
+    checkpoints = Checkpoints(path, phases, get_run_key('a'), source)
+    _complete(checkpoints, phases, ['workspace', 'clone', 'venv'])
+    assert _resumed_names(Checkpoints(path, phases, get_run_key('a'),
+                                      FakeSource('def'))) == []
+
+
+def test_reset_forgets_completed_phases(tmpdir):
+    path = str(tmpdir.join('checkpoints'))
+    phases = _phases()
+    checkpoints = Checkpoints(path, phases, get_run_key('a'),
+                              FakeSource('abc'))
+    _complete(checkpoints, phases, ['workspace'])
+    checkpoints.reset()
+
+    assert _resumed_names(Checkpoints(path, phases, get_run_key('a'),
+                                      FakeSource('abc'))) == []
@@ -0,0 +1,231 @@
+import threading
+import time
+
+import pytest
+
+from sideloader.build.cancellation import BuildCancelled, CancelToken
+from sideloader.build.coalesce import BuildCoalescer, CoalescedBuildFailed
+from sideloader.build.result import Artifact, BuildResult
+
+
+def _start(target, *args):
+    results = {}
+
+    def run():
+        try:
+            results['value'] = target(*args)
+        except Exception as e:
+            results['error'] = e
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, results
+
+
+class InFlightBuild(object):
+    """ A build that runs until it is told to finish. """
+
+    def __init__(self, tmpdir, fail=False):
+        self.tmpdir = tmpdir
+        self.fail = fail
+        self.started = threading.Event()
+        self.finish = threading.Event()
+
+    def __call__(self):
+        self.started.set()
+        self.finish.wait()
+        if self.fail:
+            raise ValueError('buildscript failed')
+        artifact = self.tmpdir.join('app_1.0_amd64.deb')
+        artifact.write('deb')
+        return BuildResult(revision='abc123',
+                           artifacts=[Artifact.from_path(str(artifact))])
+
+
+def test_identical_requests_share_a_build(tmpdir):
+    """
+    A request identical to an in-flight build waits for it and receives its
+    artifacts without building.
+    """
+    coalescer = BuildCoalescer(str(tmpdir.mkdir('workspaces')))
+    build = InFlightBuild(tmpdir)
+    leader, leader_result = _start(coalescer.run, 'key', build)
+    build.started.wait()
+
+    follower_builds = []
+    follower, follower_result = _start(
+        coalescer.run, 'key', lambda: follower_builds.append(1))
+    # Let the second request block on the lock
+    time.sleep(0.2)
+    build.finish.set()
+    leader.join()
+    follower.join()
+
+    assert follower_builds == []
+    leader_value = leader_result['value']
+    follower_value = follower_result['value']
+    assert not leader_value.coalesced
+    assert follower_value.coalesced
+    assert follower_value.revision == 'abc123'
+    assert follower_value.get_paths() == leader_value.get_paths()
+    [artifact] = follower_value.artifacts
+    assert open(artifact.path).read() == 'deb'
+    assert artifact.size == 3
+    assert '.cache/coalesced/key/' in artifact.path
+
+
+def test_failed_build_fails_attached_requests(tmpdir):
+    """ Requests attached to a build that fails fail too. """
+    coalescer = BuildCoalescer(str(tmpdir.mkdir('workspaces')))
+    build = InFlightBuild(tmpdir, fail=True)
+    leader, _ = _start(coalescer.run, 'key', build)
+    build.started.wait()
+
+    follower, follower_result = _start(coalescer.run, 'key', BuildResult)
+    # Let the second request block on the lock
+    time.sleep(0.2)
+    build.finish.set()
+    leader.join()
+    follower.join()
+
+    assert isinstance(follower_result['error'], CoalescedBuildFailed)
+
+
+def test_build_of_another_commit_is_not_shared(tmpdir):
+    """
+    If the build turns out to be of another commit than the one the
+    requests are keyed on, the requests attached to it build themselves.
+    """
+    coalescer = BuildCoalescer(str(tmpdir.mkdir('workspaces')))
+    build = InFlightBuild(tmpdir)
+    leader, leader_result = _start(
+        coalescer.run, 'key', build, 'branch', 'def456')
+    build.started.wait()
+
+    follower_builds = []
+
+    def follower_build():
+        follower_builds.append(1)
+        return BuildResult(revision='def456')
+
+    follower, follower_result = _start(
+        coalescer.run, 'key', follower_build, 'branch', 'def456')
+    # Let the second request block on the lock
+    time.sleep(0.2)
+    build.finish.set()
+    leader.join()
+    follower.join()
+
+    assert leader_result['value'].revision == 'abc123'
+    assert follower_builds == [1]
+    assert not follower_result['value'].coalesced
+    assert follower_result['value'].revision == 'def456'
+
+
+def test_later_requests_build_again(tmpdir):
+    """ Results of finished builds are not reused by later requests. """
+    coalescer = BuildCoalescer(str(tmpdir.mkdir('workspaces')))
+    builds = []
+
+    def build():
+        builds.append(1)
+        return BuildResult()
+
+    coalescer.run('key', build)
+    coalescer.run('key', build)
+    assert builds == [1, 1]
+
+
+class CancellableBuild(object):
+    """ A build that runs until it is cancelled or told to finish. """
+
+    def __init__(self, token):
+        self.token = token
+        self.started = threading.Event()
+        self.finish = threading.Event()
+
+    def __call__(self):
+        self.started.set()
+        while not self.finish.is_set():
+            self.token.wait(0.01)
+            self.token.check()
+        return BuildResult(revision='old')
+
+
+def test_cancel_superseded(tmpdir):
+    """
+    A build of a new commit of a branch can cancel the running build of the
+    superseded commit through its cancel token, and doesn't signal it.
+    """
+    workspace_base = tmpdir.mkdir('workspaces')
+    coalescer = BuildCoalescer(str(workspace_base))
+    coalescer.poll_interval = 0.01
+    token = CancelToken()
+    build = CancellableBuild(token)
+    superseded, superseded_result = _start(
+        coalescer.run, 'old-key', build, 'branch', 'old', False, token)
+    build.started.wait()
+
+    coalescer.run('new-key', BuildResult, 'branch', 'new',
+                  cancel_superseded=True)
+    superseded.join()
+
+    error = superseded_result['error']
+    assert isinstance(error, BuildCancelled)
+    assert str(error) == 'Superseded by a build of commit new'
+    assert workspace_base.join('.coalesce').listdir(
+        lambda path: path.ext in ('.branch', '.superseded')) == []
+
+
+def test_keeps_superseded_by_default(tmpdir):
+    """ Superseded builds are only cancelled when asked to. """
+    workspace_base = tmpdir.mkdir('workspaces')
+    coalescer = BuildCoalescer(str(workspace_base))
+    coalescer.poll_interval = 0.01
+    token = CancelToken()
+    build = CancellableBuild(token)
+    superseded, superseded_result = _start(
+        coalescer.run, 'old-key', build, 'branch', 'old', False, token)
+    build.started.wait()
+
+    coalescer.run('new-key', BuildResult, 'branch', 'new')
+    time.sleep(0.05)
+    build.finish.set()
+    superseded.join()
+
+    assert superseded_result['value'].revision == 'old'
+    assert not token.cancelled
+
+
+def test_cancel_while_waiting(tmpdir):
+    """
+    A request waiting for an identical build stops waiting when it is
+    cancelled.
+    """
+    coalescer = BuildCoalescer(str(tmpdir.mkdir('workspaces')))
+    coalescer.poll_interval = 0.01
+    build = InFlightBuild(tmpdir)
+    leader, _ = _start(coalescer.run, 'key', build)
+    build.started.wait()
+
+    token = CancelToken()
+    follower, follower_result = _start(
+        coalescer.run, 'key', BuildResult, None, None, False, token)
+    time.sleep(0.05)
+    token.cancel('Received signal 2')
+    follower.join()
+    build.finish.set()
+    leader.join()
+
+    assert str(follower_result['error']) == 'Received signal 2'
+
+
+def test_unexpected_errors_are_raised(tmpdir):
+    """ Errors from the leader's build are raised to the leader. """
+    coalescer = BuildCoalescer(str(tmpdir.mkdir('workspaces')))
+
+    def build():
+        raise ValueError('no')
+
+    with pytest.raises(ValueError):
+        coalescer.run('key', build)
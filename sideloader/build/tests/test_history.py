@@ -0,0 +1,77 @@
+from sideloader.build.history import BUILD_TOTAL, BuildHistory
+
+
+DAY = 24 * 60 * 60
+
+
+def _record(history, repo, started, duration, status='succeeded',
+            phases=()):
+    return history.record(
+        'build-%s' % started, repo, 'develop', 'abc123', 'virtualenv', 'deb',
+        started, duration, status, artifact_size=1024, phases=phases)
+
+
+def test_record(tmpdir):
+    """ Builds are recorded with their phases and cache lookups. """
+    history = BuildHistory(str(tmpdir.join('history.db')))
+    build = history.record(
+        'build-1', 'app', 'develop', 'abc123', 'virtualenv', 'deb', 1000, 60,
+        'failed', 'pip failed', None,
+        [('clone', 5, 'succeeded'), ('pip', 50, 'failed')],
+        [('wheels', 'hit'), ('wheels', 'hit'), ('venvs', 'miss')])
+
+    [row] = history.slowest()
+    assert row['id'] == build
+    assert (row['repo'], row['status'], row['error']) == (
+        'app', 'failed', 'pip failed')
+    assert [tuple(phase) for phase in history.phases(build)] == [
+        ('pip', 50, 'failed'), ('clone', 5, 'succeeded')]
+    assert [tuple(lookup) for lookup in history.cache_lookups(build)] == [
+        ('venvs', 'miss', 1), ('wheels', 'hit', 2)]
+
+
+def test_slowest(tmpdir):
+    """ The slowest builds can be filtered by repo and start time. """
+    history = BuildHistory(str(tmpdir.join('history.db')))
+    _record(history, 'app', 1000, 30)
+    _record(history, 'app', 2000, 90)
+    _record(history, 'other', 3000, 60)
+
+    assert [row['duration'] for row in history.slowest()] == [90, 60, 30]
+    assert [row['duration'] for row in history.slowest(limit=1)] == [90]
+    assert [row['duration'] for row in history.slowest(repo='app')] == [
+        90, 30]
+    assert [row['duration'] for row in history.slowest(since=2500)] == [60]
+
+
+def test_trends(tmpdir):
+    """ Builds are summarised per repo and period. """
+    history = BuildHistory(str(tmpdir.join('history.db')))
+    _record(history, 'app', DAY, 30)
+    _record(history, 'app', DAY + 60, 90, status='failed')
+    _record(history, 'app', 2 * DAY, 40)
+
+    rows = [tuple(row) for row in history.trends(DAY)]
+    assert rows == [('app', DAY, 2, 1, 60, 90, 1024),
+                    ('app', 2 * DAY, 1, 0, 40, 40, 1024)]
+
+
+def test_regressions(tmpdir):
+    """
+    Phases and builds that got slower between windows are reported, and
+    windows without enough builds are ignored.
+    """
+    history = BuildHistory(str(tmpdir.join('history.db')))
+    now = 100 * DAY
+    for i in range(3):
+        _record(history, 'app', now - 10 * DAY + i, 100,
+                phases=[('pip', 50, 'succeeded'), ('fpm', 10, 'succeeded')])
+        _record(history, 'app', now - DAY + i, 160,
+                phases=[('pip', 100, 'succeeded'), ('fpm', 10, 'succeeded')])
+    _record(history, 'other', now - 10 * DAY, 10)
+    _record(history, 'other', now - DAY, 100)
+
+    assert history.regressions(7 * DAY, now=now) == [
+        ('app', 'pip', 50, 100, 2.0),
+        ('app', BUILD_TOTAL, 100, 160, 1.6),
+    ]
@@ -0,0 +1,62 @@
+import hashlib
+
+from sideloader.build.manifest import Manifest
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def test_copytree_records_files(tmpdir):
+    """
+    When a tree is copied, every file is copied and recorded in the manifest
+    with its size and hash.
+    """
+    src = tmpdir.mkdir('src')
+    src.mkdir('lib').join('app.py').write('print("hi")')
+    src.join('run.sh').write('#!/bin/sh')
+    package = tmpdir.mkdir('package')
+
+    manifest = Manifest(str(package))
+    manifest.copytree(str(src), str(package.join('opt', 'app')))
+
+    assert package.join('opt', 'app', 'lib', 'app.py').read() == 'print("hi")'
+    assert [(e.path, e.size, e.sha256) for e in manifest] == [
+        ('opt/app/lib/app.py', 11, _sha256('print("hi")')),
+        ('opt/app/run.sh', 9, _sha256('#!/bin/sh')),
+    ]
+
+
+def test_copy_into_directory(tmpdir):
+    """ Copying a file into a directory records the file's path. """
+    tmpdir.join('nginx.conf').write('server {}')
+    package = tmpdir.mkdir('package')
+    package.mkdir('etc')
+
+    manifest = Manifest(str(package))
+    manifest.copy(str(tmpdir.join('nginx.conf')), str(package.join('etc')))
+
+    assert [e.path for e in manifest] == ['etc/nginx.conf']
+    assert package.join('etc', 'nginx.conf').read() == 'server {}'
+
+
+def test_render_and_parse(tmpdir):
+    """
+    The rendered manifest includes the current mode of each file and can be
+    parsed back.
+    """
+    package = tmpdir.mkdir('package')
+    requirements = package.join('requirements.pip')
+    requirements.write('six==1.10.0\n')
+    requirements.chmod(0o640)
+
+    manifest = Manifest(str(package))
+    manifest.add(str(requirements))
+    text = manifest.render()
+
+    assert text == '%s 12 0640 requirements.pip\n' % _sha256('six==1.10.0\n')
+    assert Manifest.parse(text) == {
+        'requirements.pip': (_sha256('six==1.10.0\n'), 12, 0o640)}
+
+    manifest.discard(str(requirements))
+    assert manifest.render() == ''
@@ -0,0 +1,109 @@
+import urllib2
+
+from sideloader.build.metrics import Registry, parse_samples
+
+
+def _create_registry():
+    registry = Registry()
+    builds = registry.counter('builds_total', 'Builds.', ['repo'])
+    size = registry.gauge('artifact_size_bytes', 'Size.', ['repo'])
+    duration = registry.histogram('phase_seconds', 'Phase time.', ['phase'],
+                                  buckets=[1, 10])
+    return registry, builds, size, duration
+
+
+def test_render():
+    """ Metrics are rendered in the Prometheus text format. """
+    registry, builds, size, duration = _create_registry()
+    builds.inc(repo='app')
+    builds.inc(repo='app')
+    size.set(1024, repo='app')
+    duration.observe(0.5, phase='clone')
+    duration.observe(5, phase='clone')
+
+    assert registry.render() == '\n'.join([
+        '# HELP builds_total Builds.',
+        '# TYPE builds_total counter',
+        'builds_total{repo="app"} 2',
+        '# HELP artifact_size_bytes Size.',
+        '# TYPE artifact_size_bytes gauge',
+        'artifact_size_bytes{repo="app"} 1024',
+        '# HELP phase_seconds Phase time.',
+        '# TYPE phase_seconds histogram',
+        'phase_seconds_bucket{phase="clone",le="1"} 1',
+        'phase_seconds_bucket{phase="clone",le="10"} 2',
+        'phase_seconds_bucket{phase="clone",le="+Inf"} 2',
+        'phase_seconds_sum{phase="clone"} 5.5',
+        'phase_seconds_count{phase="clone"} 2',
+    ]) + '\n'
+
+
+def test_label_values_are_escaped():
+    """ Quotes and backslashes in label values are escaped. """
+    registry, builds, _, _ = _create_registry()
+    builds.inc(repo='a"b\\c')
+    assert 'builds_total{repo="a\\"b\\\\c"} 1' in registry.render()
+
+
+def test_write_textfile_is_cumulative(tmpdir):
+    """
+    Counters and histograms written to a textfile continue from the values
+    written by previous runs, while gauges are replaced.
+    """
+    path = str(tmpdir.join('sideloader.prom'))
+
+    registry, builds, size, duration = _create_registry()
+    builds.inc(repo='app')
+    size.set(1024, repo='app')
+    duration.observe(5, phase='clone')
+    registry.write_textfile(path)
+
+    # A second process
+    registry, builds, size, duration = _create_registry()
+    builds.inc(repo='app')
+    size.set(2048, repo='app')
+    duration.observe(20, phase='clone')
+    registry.write_textfile(path)
+    # Writing again in the same process doesn't count the first run twice
+    registry.write_textfile(path)
+
+    samples = parse_samples(tmpdir.join('sideloader.prom').read())
+    assert samples[('builds_total', '{repo="app"}')] == 2
+    assert samples[('artifact_size_bytes', '{repo="app"}')] == 2048
+    assert samples[('phase_seconds_count', '{phase="clone"}')] == 2
+    assert samples[('phase_seconds_bucket', '{phase="clone",le="10"}')] == 1
+    assert samples[('phase_seconds_sum', '{phase="clone"}')] == 25
+
+
+def test_write_textfile_concurrent_processes(tmpdir):
+    """
+    Processes that write the same textfile in turn each add their own counts
+    rather than overwriting the counts of the others.
+    """
+    path = str(tmpdir.join('sideloader.prom'))
+    first, first_builds, _, _ = _create_registry()
+    second, second_builds, _, _ = _create_registry()
+
+    first_builds.inc(repo='app')
+    first.write_textfile(path)
+    second_builds.inc(repo='app')
+    second.write_textfile(path)
+    first_builds.inc(repo='app')
+    first.write_textfile(path)
+
+    samples = parse_samples(tmpdir.join('sideloader.prom').read())
+    assert samples[('builds_total', '{repo="app"}')] == 3
+    assert 'builds_total{repo="app"} 3' in first.render()
+
+
+def test_http_server():
+    """ The metrics can be served over HTTP. """
+    registry, builds, _, _ = _create_registry()
+    builds.inc(repo='app')
+    server = registry.start_http_server(0, '127.0.0.1')
+    try:
+        response = urllib2.urlopen(
+            'http://127.0.0.1:%d/metrics' % server.server_address[1])
+        assert 'builds_total{repo="app"} 1' in response.read()
+    finally:
+        server.shutdown()
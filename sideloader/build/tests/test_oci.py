@@ -0,0 +1,71 @@
+import json
+import os
+import tarfile
+
+from sideloader.build.oci import write_image, write_layer
+
+
+def _create_tree(tmpdir):
+    tree = tmpdir.mkdir('tree')
+    tree.join('app.py').write('print("hello")\n')
+    tree.mkdir('static').join('app.css').write('body {}\n')
+    return tree
+
+
+def test_write_layer_is_deterministic(tmpdir):
+    """
+    Layers made from the same files have the same digest, whatever the
+    timestamps of the files.
+    """
+    tree = _create_tree(tmpdir)
+    layer1 = write_layer([(str(tree), 'opt/app')], str(tmpdir))
+    os.utime(str(tree.join('app.py')), (0, 12345))
+    layer2 = write_layer([(str(tree), 'opt/app')], str(tmpdir))
+
+    assert layer1.digest == layer2.digest
+    assert layer1.diff_id == layer2.diff_id
+    assert layer1.size == os.path.getsize(layer1.path)
+
+    with tarfile.open(layer1.path) as tar:
+        members = tar.getmembers()
+    assert [member.name for member in members] == [
+        'opt', 'opt/app', 'opt/app/app.py', 'opt/app/static',
+        'opt/app/static/app.css']
+    assert all(member.uid == 0 and member.mtime == 0 for member in members)
+
+
+def test_write_image(tmpdir):
+    """
+    Images are written as an OCI layout whose manifest references the
+    layers, with a Docker manifest for `docker load`.
+    """
+    tree = _create_tree(tmpdir)
+    deps = write_layer([(str(tree), 'deps')], str(tmpdir))
+    app = write_layer([(str(tree), 'app')], str(tmpdir))
+    path = str(tmpdir.join('image.tar'))
+
+    digest = write_image(path, [deps, app], 'app:1.0', env=['A=1'],
+                         working_dir='/app')
+
+    with tarfile.open(path) as tar:
+        def read_json(name):
+            return json.load(tar.extractfile(name))
+
+        index = read_json('index.json')
+        assert index['manifests'][0]['digest'] == digest
+        assert (index['manifests'][0]['annotations']
+                ['org.opencontainers.image.ref.name'] == 'app:1.0')
+
+        manifest = read_json('blobs/' + digest.replace(':', '/'))
+        assert [layer['digest'] for layer in manifest['layers']] == [
+            deps.digest, app.digest]
+
+        config = read_json(
+            'blobs/' + manifest['config']['digest'].replace(':', '/'))
+        assert config['rootfs']['diff_ids'] == [deps.diff_id, app.diff_id]
+        assert config['config']['WorkingDir'] == '/app'
+
+        assert read_json('manifest.json')[0]['RepoTags'] == ['app:1.0']
+        assert read_json('oci-layout') == {'imageLayoutVersion': '1.0.0'}
+        layer_blob = tar.extractfile('blobs/' + app.digest.replace(':', '/'))
+        assert layer_blob.read() == open(app.path, 'rb').read()
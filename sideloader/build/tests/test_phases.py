@@ -0,0 +1,121 @@
+import threading
+
+import pytest
+
+from sideloader.build.phases import Phase, PhaseGraph, PhaseListener
+
+
+class RecordingListener(PhaseListener):
+    def __init__(self):
+        self.events = []
+
+    def phase_started(self, phase):
+        self.events.append(('started', phase.name))
+
+    def phase_finished(self, phase, duration):
+        self.events.append(('finished', phase.name))
+
+    def phase_failed(self, phase, duration, exc_info):
+        self.events.append(('failed', phase.name))
+
+
+def test_run_in_dependency_order():
+    """
+    Phases run after the phases that produce their inputs, and the duration
+    of each phase is returned.
+    """
+    calls = []
+    graph = PhaseGraph([
+        Phase('c', lambda: calls.append('c'), inputs=['b']),
+        Phase('b', lambda: calls.append('b'), inputs=['a'], outputs=['b']),
+        Phase('a', lambda: calls.append('a'), outputs=['a']),
+    ])
+
+    durations = graph.run(max_workers=1)
+
+    assert calls == ['a', 'b', 'c']
+    assert sorted(durations.keys()) == ['a', 'b', 'c']
+
+
+def test_independent_phases_overlap():
+    """
+    Phases that don't depend on each other run at the same time. Each phase
+    here waits for the other to start, so this would deadlock if they ran
+    one after another.
+    """
+    a_started = threading.Event()
+    b_started = threading.Event()
+
+    def a():
+        a_started.set()
+        assert b_started.wait(5)
+
+    def b():
+        b_started.set()
+        assert a_started.wait(5)
+
+    PhaseGraph([Phase('a', a), Phase('b', b)]).run(max_workers=2)
+
+
+def test_failure_stops_dependent_phases():
+    """
+    When a phase fails, phases that depend on it don't run, the listeners are
+    told and the original error is raised.
+    """
+    calls = []
+    listener = RecordingListener()
+
+    def fail():
+        raise RuntimeError('clone failed')
+
+    graph = PhaseGraph([
+        Phase('clone', fail, outputs=['repo']),
+        Phase('build', lambda: calls.append('build'), inputs=['repo']),
+    ])
+
+    with pytest.raises(RuntimeError) as error:
+        graph.run(listeners=[listener])
+
+    assert str(error.value) == 'clone failed'
+    assert calls == []
+    assert listener.events == [('started', 'clone'), ('failed', 'clone')]
+
+
+def test_available_resources():
+    """ Resources given as available satisfy inputs without a producer. """
+    calls = []
+    PhaseGraph([Phase('build', lambda: calls.append('build'),
+                      inputs=['repo'])], available=['repo']).run()
+    assert calls == ['build']
+
+
+def test_missing_input_fails():
+    """ A phase with an input that nothing produces is rejected. """
+    with pytest.raises(ValueError) as error:
+        PhaseGraph([Phase('build', lambda: None, inputs=['repo'])])
+
+    assert str(error.value) == (
+        "Phase 'build' requires 'repo' which no phase produces")
+
+
+def test_cycle_fails():
+    """ Phases with cyclic dependencies are rejected. """
+    with pytest.raises(ValueError) as error:
+        PhaseGraph([
+            Phase('a', lambda: None, inputs=['b'], outputs=['a']),
+            Phase('b', lambda: None, inputs=['a'], outputs=['b']),
+        ])
+
+    assert str(error.value) == 'Phases a, b have cyclic dependencies'
+
+
+def test_ordered():
+    """ The phases can be listed in a valid sequential order. """
+    graph = PhaseGraph([
+        Phase('package', lambda: None, inputs=['tree']),
+        Phase('copy', lambda: None, inputs=['build'], outputs=['tree']),
+        Phase('build', lambda: None, outputs=['build']),
+    ])
+
+    assert [phase.name for phase in graph.ordered()] == [
+        'build', 'copy', 'package']
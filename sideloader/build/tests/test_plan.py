@@ -0,0 +1,79 @@
+from sideloader.build.history import BuildHistory
+from sideloader.build.phases import Phase, PhaseGraph
+from sideloader.build.plan import BuildPlan, estimate_durations
+
+
+def _record(history, started, phases, cache_outcomes=()):
+    return history.record(
+        'build-%s' % started, 'app', 'develop', 'abc123', 'virtualenv', 'deb',
+        started, 100, 'succeeded', phases=phases,
+        cache_outcomes=cache_outcomes)
+
+
+def test_estimate_durations(tmpdir):
+    """
+    Phases with a cache are estimated separately for cache hits and misses.
+    """
+    history = BuildHistory(str(tmpdir.join('history.db')))
+    _record(history, 1000, [('clone', 4, 'succeeded'),
+                            ('pip', 60, 'succeeded')], [('venvs', 'miss')])
+    _record(history, 2000, [('clone', 6, 'succeeded'),
+                            ('pip', 2, 'succeeded')], [('venvs', 'hit')])
+    _record(history, 3000, [('clone', 5, 'succeeded'),
+                            ('pip', 4, 'succeeded')], [('venvs', 'hit')])
+    history.record('build-4', 'app', 'develop', 'abc123', 'virtualenv', 'deb',
+                   4000, 100, 'failed', phases=[('clone', 50, 'succeeded')])
+
+    durations = estimate_durations(history, 'app')
+    assert durations['clone'] == {'run': None, 'cached': None, 'any': 5}
+    assert durations['pip'] == {'run': 60, 'cached': 3.0, 'any': 4}
+
+
+def noop():
+    pass
+
+
+def _phases():
+    return PhaseGraph([
+        Phase('clone', noop, outputs=['repo']),
+        Phase('pip', noop, inputs=['repo'], outputs=['dependencies']),
+        Phase('build_dir', noop, inputs=['repo'], outputs=['build_dir']),
+        Phase('fpm', noop, inputs=['dependencies', 'build_dir'],
+              outputs=['package']),
+    ]).ordered()
+
+
+def test_build_plan():
+    """
+    Phases are estimated by their action and the build's duration is its
+    longest chain of dependent phases.
+    """
+    durations = {
+        'clone': {'run': None, 'cached': None, 'any': 5},
+        'pip': {'run': 60, 'cached': 3, 'any': 4},
+        'build_dir': {'run': None, 'cached': None, 'any': 10},
+    }
+    plan = BuildPlan('app', 'develop', 'abc123', _phases(),
+                     {'pip': ('cached', 'virtualenv hit')}, durations)
+
+    assert [(planned.name, planned.action, planned.estimate)
+            for planned in plan.phases] == [
+        ('clone', 'run', 5), ('pip', 'cached', 3), ('build_dir', 'run', 10),
+        ('fpm', 'run', None)]
+    assert plan.get_duration() == 15
+
+    rendered = plan.render()
+    assert 'Plan for app develop at abc123' in rendered
+    assert 'virtualenv hit' in rendered
+    assert 'Estimated duration: 15.0s' in rendered
+    assert 'No history for: fpm' in rendered
+
+
+def test_build_plan_skipped():
+    """ Skipped phases take no time. """
+    durations = {'pip': {'run': 60, 'cached': 3, 'any': 4}}
+    plan = BuildPlan('app', 'develop', None, _phases(),
+                     {'pip': ('skip', 'no pip dependencies')}, durations)
+
+    assert plan.phases[1].estimate == 0
+    assert plan.get_duration() == 0
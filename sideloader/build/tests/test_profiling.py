@@ -0,0 +1,38 @@
+import pstats
+
+from sideloader.build.phases import Phase, PhaseGraph
+from sideloader.build.profiling import Profiler
+from sideloader.build.utils import cmd
+
+
+class FakeBuild(object):
+    def install_dependencies(self):
+        cmd(['sleep', '0.1'])
+
+
+def test_profile_build(tmpdir):
+    """
+    Profiling a build writes a cProfile dump covering the phase threads,
+    collapsed stacks with subprocess frames and the subprocess time of each
+    method.
+    """
+    build = FakeBuild()
+    profiler = Profiler(str(tmpdir.join('profile')))
+    profiler.attributed_classes = (FakeBuild,)
+
+    graph = PhaseGraph([Phase('pip', build.install_dependencies)])
+    profiler.run(graph.run, 1, [profiler])
+
+    stats = pstats.Stats(str(tmpdir.join('profile', 'sideloader.prof')))
+    assert any(name == 'install_dependencies'
+               for _, _, name in stats.stats)
+
+    collapsed = tmpdir.join('profile', 'sideloader.collapsed').read()
+    assert any(line.startswith('phase-pip;') and
+               '[subprocess sleep] ' in line
+               for line in collapsed.splitlines())
+
+    report = tmpdir.join('profile', 'subprocesses.txt').read().splitlines()
+    assert report[1].split()[1:] == [
+        '1', 'FakeBuild.install_dependencies', 'sleep']
+    assert float(report[1].split()[0]) >= 0.1
@@ -0,0 +1,50 @@
+import json
+
+from sideloader.build.result import Artifact, BuildResult, PhaseTiming
+
+
+def _create_result(tmpdir):
+    package = tmpdir.join('app_0.1_amd64.deb')
+    package.write('deb')
+    manifest = tmpdir.join('app-manifest.txt')
+    manifest.write('manifest')
+    return BuildResult(
+        'build-1', 'app', 'develop', 'abc123', '0.1', 'virtualenv', 'deb',
+        1000, 60, [Artifact.from_path(str(package)),
+                   Artifact.from_path(str(manifest), 'manifest')],
+        [PhaseTiming('clone', 5, 'succeeded')],
+        [('wheels', 'hit'), ('wheels', 'miss'), ('wheels', 'hit')])
+
+
+def test_artifacts(tmpdir):
+    """ Artifacts are described by their size and digest. """
+    result = _create_result(tmpdir)
+
+    package = result.get_artifact()
+    assert package.path == str(tmpdir.join('app_0.1_amd64.deb'))
+    assert package.size == 3
+    assert package.sha256 == (
+        '9cfa1468c93fc18652e34a000f0c6614b0fa18f6f4887477ad9b0d36ca6a7eaa')
+    assert result.get_artifact('deps_package') is None
+    assert result.get_paths() == [package.path]
+
+
+def test_cache_summary(tmpdir):
+    """ Cache lookups are counted by cache and outcome. """
+    assert _create_result(tmpdir).get_cache_summary() == {
+        'wheels': {'hit': 2, 'miss': 1}}
+
+
+def test_round_trip(tmpdir):
+    """ Results survive serialisation, e.g. to share them between builds. """
+    result = _create_result(tmpdir)
+
+    loaded = BuildResult.from_dict(json.loads(json.dumps(result.to_dict())))
+    assert loaded.to_dict() == result.to_dict()
+    assert loaded.phases == [PhaseTiming('clone', 5, 'succeeded')]
+
+    relocated = result.relocate('/shared')
+    assert relocated.get_paths(('package', 'manifest')) == [
+        '/shared/app_0.1_amd64.deb', '/shared/app-manifest.txt']
+    assert relocated.get_artifact().sha256 == result.get_artifact().sha256
+    assert result.get_artifact().path.startswith(str(tmpdir))
@@ -1,10 +1,29 @@
+import io
+import json
 import os
+import shutil
+import subprocess
+import tarfile
+import threading
+import time
 
 import pytest
 
-from sideloader.build import Build, Deploy, GitRepo, Package, Workspace
+from sideloader.build import (
+    Build, BuildResult, Deploy, GitRepo, LocalSource, Package, Sideloader,
+    Workspace, metrics, watch)
+from sideloader.build.build_steps import BuildStep
+from sideloader.build.cache import BuildCache, LocalCache
+from sideloader.build.cancellation import BuildCancelled, PhaseTimeout
+from sideloader.build.checkpoint import CHECKPOINT_FILE
 from sideloader.build.config_files import ConfigFiles
-from sideloader.build.deploy_types import DeployType
+from sideloader.build.deploy_types import DeployType, VirtualEnv, Wheel
+from sideloader.build.history import BuildHistory
+from sideloader.build.manifest import Manifest
+from sideloader.build.phases import PhaseGraph
+from sideloader.build.venv_pool import VenvPool
+from sideloader.build.workspace_lock import (
+    LOCK_DIR, WorkspaceLease, is_leased)
 
 
 class TestGitRepo(object):
@@ -16,13 +35,192 @@ class TestGitRepo(object):
         assert repo.name == 'sideloader2'
         assert repo.branch == 'develop'
 
+    def test_lookup_revision(self):
+        """
+        The revision of a branch is looked up with ls-remote, preferring
+        branches to tags.
+        """
+        repo = GitRepo.from_github_url(
+            'https://github.com/praekelt/sideloader2.git', 'develop')
+        output = '\n'.join([
+            'aaa\trefs/tags/develop',
+            'bbb\trefs/heads/develop',
+        ])
+        cmds = []
+
+        def cmd(args):
+            cmds.append(args)
+            return output
+
+        assert repo.lookup_revision(cmd) == 'bbb'
+        assert cmds == [['git', 'ls-remote',
+                         'https://github.com/praekelt/sideloader2.git',
+                         'develop']]
+
+
+class TestLocalSource(object):
+    def _create_source_dir(self, tmpdir):
+        source_dir = tmpdir.mkdir('my-app')
+        source_dir.join('setup.py').write('setup()')
+        source_dir.mkdir('scripts').join('build.sh').write('make')
+        source_dir.mkdir('.git').join('HEAD').write('ref: refs/heads/develop')
+        return source_dir
+
+    def test_from_path(self, tmpdir):
+        """
+        A local source is named after the directory or tarball it comes from.
+        """
+        source_dir = self._create_source_dir(tmpdir)
+        assert LocalSource.from_path(str(source_dir), 'develop').name == (
+            'my-app')
+
+        tarball = tmpdir.join('my-app-1.0.tar.gz')
+        tarball.write('')
+        assert LocalSource.from_path(str(tarball), 'develop').name == (
+            'my-app-1.0')
+
+    def test_is_local(self, tmpdir):
+        """ Directories and tarballs are local sources, URLs are not. """
+        assert LocalSource.is_local(str(self._create_source_dir(tmpdir)))
+        assert not LocalSource.is_local(
+            'https://github.com/praekelt/sideloader2.git')
+
+    def test_fetch_directory(self, tmpdir):
+        """
+        When a local directory is fetched, its contents are staged into the
+        repo directory and its content hash is recorded as the revision.
+        """
+        source_dir = self._create_source_dir(tmpdir)
+        source = LocalSource.from_path(str(source_dir), 'develop')
+        repo_dir = tmpdir.join('workspace', 'my-app')
+        tmpdir.mkdir('workspace')
+
+        source.fetch(str(repo_dir), None)
+
+        assert repo_dir.join('setup.py').read() == 'setup()'
+        assert repo_dir.join('scripts', 'build.sh').read() == 'make'
+        assert len(source.revision) == 64
+
+        # The hash depends on the contents only, not on the .git directory
+        source_dir.join('.git', 'HEAD').write('ref: refs/heads/master')
+        other = LocalSource.from_path(str(source_dir), 'develop')
+        other.fetch(str(tmpdir.join('workspace', 'other')), None)
+        assert other.revision == source.revision
+
+        source_dir.join('setup.py').write('setup(name="changed")')
+        changed = LocalSource.from_path(str(source_dir), 'develop')
+        changed.fetch(str(tmpdir.join('workspace', 'changed')), None)
+        assert changed.revision != source.revision
+
+    def test_fetch_directory_without_reflinks_copies(
+            self, tmpdir, monkeypatch):
+        """
+        Where copy-on-write clones aren't supported, the source directory is
+        copied rather than linked, so that changing the staged files doesn't
+        change the source.
+        """
+        monkeypatch.setattr('sideloader.build.sideloader.reflink_tree',
+                            lambda src, dst: False)
+        source_dir = self._create_source_dir(tmpdir)
+        source = LocalSource.from_path(str(source_dir), 'develop')
+        repo_dir = tmpdir.join('workspace', 'my-app')
+        tmpdir.mkdir('workspace')
+        source.fetch(str(repo_dir), None)
+
+        with open(str(repo_dir.join('setup.py')), 'a') as staged:
+            staged.write('# built')
+        repo_dir.join('scripts', 'build.sh').chmod(0o755)
+
+        assert source_dir.join('setup.py').read() == 'setup()'
+        assert not os.access(str(source_dir.join('scripts', 'build.sh')),
+                             os.X_OK)
+
+        source_dir.join('setup.py').write('setup(name="changed")')
+        source.restage(str(repo_dir), ['setup.py'])
+        with open(str(repo_dir.join('setup.py')), 'a') as staged:
+            staged.write('# built')
+        assert source_dir.join('setup.py').read() == 'setup(name="changed")'
+
+    def test_fetch_tarball_refuses_escapes(self, tmpdir):
+        """
+        A tarball with a symlink out of the workspace followed by a file
+        inside the symlink is refused without writing anything outside.
+        """
+        outside = tmpdir.mkdir('outside')
+        tarball_path = str(tmpdir.join('evil.tar'))
+        with tarfile.open(tarball_path, 'w') as tarball:
+            link = tarfile.TarInfo('proj/link')
+            link.type = tarfile.SYMTYPE
+            link.linkname = str(outside)
+            tarball.addfile(link)
+            pwned = tarfile.TarInfo('proj/link/pwned.txt')
+            pwned.size = 1
+            tarball.addfile(pwned, io.BytesIO('x'))
+
+        tmpdir.mkdir('workspace')
+        source = LocalSource.from_path(tarball_path, 'develop')
+        with pytest.raises(ValueError):
+            source.fetch(str(tmpdir.join('workspace', 'evil')), None)
+        assert outside.listdir() == []
+
+    def test_restage(self, tmpdir):
+        """
+        Restaging updates the changed paths of a staged source directory and
+        its revision.
+        """
+        source_dir = self._create_source_dir(tmpdir)
+        source = LocalSource.from_path(str(source_dir), 'develop')
+        repo_dir = tmpdir.join('workspace', 'my-app')
+        tmpdir.mkdir('workspace')
+        source.fetch(str(repo_dir), None)
+        revision = source.revision
+
+        source_dir.join('setup.py').remove()
+        source_dir.join('scripts', 'build.sh').write('make all')
+        source_dir.ensure('app', 'views.py').write('views = 1')
+        source.restage(str(repo_dir), [
+            'setup.py', 'scripts/build.sh', 'app', 'app/views.py'])
+
+        assert not repo_dir.join('setup.py').check()
+        assert repo_dir.join('scripts', 'build.sh').read() == 'make all'
+        assert repo_dir.join('app', 'views.py').read() == 'views = 1'
+        assert source.revision != revision
+
+        source_dir.join('app').remove()
+        source.restage(str(repo_dir), ['app'])
+        assert not repo_dir.join('app').check()
+
+    def test_fetch_tarball(self, tmpdir):
+        """
+        When a tarball is fetched, it is extracted into the repo directory,
+        stripping a single top-level directory, and has the same revision as
+        the equivalent directory.
+        """
+        source_dir = self._create_source_dir(tmpdir)
+        tarball_path = str(tmpdir.join('my-app.tar.gz'))
+        with tarfile.open(tarball_path, 'w:gz') as tarball:
+            tarball.add(str(source_dir), 'my-app')
+
+        tmpdir.mkdir('workspace')
+        source = LocalSource.from_path(tarball_path, 'develop')
+        repo_dir = tmpdir.join('workspace', 'my-app')
+        source.fetch(str(repo_dir), None)
+
+        assert repo_dir.join('setup.py').read() == 'setup()'
+
+        dir_source = LocalSource.from_path(str(source_dir), 'develop')
+        dir_source.fetch(str(tmpdir.join('workspace', 'dir')), None)
+        assert source.revision == dir_source.revision
+
 
 class CommandLineTest(object):
     def setup_method(self, test_method):
         self.cmds = []
+        self.cmd_envs = []
 
     def cmd(self, args, *_args, **kwargs):
         self.cmds.append(args)
+        self.cmd_envs.append(kwargs.get('env'))
 
 
 class TestWorkspace(CommandLineTest):
@@ -91,7 +289,7 @@ class TestWorkspace(CommandLineTest):
     def test_create_clean_workspace_cleans_dir(self, tmpdir):
         """
         When a workspace is cleaned, the build, package and repo directories
-        should be deleted. Other files should remain.
+        and the checkpoints should be deleted. Other files should remain.
         """
         workspace = self._create_workspace(tmpdir)
 
@@ -101,6 +299,7 @@ class TestWorkspace(CommandLineTest):
         build_dir = ws_dir.mkdir('build')
         repo_dir = ws_dir.mkdir('sideloader2')
         other_file = ws_dir.ensure('test-file')
+        checkpoint_file = ws_dir.ensure('.sideloader-checkpoints')
 
         workspace.create_clean_workspace()
 
@@ -111,6 +310,7 @@ class TestWorkspace(CommandLineTest):
         assert not package_dir.check()
         assert not build_dir.check()
         assert not repo_dir.check()
+        assert not checkpoint_file.check()
 
         # Other files are not deleted
         assert other_file.check()
@@ -126,6 +326,20 @@ class TestWorkspace(CommandLineTest):
 
         assert tmpdir.join('test_id', 'build').check()
 
+    def test_make_build_dir_replaces_existing(self, tmpdir):
+        """
+        A build directory left by an earlier attempt at the build is replaced
+        with an empty one.
+        """
+        workspace = self._create_workspace(tmpdir)
+        workspace.create_clean_workspace()
+        workspace.make_build_dir()
+        tmpdir.join('test_id', 'build', 'partial').write('')
+
+        workspace.make_build_dir()
+
+        assert tmpdir.join('test_id', 'build').listdir() == []
+
     def test_make_package_dir(self, tmpdir):
         """
         When the package directory is made, the directory exists.
@@ -178,6 +392,132 @@ class TestWorkspace(CommandLineTest):
         assert error.value.errno == 2
         assert error.value.strerror == 'No such file or directory'
 
+    def _create_staged_workspace(self, tmpdir, cap=1024):
+        workspace = self._create_workspace(tmpdir.mkdir('base'))
+        workspace.staging_dir = str(tmpdir.mkdir('shm'))
+        workspace.staging_cap = cap
+        workspace.create_clean_workspace()
+        return workspace
+
+    def test_has_lost_staging(self, tmpdir):
+        """
+        Staged directories are lost if the staging area was cleared since
+        they were created.
+        """
+        workspace = self._create_staged_workspace(tmpdir)
+        workspace.make_build_dir()
+        assert not workspace.has_lost_staging()
+
+        tmpdir.join('shm').remove()
+        assert workspace.has_lost_staging()
+
+    def test_make_dirs_staged(self, tmpdir):
+        """
+        When in-memory staging is enabled, the build and package directories
+        are created in the staging directory and linked into the workspace.
+        """
+        workspace = self._create_staged_workspace(tmpdir)
+        workspace.make_build_dir()
+        workspace.make_package_dir()
+        workspace.make_install_dir()
+
+        build_dir = tmpdir.join('base', 'test_id', 'build')
+        assert build_dir.islink()
+        assert build_dir.realpath().dirpath().dirpath() == tmpdir.join('shm')
+        assert tmpdir.join('base', 'test_id', 'package').islink()
+        assert os.path.isdir(workspace.get_install_path())
+
+    def test_check_staging_falls_back_to_disk(self, tmpdir):
+        """
+        When the staged directories grow past the cap, they are moved to disk
+        with their contents.
+        """
+        workspace = self._create_staged_workspace(tmpdir, cap=1024)
+        workspace.make_build_dir()
+        workspace.make_package_dir()
+
+        small = tmpdir.join('base', 'test_id', 'build', 'small.txt')
+        small.write('x' * 100)
+        workspace.check_staging()
+        assert tmpdir.join('base', 'test_id', 'build').islink()
+
+        tmpdir.join('base', 'test_id', 'build', 'big.txt').write('x' * 2048)
+        workspace.check_staging()
+
+        build_dir = tmpdir.join('base', 'test_id', 'build')
+        assert not build_dir.islink()
+        assert build_dir.join('big.txt').size() == 2048
+        assert build_dir.join('small.txt').size() == 100
+        assert not tmpdir.join('base', 'test_id', 'package').islink()
+
+    def test_check_staging_falls_back_when_space_runs_low(self, tmpdir,
+                                                          monkeypatch):
+        """
+        When the staging directory no longer has room for the staged
+        directories to grow up to the cap, they are moved to disk before they
+        run out of space.
+        """
+        workspace = self._create_staged_workspace(tmpdir, cap=1024)
+        workspace.make_build_dir()
+        tmpdir.join('base', 'test_id', 'build', 'small.txt').write('x' * 100)
+
+        monkeypatch.setattr(workspace, '_get_staging_space', lambda: 512)
+        workspace.check_staging()
+
+        build_dir = tmpdir.join('base', 'test_id', 'build')
+        assert not build_dir.islink()
+        assert build_dir.join('small.txt').size() == 100
+        assert tmpdir.join('shm').listdir() == []
+
+    def test_unstage(self, tmpdir):
+        """
+        Unstaging moves the staged directories to disk, where a resumed build
+        finds them, and frees the staging area.
+        """
+        workspace = self._create_staged_workspace(tmpdir)
+        workspace.make_build_dir()
+        workspace.make_package_dir()
+        workspace.make_install_dir()
+        open(workspace.get_install_path('app.py'), 'w').close()
+
+        workspace.unstage()
+
+        assert not tmpdir.join('base', 'test_id', 'package').islink()
+        assert os.path.exists(workspace.get_install_path('app.py'))
+        assert not workspace.has_lost_staging()
+        assert tmpdir.join('shm').listdir() == []
+
+    def test_persist_staging(self, tmpdir):
+        """
+        When staging is persisted, the artifacts in the package directory are
+        moved to disk and the staging area is removed.
+        """
+        workspace = self._create_staged_workspace(tmpdir)
+        workspace.make_build_dir()
+        workspace.make_package_dir()
+        workspace.make_install_dir()
+        open(workspace.get_package_path('app_1.0_amd64.deb'), 'w').close()
+        open(workspace.get_install_path('app.py'), 'w').close()
+
+        workspace.persist_staging()
+
+        package_dir = tmpdir.join('base', 'test_id', 'package')
+        assert not package_dir.islink()
+        assert package_dir.listdir() == [package_dir.join('app_1.0_amd64.deb')]
+        assert tmpdir.join('shm').listdir() == []
+
+    def test_clean_workspace_removes_staged_dirs(self, tmpdir):
+        """ Cleaning the workspace removes the staged directories. """
+        workspace = self._create_staged_workspace(tmpdir)
+        workspace.make_build_dir()
+        staged_path = tmpdir.join('base', 'test_id', 'build').realpath()
+
+        workspace.clean_workspace()
+
+        assert not tmpdir.join('base', 'test_id', 'build').check(link=1)
+        assert not staged_path.check()
+        assert tmpdir.join('shm').listdir() == []
+
     def test_fetch_repo(self, tmpdir):
         """
         When the repo is fetched in the workspace, git is called with the
@@ -200,6 +540,19 @@ class TestWorkspace(CommandLineTest):
              'checkout', 'develop']
         )
 
+    def test_fetch_repo_pinned(self, tmpdir):
+        """
+        A repo pinned to a revision checks it out rather than the head of
+        the branch.
+        """
+        workspace = self._create_workspace(tmpdir)
+        workspace.repo.pinned_revision = 'a' * 40
+        workspace.fetch_repo()
+
+        assert self.cmds[1] == [
+            'git', '-C', str(tmpdir) + '/test_id/sideloader2', 'checkout',
+            'a' * 40]
+
 
 class TestDeploy(object):
     def setup_method(self, test_method):
@@ -294,25 +647,162 @@ class TestBuild(CommandLineTest):
              '--upgrade', 'pytest']
         )
 
+    def test_create_virtualenv_from_pool(self, tmpdir):
+        """
+        When there is a virtualenv pool, a new virtualenv is taken from the
+        pool instead of being created, and the pool is refilled.
+        """
+        build = self._create_build(tmpdir)
+        build.venv_pool = VenvPool(str(tmpdir.join('.venv-pool')), 1)
+        build.venv_pool._cmd = self.cmd
+        tmpdir.ensure('.venv-pool', 'default', 'blank', 'bin', 'python')
+
+        build.create_virtualenv()
+        for thread in threading.enumerate():
+            if thread.name == 'sideloader-venv-pool':
+                thread.join()
+
+        assert tmpdir.join('test_id', 've', 'bin', 'python').check()
+        assert not tmpdir.join('.venv-pool', 'default', 'blank').check()
+        [virtualenv, pip] = self.cmds
+        assert virtualenv[-1].startswith(str(tmpdir) + '/.venv-pool/default/')
+
+    def test_install_cached_dependencies(self, tmpdir):
+        """
+        When a build cache is used, dependencies are installed from wheels
+        that are built and cached on a miss, and the virtualenv is cached so
+        that the next build with the same dependencies can restore it.
+        """
+        def cmd(args, *_args, **kwargs):
+            self.cmds.append(args)
+            if args[1] == 'wheel':
+                open(os.path.join(args[3], args[4] + '.whl'), 'w').close()
+            return '2.7.18'
+
+        build = self._create_build(tmpdir)
+        build._cmd = cmd
+        build.cache = BuildCache(LocalCache(str(tmpdir)))
+        tmpdir.ensure('test_id', 've', 'bin', 'python')
+
+        build.install_dependencies()
+
+        pip = str(tmpdir) + '/test_id/ve/bin/pip'
+        assert [args[:2] for args in self.cmds] == [
+            [str(tmpdir) + '/test_id/ve/bin/python', '-c'],
+            [pip, 'wheel'], [pip, 'install'],
+            [pip, 'wheel'], [pip, 'install'],
+        ]
+        assert self.cmds[2][2:5] == ['--upgrade', '--no-index', '--find-links']
+        assert self.cmds[2][-1] == 'django'
+        assert len(tmpdir.join('.cache', 'wheels').listdir()) == 2
+        assert len(tmpdir.join('.cache', 'venvs').listdir()) == 1
+
+        # A second build with the same dependencies restores the virtualenv
+        self.cmds = []
+        tmpdir.join('test_id', 've').remove()
+        build.install_dependencies()
+
+        assert len(self.cmds) == 1
+        assert tmpdir.join('test_id', 've', 'bin', 'python').check()
+
+    def test_run_build_steps(self, tmpdir):
+        """
+        Build steps run on a cache miss and have their outputs restored on a
+        hit, until their inputs change.
+        """
+        def cmd(args, *_args, **kwargs):
+            self.cmds.append(args)
+            tmpdir.ensure('test_id', 'build', 'static', 'app.js')
+
+        build = self._create_build(tmpdir)
+        build._cmd = cmd
+        build.cache = BuildCache(LocalCache(str(tmpdir)))
+        build.deploy = build.deploy.override(build_steps=[
+            BuildStep('assets', 'npm run build', ['assets'], ['static'])])
+        repo = tmpdir.ensure('test_id', 'sideloader2', dir=True)
+        repo.ensure('assets', 'app.js').write('app()')
+        build.workspace.make_build_dir()
+
+        build.run_build_steps()
+        assert self.cmds == [['sh', '-c', 'npm run build']]
+
+        # The outputs are restored while the inputs don't change
+        tmpdir.join('test_id', 'build').remove()
+        build.workspace.make_build_dir()
+        build.run_build_steps()
+        assert len(self.cmds) == 1
+        assert tmpdir.join('test_id', 'build', 'static', 'app.js').check()
+
+        repo.join('assets', 'app.js').write('changed()')
+        build.run_build_steps()
+        assert len(self.cmds) == 2
+
+    def test_run_build_steps_missing_output(self, tmpdir):
+        """ Build steps fail if they don't create their outputs. """
+        build = self._create_build(tmpdir)
+        build.deploy = build.deploy.override(build_steps=[
+            BuildStep('assets', 'npm run build', [], ['static'])])
+        build.workspace.make_build_dir()
+
+        with pytest.raises(ValueError):
+            build.run_build_steps()
+
+    def test_plan_phases(self, tmpdir):
+        """
+        Planning reports the phases that would be skipped or served from the
+        caches without running or caching anything.
+        """
+        def cmd(args, *_args, **kwargs):
+            self.cmds.append(args)
+            return '2.7.18 (default)'
+
+        build = self._create_build(tmpdir)
+        build._cmd = cmd
+        build.cache = BuildCache(LocalCache(str(tmpdir)))
+        build.deploy = build.deploy.override(build_steps=[
+            BuildStep('assets', 'npm run build', ['assets'], ['static'])])
+        repo = tmpdir.ensure('test_id', 'sideloader2', dir=True)
+        repo.ensure('assets', 'app.js').write('app()')
+
+        actions = build.plan_phases(str(repo))
+        assert actions == {
+            'pip': ('run', 'new virtualenv, the cache key is not known yet'),
+            'build_steps': ('run', 'no cached outputs for assets'),
+        }
+
+        blob_path = build.cache.new_blob_path()
+        open(blob_path, 'w').close()
+        build.cache.put('steps', build.deploy.build_steps[0].get_cache_key(
+            str(repo)), blob_path)
+        tmpdir.ensure('test_id', 've', 'bin', 'python')
+        actions = build.plan_phases(str(repo))
+        assert actions['virtualenv'] == ('reuse', 'the workspace has one')
+        assert actions['pip'] == ('run', '0 of 2 wheels cached')
+        assert actions['build_steps'] == ('cached', 'inputs unchanged')
+        assert build.cache.outcomes == []
+        assert self.cmds == [[str(tmpdir.join('test_id', 've', 'bin',
+                                              'python')),
+                              '-c', 'import sys; print(sys.version)']]
+
     def test_put_env_variables(self, tmpdir):
         """
         When placing the enviornment variables, all the variables are set
-        correctly.
+        correctly in the build environment, but not in this process.
         """
         build = self._create_build(tmpdir)
+        environ = dict(os.environ)
         build.put_env_variables()
 
-        assert os.getenv('VENV') == str(tmpdir) + '/test_id/ve'
-        assert (os.getenv('PIP') ==
-                str(tmpdir) + '/test_id/ve/bin/pip')
-        assert os.getenv('REPO') == 'sideloader2'
-        assert os.getenv('BRANCH') == 'develop'
-        assert os.getenv('WORKSPACE') == str(tmpdir) + '/test_id'
-        assert (os.getenv('BUILDDIR') ==
-                str(tmpdir) + '/test_id/build')
-        assert (os.getenv('INSTALLDIR') ==
-                str(tmpdir) + '/test_id/package/opt')
-        assert os.getenv('NAME') == 'test_deploy'
+        env = build.build_env
+        assert env['VENV'] == str(tmpdir) + '/test_id/ve'
+        assert env['PIP'] == str(tmpdir) + '/test_id/ve/bin/pip'
+        assert env['REPO'] == 'sideloader2'
+        assert env['BRANCH'] == 'develop'
+        assert env['WORKSPACE'] == str(tmpdir) + '/test_id'
+        assert env['BUILDDIR'] == str(tmpdir) + '/test_id/build'
+        assert env['INSTALLDIR'] == str(tmpdir) + '/test_id/package/opt'
+        assert env['NAME'] == 'test_deploy'
+        assert dict(os.environ) == environ
 
     def test_put_env_variables_path(self, tmpdir):
         """
@@ -322,15 +812,45 @@ class TestBuild(CommandLineTest):
         build = self._create_build(tmpdir)
         build.put_env_variables()
 
-        assert os.getenv('PATH').startswith(
+        assert build.build_env['PATH'].startswith(
             str(tmpdir) + '/test_id/ve/bin')
 
+    def test_phases(self, tmpdir):
+        """
+        The build phases form a valid graph on top of the workspace and
+        deploy, with the build virtualenv independent of the repo and the
+        config files independent of the freeze.
+        """
+        build = self._create_build(tmpdir)
+        graph = PhaseGraph(build.workspace.phases() + build.phases(),
+                           available=['deploy'])
+
+        phases = dict((phase.name, phase) for phase in graph.phases)
+        assert 'repo' not in phases['virtualenv'].inputs
+        assert 'requirements' not in phases['copy_config'].inputs
+
+    def test_phases_wheel(self, tmpdir):
+        """
+        Wheel deploys install a wheel into the package tree instead of copying
+        the build directory and freezing the build virtualenv.
+        """
+        build = self._create_build(tmpdir)
+        build.deploy_type = Wheel()
+        graph = PhaseGraph(build.workspace.phases() + build.phases(),
+                           available=['deploy'])
+
+        phases = dict((phase.name, phase) for phase in graph.phases)
+        assert 'copy_build' not in phases
+        assert 'freeze' not in phases
+        assert phases['wheel'].outputs == ('install_tree', 'requirements')
+
     def test_run_buildscript(self, tmpdir):
         """
         When running the buildscript, the buildscript is first made executable
         and then executed.
         """
         build = self._create_build(tmpdir)
+        build.put_env_variables()
 
         build.run_buildscript()
 
@@ -338,6 +858,7 @@ class TestBuild(CommandLineTest):
                                   'build.sh')
         assert self.cmds[0] == ['chmod', 'a+x', buildscript]
         assert self.cmds[1] == [buildscript]
+        assert self.cmd_envs[1] == build.build_env
 
     def test_run_buildscript_no_file(self, tmpdir):
         """
@@ -373,6 +894,67 @@ class TestBuild(CommandLineTest):
         assert install_dir.join('fake', 'test1.txt').check()
         assert install_dir.join('fake', 'dummy', 'test2.txt').check()
 
+    def test_sync_install_tree(self, tmpdir):
+        """
+        Syncing a rebuilt build directory only copies the changed files into
+        the install directory and removes the files that are gone.
+        """
+        build = self._create_build(tmpdir)
+        build.workspace.make_build_dir()
+        build.workspace.make_package_dir()
+        build_dir = tmpdir.join('test_id', 'build')
+        build_dir.ensure('app', 'views.txt').write('views')
+        build_dir.ensure('app', 'models.txt').write('models')
+        build_dir.ensure('app', 'old.txt').write('old')
+        build.copy_build()
+        old_files = set(['app/views.txt', 'app/models.txt', 'app/old.txt'])
+
+        build_dir.remove()
+        build_dir.ensure('app', 'views.txt').write('views')
+        build_dir.ensure('app', 'models.txt').write('changed')
+        build_dir.ensure('static', 'app.css').write('css')
+        synced = build.sync_install_tree(old_files)
+
+        install_dir = tmpdir.join('test_id', 'package', 'opt')
+        assert synced == [
+            str(install_dir.join('app', 'old.txt')),
+            str(install_dir.join('app', 'models.txt')),
+            str(install_dir.join('static', 'app.css'))]
+        assert install_dir.join('app', 'models.txt').read() == 'changed'
+        assert not install_dir.join('app', 'old.txt').check()
+        assert sorted(entry.path for entry in build.manifest) == [
+            'opt/app/models.txt', 'opt/app/views.txt', 'opt/static/app.css']
+
+    def test_slim_install_tree(self, tmpdir):
+        """
+        Slimming removes the files excluded by the deploy from the install
+        directory and the manifest.
+        """
+        build = self._create_build(tmpdir)
+        build.deploy = build.deploy.override(exclude=['static/src'])
+        build.workspace.make_build_dir()
+        build.workspace.make_package_dir()
+        build_dir = tmpdir.join('test_id', 'build')
+        build_dir.ensure('static', 'src', 'app.scss')
+        build_dir.ensure('static', 'app.css')
+        build_dir.ensure('tests', 'test_app.py')
+        build.copy_build()
+
+        build.slim_install_tree()
+
+        install_dir = tmpdir.join('test_id', 'package', 'opt')
+        assert not install_dir.join('static', 'src').check()
+        assert install_dir.join('tests', 'test_app.py').check()
+        assert sorted(entry.path for entry in build.manifest) == [
+            'opt/static/app.css', 'opt/tests/test_app.py']
+
+        # Slim deploys also leave out the usual files
+        build.deploy = build.deploy.override(slim=True)
+        build.slim_install_tree()
+        assert not install_dir.join('tests').check()
+        assert [entry.path for entry in build.manifest] == [
+            'opt/static/app.css']
+
     def test_copy_config_files(self, tmpdir):
         """
         When the config files are copied, the correct config directory is
@@ -400,6 +982,25 @@ class TestBuild(CommandLineTest):
         assert package_path.join('etc', 'supervisor', 'conf.d',
                                  'my-app.conf').check()
 
+    def test_normalize_freeze_output(self, tmpdir):
+        """
+        In reproducible builds, the frozen requirements are sorted and don't
+        contain build-time paths.
+        """
+        build = self._create_build(tmpdir)
+        build.source_date_epoch = 0
+
+        ws = str(tmpdir) + '/test_id'
+        output = build.normalize_freeze_output(
+            'six==1.10.0\n'
+            '-e git+file://%s/sideloader2@abc#egg=app\n'
+            'lib @ file://%s/package/opt/lib\n' % (ws, ws))
+
+        assert output == (
+            '-e git+file://@WORKSPACE@/sideloader2@abc#egg=app\n'
+            'lib @ file:///opt/lib\n'
+            'six==1.10.0\n')
+
     def test_generate_postinstall(self, tmpdir):
         """
         When the postinstall script is generated, its content is correct.
@@ -433,6 +1034,18 @@ this is a test
 
 """.format(tmpdir=str(tmpdir))
 
+    def test_generate_postinstall_reproducible(self, tmpdir):
+        """
+        Reproducible builds give the postinstall script the same INSTALLDIR
+        as other builds.
+        """
+        build = self._create_build(tmpdir)
+        build.source_date_epoch = 0
+
+        postinstall_script = build.generate_postinstall_script()
+        assert 'INSTALLDIR=%s/test_id/package/opt\n' % (
+            str(tmpdir),) in postinstall_script
+
 
 class TestPackage(CommandLineTest):
 
@@ -453,6 +1066,41 @@ class TestPackage(CommandLineTest):
         package._cmd = self.cmd
         return package
 
+    def test_build_image(self, tmpdir):
+        """
+        OCI images have the relocated build virtualenv in one layer and the
+        package tree in another, and are listed as the package's artifacts.
+        """
+        package = self._create_package(tmpdir)
+        package.target = 'oci'
+        package.deploy_type = VirtualEnv()
+        workspace = package.workspace
+
+        build_venv = workspace.get_path('ve')
+        os.makedirs(os.path.join(build_venv, 'bin'))
+        with open(os.path.join(build_venv, 'bin', 'pip'), 'w') as pip:
+            pip.write('#!%s/bin/python\n' % build_venv)
+        workspace.make_install_dir()
+        open(workspace.get_install_path('app.py'), 'w').close()
+        # A leftover artifact from a previous run
+        open(workspace.get_package_path('old.deb'), 'w').close()
+
+        package.build_image()
+
+        image_path = workspace.get_package_path('test_deploy_1.0.oci.tar')
+        assert package.list_artifacts() == [image_path]
+        with tarfile.open(image_path) as tar:
+            docker_manifest = json.load(tar.extractfile('manifest.json'))[0]
+            deps, app = [
+                tarfile.open(
+                    fileobj=io.BytesIO(tar.extractfile(name).read()))
+                for name in docker_manifest['Layers']]
+
+        assert deps.extractfile('opt/python/bin/pip').read() == (
+            '#!/opt/python/bin/python\n')
+        assert 'opt/app.py' in app.getnames()
+        assert 'old.deb' not in app.getnames()
+
     def test_run_fpm(self, tmpdir):
         """
         When running the fpm package command, the command is properly
@@ -482,6 +1130,75 @@ class TestPackage(CommandLineTest):
             ]
         )
 
+    def test_run_fpm_reproducible(self, tmpdir):
+        """
+        When building a reproducible package, ownership and timestamps are
+        fixed and the files are passed to fpm in sorted order.
+        """
+        package = self._create_package(tmpdir)
+        package.deploy = package.deploy.override(user='')
+        package.source_date_epoch = 1500000000
+
+        open(package.workspace.get_package_path('b.txt'), 'a').close()
+        open(package.workspace.get_package_path('a.txt'), 'a').close()
+
+        package.run_fpm()
+
+        assert self.cmds[0][-8:] == [
+            '--deb-user', 'root',
+            '--deb-group', 'root',
+            '--source-date-epoch-default', '1500000000',
+            'a.txt', 'b.txt'
+        ]
+
+    def test_build_deps_package(self, tmpdir):
+        """
+        The dependencies package is versioned by the frozen requirements, is
+        depended on by the app package and is reused from the cache while
+        the requirements don't change.
+        """
+        def fpm_cmd(args, *_args, **kwargs):
+            self.cmds.append(args)
+            if args[0] == 'fpm' and args[4].endswith('.deb'):
+                open(args[4], 'w').close()
+
+        package = self._create_package(tmpdir)
+        package._cmd = fpm_cmd
+        package.deploy_type = VirtualEnv()
+        package.split_deps = True
+        package.cache = BuildCache(LocalCache(str(tmpdir)))
+        workspace = package.workspace
+
+        os.makedirs(workspace.get_path('ve', 'bin'))
+        workspace.make_install_dir()
+        requirements_path = workspace.get_install_path(
+            'test_deploy-requirements.pip')
+        with open(requirements_path, 'w') as requirements_file:
+            requirements_file.write('Django==1.8\n')
+
+        package.build_deps_package()
+        package.run_fpm()
+
+        version = package.deps_version
+        assert version.startswith('0.') and len(version) == 18
+        deps_cmd, app_cmd = self.cmds
+        assert deps_cmd[:5] == [
+            'fpm', '-C', workspace.get_path('deps-package'),
+            '-p', workspace.get_artifact_path(
+                'test_deploy-deps_%s_amd64.deb' % version)]
+        assert deps_cmd[-1] == 'opt'
+        assert 'test_deploy-deps (= %s)' % version in app_cmd
+        # The dependencies package is built outside the app package's tree
+        assert app_cmd[-3:] == ['--deb-user', 'ubuntu', 'opt']
+        assert package.get_package_paths() == []
+
+        # The same requirements reuse the cached package
+        os.remove(package.deps_package_path)
+        self.cmds = []
+        package.build_deps_package()
+        assert self.cmds == []
+        assert os.path.exists(package.deps_package_path)
+
     def test_sign_debs(self, tmpdir):
         """
         When signing .deb files, only the .deb files in the package directory
@@ -505,6 +1222,32 @@ class TestPackage(CommandLineTest):
             ]
         )
 
+    def test_sign_debs_built_by_fpm(self, tmpdir):
+        """
+        Once fpm has run, only the packages it built are signed and they are
+        the run's artifacts.
+        """
+        package = self._create_package(tmpdir)
+        package_dir = tmpdir.join('test_id', 'package')
+        package_dir.ensure('opt', 'app.py')
+        package_dir.join('old_0.9_amd64.deb').write('old')
+
+        def fpm(args, *_args, **kwargs):
+            self.cmds.append(args)
+            package_dir.join('test_deploy_1.0_amd64.deb').write('deb')
+
+        package._cmd = fpm
+        package.gpg_key = 'GPGKEY23'
+        package.run_fpm()
+        package.sign_debs()
+
+        deb = str(package_dir.join('test_deploy_1.0_amd64.deb'))
+        assert self.cmds[1] == [
+            'dpkg-sig', '-k', 'GPGKEY23', '--sign', 'builder', deb]
+        assert [(artifact.path, artifact.kind, artifact.size)
+                for artifact in package.get_build_artifacts()] == [
+            (deb, 'package', 3)]
+
     def test_sign_debs_skipped_if_no_gpg_key(self, tmpdir):
         """
         When trying to sign the .deb files and no GPG key has been configured
@@ -519,3 +1262,424 @@ class TestPackage(CommandLineTest):
         package.sign_debs()
 
         assert len(self.cmds) == 0
+
+
+class FakeWatcher(object):
+    """ Makes each of a list of changes to the source as it is waited on. """
+
+    def __init__(self, root, changes):
+        self.root = root
+        self.changes = list(changes)
+        self.closed = False
+
+    def wait(self):
+        if not self.changes:
+            # Stop watching the way a user would
+            raise KeyboardInterrupt()
+        change = self.changes.pop(0)
+        for relpath, content in change.items():
+            self.root.join(relpath).write(content)
+        return sorted(change)
+
+    def close(self):
+        self.closed = True
+
+
+class TestSideloader(CommandLineTest):
+
+    def setup_method(self, test_method):
+        super(TestSideloader, self).setup_method(test_method)
+        # A function of the command's args that says whether it should fail
+        self.fail_cmd = None
+        # The Builds created by runs, to inspect their state
+        self.builds = []
+
+    def fake_cmd(self, args, *_args, **kwargs):
+        """
+        Record a command and fake the results of the ones the build relies
+        on: the buildscript copies the app from the source into the build
+        directory, pip freezes and fpm packages.
+        """
+        self.cmd(args, **kwargs)
+        if self.fail_cmd is not None and self.fail_cmd(args):
+            raise subprocess.CalledProcessError(1, args)
+
+        if args[0].endswith('build.sh'):
+            shutil.copy(os.path.join(os.path.dirname(args[0]), 'app.py'),
+                        kwargs['env']['BUILDDIR'])
+        elif args[1:] == ['freeze']:
+            return 'Django==1.8\n'
+        elif args[0] == 'fpm':
+            name = '%s_%s_amd64.deb' % (args[args.index('-n') + 1],
+                                        args[args.index('-v') + 1])
+            open(os.path.join(args[4], name), 'w').close()
+        return ''
+
+    def _create_sideloader(self, tmpdir, monkeypatch, config=''):
+        source_dir = tmpdir.mkdir('my-app')
+        source_dir.join('.deploy.yaml').write(
+            'name: my-app\nbuildscript: build.sh\n')
+        source_dir.join('build.sh').write('#!/bin/sh\n')
+        source_dir.join('app.py').write('print("hello")\n')
+        config_path = tmpdir.join('config.yaml')
+        config_path.write('install_location: /opt\nworkspace_base: %s\n%s' % (
+            tmpdir.join('workspaces'), config))
+
+        def fake_cmd(obj, *args, **kwargs):
+            return self.fake_cmd(*args, **kwargs)
+
+        for cls in (Workspace, Build, Package):
+            monkeypatch.setattr(cls, '_cmd', fake_cmd)
+
+        create_build = Sideloader._create_build
+
+        def record_build(sideloader, *args):
+            build = create_build(sideloader, *args)
+            self.builds.append(build)
+            return build
+
+        monkeypatch.setattr(Sideloader, '_create_build', record_build)
+        return Sideloader(str(config_path), str(source_dir))
+
+    def test_run(self, tmpdir, monkeypatch):
+        """
+        A run builds and packages the source and describes what it built in
+        a BuildResult.
+        """
+        sideloader = self._create_sideloader(tmpdir, monkeypatch)
+        workspace = sideloader._create_workspace()
+
+        result = sideloader.run(build_num=7)
+
+        assert isinstance(result, BuildResult)
+        assert (result.repo, result.branch, result.version,
+                result.deploy_type, result.target) == (
+            'my-app', 'develop', '0.7', 'virtualenv', 'deb')
+        assert result.revision == sideloader.repo.lookup_revision(None)
+        assert [(artifact.path, artifact.kind)
+                for artifact in result.artifacts] == [
+            (workspace.get_package_path('my-app_0.7_amd64.deb'), 'package'),
+            (workspace.get_package_path('my-app-manifest.txt'), 'manifest')]
+        phases = [timing.name for timing in result.phases]
+        assert 'buildscript' in phases and phases[-1] == 'persist'
+        assert result.duration >= 0 and not result.coalesced
+
+    def test_resume(self, tmpdir, monkeypatch):
+        """
+        A build that failed late is resumed without running the buildscript
+        again, with the environment and the manifest of the skipped phases
+        restored.
+        """
+        sideloader = self._create_sideloader(tmpdir, monkeypatch)
+        workspace = sideloader._create_workspace()
+
+        def is_bytecode(args):
+            return args[:2] == [workspace.get_path('ve', 'bin', 'python'),
+                                '-c']
+
+        self.fail_cmd = is_bytecode
+        with pytest.raises(subprocess.CalledProcessError):
+            sideloader.run()
+
+        self.fail_cmd = None
+        self.cmds = []
+        result = sideloader.run(resume=True)
+
+        assert isinstance(result, BuildResult)
+        assert [args for args in self.cmds
+                if args[0].endswith('build.sh')] == []
+        assert is_bytecode(self.cmds[0])
+        build = self.builds[-1]
+        assert build.build_env['BUILDDIR'] == workspace.get_build_path()
+        assert build.build_env['NAME'] == 'my-app'
+
+        manifest_path = workspace.get_package_path('my-app-manifest.txt')
+        assert [artifact.path for artifact in result.artifacts] == [
+            workspace.get_package_path('my-app_0.1_amd64.deb'),
+            manifest_path]
+        with open(manifest_path) as manifest_file:
+            paths = [line.split(' ', 3)[3]
+                     for line in manifest_file.read().splitlines()]
+        assert paths == ['opt/app.py', 'opt/my-app-requirements.pip']
+
+    def test_resume_after_buildscript_failure(self, tmpdir, monkeypatch):
+        """
+        If the buildscript has to run again, the build directory is created
+        again rather than keeping what the failed attempt wrote to it.
+        """
+        sideloader = self._create_sideloader(tmpdir, monkeypatch)
+        workspace = sideloader._create_workspace()
+
+        def is_buildscript(args):
+            return args[0].endswith('build.sh')
+
+        self.fail_cmd = is_buildscript
+        with pytest.raises(subprocess.CalledProcessError):
+            sideloader.run()
+        open(workspace.get_build_path('partial.py'), 'w').close()
+
+        self.fail_cmd = None
+        self.cmds = []
+        sideloader.run(resume=True)
+
+        assert len([args for args in self.cmds if is_buildscript(args)]) == 1
+        assert not os.path.exists(workspace.get_build_path('partial.py'))
+        assert sorted(entry.path for entry in self.builds[-1].manifest) == [
+            'opt/app.py', 'opt/my-app-requirements.pip']
+
+    def test_resume_after_config_change(self, tmpdir, monkeypatch):
+        """
+        A build isn't resumed from the checkpoints of a build with a
+        different config.
+        """
+        sideloader = self._create_sideloader(tmpdir, monkeypatch)
+        workspace = sideloader._create_workspace()
+
+        def is_bytecode(args):
+            return args[:2] == [workspace.get_path('ve', 'bin', 'python'),
+                                '-c']
+
+        self.fail_cmd = is_bytecode
+        with pytest.raises(subprocess.CalledProcessError):
+            sideloader.run()
+
+        self.fail_cmd = None
+        self.cmds = []
+        sideloader.config.gpg_key = 'other-key'
+        sideloader.run(resume=True)
+
+        assert [args for args in self.cmds if args[0].endswith('build.sh')]
+
+    def test_split_deps_needs_cache(self, tmpdir, monkeypatch):
+        """
+        Without a cache to reuse it from, a dependencies package would be
+        rebuilt with different bytes under the same version, so splitting
+        out the dependencies needs the cache.
+        """
+        sideloader = self._create_sideloader(tmpdir, monkeypatch)
+
+        with pytest.raises(ValueError):
+            sideloader.run(split_deps=True)
+        assert self.cmds == []
+
+    def test_failed_run_unstages(self, tmpdir, monkeypatch):
+        """
+        A failed run moves its staged directories to disk, freeing the
+        staging area and keeping them to resume from.
+        """
+        shm = tmpdir.mkdir('shm')
+        sideloader = self._create_sideloader(
+            tmpdir, monkeypatch,
+            'staging_dir: %s\nstaging_size_cap: 1M\n' % shm)
+        workspace = sideloader._create_workspace()
+
+        self.fail_cmd = lambda args: args[0] == 'fpm'
+        with pytest.raises(subprocess.CalledProcessError):
+            sideloader.run()
+
+        assert shm.listdir() == []
+        assert not os.path.islink(workspace.get_build_path())
+        assert os.path.exists(workspace.get_build_path('app.py'))
+
+    def test_run_with_python(self, tmpdir, monkeypatch):
+        """
+        The configured interpreter is used for the build's virtualenv and
+        for the pool it comes from.
+        """
+        sideloader = self._create_sideloader(
+            tmpdir, monkeypatch,
+            'python: /usr/bin/python3\nvenv_pool_size: 1\n')
+        workspace = sideloader._create_workspace()
+        monkeypatch.setattr(VenvPool, 'take', lambda self, dst: False)
+        monkeypatch.setattr(VenvPool, 'refill_in_background',
+                            lambda self: None)
+
+        sideloader.run()
+
+        assert ['virtualenv', '-p', '/usr/bin/python3',
+                workspace.get_path('ve')] in self.cmds
+        assert self.builds[-1].venv_pool.python == '/usr/bin/python3'
+
+    def test_run_holds_lease(self, tmpdir, monkeypatch):
+        """
+        A run holds the lease on its workspace while it builds and gives it
+        up afterwards.
+        """
+        sideloader = self._create_sideloader(tmpdir, monkeypatch)
+        workspace_base = sideloader.config.workspace_base
+        leased = []
+
+        def check_lease(args):
+            leased.append(is_leased(workspace_base, 'my-app'))
+            return False
+
+        self.fail_cmd = check_lease
+        sideloader.run()
+
+        assert leased and all(leased)
+        assert not is_leased(workspace_base, 'my-app')
+
+    def test_cancel_while_waiting_for_lease(self, tmpdir, monkeypatch):
+        """
+        A run that is waiting for another run's lease can be cancelled, and
+        leaves the other run's workspace alone.
+        """
+        sideloader = self._create_sideloader(tmpdir, monkeypatch)
+        workspace_base = sideloader.config.workspace_base
+        lease = WorkspaceLease(workspace_base, 'my-app')
+        lease.acquire()
+        in_use = tmpdir.join('workspaces', 'my-app', 'in-use').ensure()
+
+        errors = []
+
+        def run():
+            try:
+                sideloader.run()
+            except BuildCancelled as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        queue = os.path.join(workspace_base, LOCK_DIR, 'my-app.queue')
+        while len(os.listdir(queue)) < 2:
+            time.sleep(0.01)
+        sideloader.cancel('Received signal 2')
+        thread.join()
+
+        assert [str(e) for e in errors] == ['Received signal 2']
+        assert self.cmds == []
+        assert in_use.check()
+        lease.release()
+
+    def test_run_coalesced(self, tmpdir, monkeypatch):
+        """
+        A coalesced run builds with the arguments it was given and shares the
+        artifacts.
+        """
+        sideloader = self._create_sideloader(tmpdir, monkeypatch)
+
+        result = sideloader.run_coalesced(build_num=3, name='other-app')
+
+        assert not result.coalesced
+        assert result.version == '0.3'
+        assert self.builds[-1].deploy.name == 'other-app'
+        assert '.cache/coalesced/' in result.artifacts[0].path
+
+    def test_cancel_cleans_up_workspace(self, tmpdir, monkeypatch):
+        """
+        Cancelling a run stops it in the middle of its phases and cleans up
+        its workspace.
+        """
+        sideloader = self._create_sideloader(tmpdir, monkeypatch)
+        workspace = sideloader._create_workspace()
+
+        def cancel_in_buildscript(args):
+            if args[0].endswith('build.sh'):
+                sideloader.cancel('Received signal 15')
+                # What cmd does once the cancel token has killed the command
+                sideloader.cancel_token.check()
+            return False
+
+        self.fail_cmd = cancel_in_buildscript
+        with pytest.raises(BuildCancelled) as excinfo:
+            sideloader.run()
+
+        assert str(excinfo.value) == 'Received signal 15'
+        assert not [args for args in self.cmds if args[0] == 'fpm']
+        for path in (workspace.get_repo_path(), workspace.get_build_path(),
+                     workspace.get_package_path(),
+                     workspace.get_path(CHECKPOINT_FILE)):
+            assert not os.path.exists(path)
+
+    def test_phase_timeout_keeps_workspace(self, tmpdir, monkeypatch):
+        """
+        A phase that runs past its deadline fails the build but keeps its
+        workspace and checkpoints, so that the build can be resumed.
+        """
+        sideloader = self._create_sideloader(tmpdir, monkeypatch)
+        workspace = sideloader._create_workspace()
+
+        def time_out_in_buildscript(args):
+            if args[0].endswith('build.sh'):
+                # What cmd raises once the phase's deadline has passed
+                raise PhaseTimeout('Command build.sh timed out')
+            return False
+
+        self.fail_cmd = time_out_in_buildscript
+        with pytest.raises(PhaseTimeout):
+            sideloader.run()
+
+        assert os.path.exists(workspace.get_repo_path())
+        assert os.path.exists(workspace.get_path(CHECKPOINT_FILE))
+        [build] = BuildHistory(sideloader.config.history_db).slowest()
+        assert build['status'] == 'failed'
+
+    def test_watch(self, tmpdir, monkeypatch):
+        """
+        Watching builds the source, then after a change reruns only the
+        buildscript, syncs the package tree and repackages. The workspace is
+        leased until watching stops.
+        """
+        sideloader = self._create_sideloader(tmpdir, monkeypatch)
+        workspace = sideloader._create_workspace()
+        watcher = FakeWatcher(tmpdir.join('my-app'),
+                              [{'app.py': 'print("bye")\n'}])
+
+        def create_watcher(root):
+            assert root == str(tmpdir.join('my-app'))
+            return watcher
+
+        monkeypatch.setattr(watch, 'create_watcher', create_watcher)
+        with pytest.raises(KeyboardInterrupt):
+            sideloader.watch()
+
+        def count(name):
+            return len([args for args in self.cmds
+                        if os.path.basename(args[0]) == name])
+
+        assert (count('virtualenv'), count('build.sh'), count('fpm')) == (
+            1, 2, 2)
+        with open(workspace.get_install_path('app.py')) as app:
+            assert app.read() == 'print("bye")\n'
+        with open(workspace.get_package_path('my-app-manifest.txt')) as f:
+            manifest = Manifest.parse(f.read())
+        assert manifest['opt/app.py'][1] == len('print("bye")\n')
+        assert watcher.closed
+        assert not is_leased(sideloader.config.workspace_base, 'my-app')
+
+    def test_watch_serves_metrics(self, tmpdir, monkeypatch):
+        """
+        If a metrics port is configured, the metrics are served while
+        watching and the server is shut down when watching stops.
+        """
+        sideloader = self._create_sideloader(tmpdir, monkeypatch,
+                                             'metrics_port: 9464\n')
+        servers = []
+
+        class FakeServer(object):
+            def __init__(self, port):
+                self.port = port
+                self.shut_down = False
+                servers.append(self)
+
+            def shutdown(self):
+                self.shut_down = True
+
+        def create_watcher(root):
+            return FakeWatcher(tmpdir.join('my-app'), [])
+
+        monkeypatch.setattr(metrics.REGISTRY, 'start_http_server', FakeServer)
+        monkeypatch.setattr(watch, 'create_watcher', create_watcher)
+
+        def count_builds():
+            labels = {'repo': 'my-app', 'deploy_type': 'virtualenv'}
+            return sum(value for _, key, value in metrics.BUILDS.samples()
+                       if dict(key) == labels)
+
+        builds = count_builds()
+        with pytest.raises(KeyboardInterrupt):
+            sideloader.watch()
+
+        [server] = servers
+        assert server.port == 9464 and server.shut_down
+        assert count_builds() == builds + 1
@@ -0,0 +1,84 @@
+import os
+
+from sideloader.build.slimming import (
+    DEFAULT_EXCLUDES, format_size, is_excluded, remove_excluded, size_report,
+    strip_shared_objects)
+
+
+def test_is_excluded():
+    """
+    Patterns without a '/' match names at any depth, others match the path
+    from the root.
+    """
+    assert is_excluded('app/tests', ['tests'])
+    assert is_excluded('app/module.pyc', ['*.pyc'])
+    assert is_excluded('app/static/src', ['app/static/src'])
+    assert is_excluded('app/static/src', ['/app/static/*'])
+    assert not is_excluded('other/static/src', ['app/static/src'])
+    assert not is_excluded('app/testing.py', ['tests'])
+
+
+def test_remove_excluded(tmpdir):
+    """ Excluded files and directories are removed and listed. """
+    tmpdir.ensure('app', '__init__.py')
+    tmpdir.ensure('app', '__init__.pyc')
+    tmpdir.ensure('app', 'tests', 'test_app.py')
+    tmpdir.ensure('app', '.git', 'HEAD')
+    tmpdir.ensure('app', 'speedups.c')
+
+    removed = remove_excluded(str(tmpdir), DEFAULT_EXCLUDES)
+
+    assert sorted(os.path.relpath(path, str(tmpdir)) for path in removed) == [
+        'app/.git/HEAD', 'app/__init__.pyc', 'app/speedups.c',
+        'app/tests/test_app.py']
+    assert [path.basename for path in tmpdir.join('app').listdir()] == [
+        '__init__.py']
+
+
+def test_strip_shared_objects(tmpdir):
+    """
+    Shared objects are stripped into new files, leaving the files they were
+    hard linked from untouched.
+    """
+    original = tmpdir.join('original.so')
+    original.write('\x7fELF' + 'debug' * 100)
+    lib = tmpdir.mkdir('lib')
+    os.link(str(original), str(lib.join('_speedups.so')))
+    lib.join('data.so.txt').write('not a shared object')
+    lib.join('fake.so').write('not ELF')
+    cmds = []
+
+    def cmd(args, *_args, **kwargs):
+        cmds.append(args)
+        with open(args[3], 'w') as stripped:
+            stripped.write('\x7fELF')
+
+    stripped = strip_shared_objects(str(lib), cmd)
+
+    path = str(lib.join('_speedups.so'))
+    assert stripped == [(path, 500)]
+    assert cmds == [['strip', '--strip-debug', '-o', path + '.stripped',
+                     path]]
+    assert lib.join('_speedups.so').read() == '\x7fELF'
+    assert original.read() == '\x7fELF' + 'debug' * 100
+    assert sorted(path.basename for path in lib.listdir()) == [
+        '_speedups.so', 'data.so.txt', 'fake.so']
+
+
+def test_size_report(tmpdir):
+    """ Files are grouped by their leading directories, largest first. """
+    tmpdir.ensure('app', 'static', 'app.js').write('x' * 300)
+    tmpdir.ensure('app', 'static', 'app.css').write('x' * 100)
+    tmpdir.ensure('app', 'models.py').write('x' * 200)
+
+    total, groups, files = size_report(str(tmpdir), depth=2, limit=2)
+
+    assert total == 600
+    assert groups == [('app/static', 400), ('app/models.py', 200)]
+    assert files == [('app/static/app.js', 300), ('app/models.py', 200)]
+
+
+def test_format_size():
+    assert format_size(512) == '512B'
+    assert format_size(1536) == '1.5K'
+    assert format_size(3 * 1024 ** 3) == '3.0G'
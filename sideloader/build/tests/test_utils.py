@@ -1,4 +1,12 @@
-from sideloader.build.utils import args_str, create_venv_paths
+import io
+import os
+import tarfile
+
+import pytest
+
+from sideloader.build.utils import (
+    args_str, create_venv_paths, extract_tarball, link_tree, normalize_tree,
+    parse_duration, parse_size, relocate_venv)
 
 
 def test_args_str_string_list():
@@ -40,3 +48,134 @@ def test_create_venv_paths():
     assert venv_paths.activate == '/mypath/myvenv/bin/activate'
     assert venv_paths.pip == '/mypath/myvenv/bin/pip'
     assert venv_paths.python == '/mypath/myvenv/bin/python'
+
+
+def test_parse_size():
+    """ parse_size should convert sizes with unit suffixes to bytes. """
+    assert parse_size('512') == 512
+    assert parse_size('2K') == 2048
+    assert parse_size('1.5M') == 1536 * 1024
+    assert parse_size('10GB') == 10 * 1024 ** 3
+    assert parse_size(4096) == 4096
+    assert parse_size(None) is None
+
+
+def test_parse_duration():
+    """ parse_duration should convert durations with units to seconds. """
+    assert parse_duration('90') == 90
+    assert parse_duration('30m') == 30 * 60
+    assert parse_duration('1.5h') == 90 * 60
+    assert parse_duration('7d') == 7 * 24 * 60 * 60
+    assert parse_duration(None) is None
+
+
+def test_normalize_tree(tmpdir):
+    """
+    normalize_tree should give every file and directory the same mtime and
+    normalised permissions.
+    """
+    tmpdir.mkdir('sub').join('script.sh').write('#!/bin/sh')
+    tmpdir.join('sub', 'script.sh').chmod(0o700)
+    tmpdir.join('data.txt').write('data')
+    tmpdir.join('data.txt').chmod(0o664)
+
+    normalize_tree(str(tmpdir), 1000)
+
+    for path, mode in [('sub', 0o755), ('sub/script.sh', 0o755),
+                       ('data.txt', 0o644), ('', 0o755)]:
+        stat = os.stat(os.path.join(str(tmpdir), path))
+        assert stat.st_mtime == 1000
+        assert stat.st_mode & 0o777 == mode
+
+
+def test_relocate_venv(tmpdir):
+    """
+    relocate_venv should rewrite virtualenv paths in scripts and path files
+    without changing the files of a hard linked original.
+    """
+    venv = tmpdir.mkdir('ve')
+    venv.mkdir('bin').join('pip').write('#!%s/bin/python\n' % venv)
+    venv.join('bin', 'pip').chmod(0o755)
+    site = venv.mkdir('lib').mkdir('site-packages')
+    site.join('app.egg-link').write('%s/src/app\n' % venv)
+    site.join('data.bin').write('\0%s' % venv)
+
+    link_tree(str(venv), str(tmpdir.join('copy')))
+    relocate_venv(str(tmpdir.join('copy')), str(venv), '/opt/app/python')
+
+    copy = tmpdir.join('copy')
+    assert copy.join('bin', 'pip').read() == '#!/opt/app/python/bin/python\n'
+    assert os.access(str(copy.join('bin', 'pip')), os.X_OK)
+    assert (copy.join('lib', 'site-packages', 'app.egg-link').read() ==
+            '/opt/app/python/src/app\n')
+    assert (copy.join('lib', 'site-packages', 'data.bin').read() ==
+            '\0%s' % venv)
+    assert venv.join('bin', 'pip').read() == '#!%s/bin/python\n' % venv
+
+
+def _make_tarball(path, members):
+    """ Create a tarball of (name, type, linkname or data) members. """
+    with tarfile.open(path, 'w') as tarball:
+        for name, kind, value in members:
+            info = tarfile.TarInfo(name)
+            info.type = kind
+            if kind == tarfile.REGTYPE:
+                info.size = len(value)
+                tarball.addfile(info, io.BytesIO(value))
+            else:
+                info.linkname = value
+                tarball.addfile(info)
+
+
+def test_extract_tarball(tmpdir):
+    """ Files, directories and links inside the directory are extracted. """
+    tarball = str(tmpdir.join('ok.tar'))
+    _make_tarball(tarball, [
+        ('proj/a.txt', tarfile.REGTYPE, 'a'),
+        ('proj/link', tarfile.SYMTYPE, 'a.txt'),
+        ('proj/hard', tarfile.LNKTYPE, 'proj/a.txt'),
+    ])
+    extract_tarball(tarball, str(tmpdir.mkdir('out')))
+    assert tmpdir.join('out', 'proj', 'link').read() == 'a'
+    assert tmpdir.join('out', 'proj', 'hard').read() == 'a'
+
+
+@pytest.mark.parametrize('members', [
+    [('/abs.txt', tarfile.REGTYPE, 'x')],
+    [('../up.txt', tarfile.REGTYPE, 'x')],
+    [('proj/link', tarfile.SYMTYPE, '../../outside')],
+    [('proj/hard', tarfile.LNKTYPE, '../outside/secret')],
+])
+def test_extract_tarball_refuses_escapes(tmpdir, members):
+    """ Members and links that point outside of the directory are refused. """
+    tarball = str(tmpdir.join('bad.tar'))
+    _make_tarball(tarball, members)
+    with pytest.raises(ValueError):
+        extract_tarball(tarball, str(tmpdir.mkdir('out')))
+
+
+def test_extract_tarball_never_writes_through_symlinks(tmpdir):
+    """
+    Symlinks that point outside of the directory may be allowed, but
+    nothing is extracted through them.
+    """
+    outside = tmpdir.mkdir('outside')
+    tarball = str(tmpdir.join('bad.tar'))
+    _make_tarball(tarball, [
+        ('proj/link', tarfile.SYMTYPE, str(outside)),
+        ('proj/link/pwned.txt', tarfile.REGTYPE, 'x'),
+    ])
+    with pytest.raises(ValueError):
+        extract_tarball(tarball, str(tmpdir.mkdir('out')),
+                        external_symlinks=True)
+    assert outside.listdir() == []
+
+    tarball = str(tmpdir.join('bad2.tar'))
+    _make_tarball(tarball, [
+        ('link', tarfile.SYMTYPE, str(outside.join('file'))),
+        ('link', tarfile.REGTYPE, 'x'),
+    ])
+    with pytest.raises(ValueError):
+        extract_tarball(tarball, str(tmpdir.mkdir('out2')),
+                        external_symlinks=True)
+    assert outside.listdir() == []
@@ -0,0 +1,73 @@
+import os
+
+from sideloader.build.venv_pool import VenvPool
+
+
+class FakeVirtualenv(object):
+    """ Creates just enough of a virtualenv to check relocation. """
+
+    def __init__(self):
+        self.cmds = []
+
+    def __call__(self, args, *_args, **kwargs):
+        self.cmds.append(args)
+        if args[0] == 'virtualenv':
+            venv_path = args[-1]
+            os.makedirs(os.path.join(venv_path, 'bin'))
+            with open(os.path.join(venv_path, 'bin', 'pip'), 'w') as pip:
+                pip.write('#!%s/bin/python\n' % venv_path)
+
+
+def _create_pool(tmpdir, size=2):
+    pool = VenvPool(str(tmpdir.join('pool')), size)
+    pool._cmd = FakeVirtualenv()
+    return pool
+
+
+def test_refill(tmpdir):
+    """
+    Refilling creates pip-upgraded virtualenvs until the pool is full, and
+    cleans up after refills that died.
+    """
+    pool = _create_pool(tmpdir)
+    os.makedirs(os.path.join(pool.path, '.tmp-dead'))
+    pool.refill()
+
+    assert sorted(os.listdir(pool.path)) == ['.refill.lock'] + sorted(
+        os.path.basename(path) for path in pool._ready())
+    assert len(pool._ready()) == 2
+    assert [args[1:] for args in pool._cmd.cmds[1::2]] == [
+        ['install', '--upgrade', 'pip']] * 2
+
+    # A full pool isn't refilled
+    pool.refill()
+    assert len(pool._cmd.cmds) == 4
+
+
+def test_take(tmpdir):
+    """
+    Taking a virtualenv moves it out of the pool and relocates it, until the
+    pool is empty.
+    """
+    pool = _create_pool(tmpdir, size=1)
+    pool.refill()
+
+    dst = str(tmpdir.join('ve'))
+    assert pool.take(dst)
+    assert pool._ready() == []
+    assert open(os.path.join(dst, 'bin', 'pip')).read() == (
+        '#!%s/bin/python\n' % dst)
+
+    assert not pool.take(str(tmpdir.join('ve2')))
+    thread = pool.refill_in_background()
+    # Exiting doesn't wait for the refill
+    assert thread.daemon
+    thread.join()
+    assert len(pool._ready()) == 1
+
+
+def test_interpreters_have_separate_pools(tmpdir):
+    """ Pools for different interpreters don't share virtualenvs. """
+    default = VenvPool(str(tmpdir), 1)
+    python3 = VenvPool(str(tmpdir), 1, '/usr/bin/python3')
+    assert default.path != python3.path
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+from sideloader.build import Deploy
+from sideloader.build.watch import (
+    RESCAN, InotifyWatcher, PollingWatcher, plan_rebuild)
+
+
+def _watchers():
+    watchers = [lambda root: PollingWatcher(root, interval=0.01)]
+    if hasattr(os, 'uname') and os.uname()[0] == 'Linux':
+        watchers.append(InotifyWatcher)
+    return watchers
+
+
+@pytest.mark.parametrize('create_watcher', _watchers())
+def test_watcher(tmpdir, create_watcher):
+    """
+    Watchers report changed, created and removed files (including the files
+    in new directories) and ignore editor and VCS files.
+    """
+    tmpdir.ensure('app', 'views.py').write('views = 1')
+    tmpdir.ensure('setup.py').write('setup()')
+    watcher = create_watcher(str(tmpdir))
+    try:
+        tmpdir.join('app', 'views.py').write('views = 2')
+        tmpdir.join('setup.py').remove()
+        tmpdir.ensure('app', '.views.py.swp')
+        tmpdir.ensure('.git', 'index')
+        assert watcher.wait(settle=0.05) == [
+            os.path.join('app', 'views.py'), 'setup.py']
+
+        tmpdir.ensure('static', 'css', 'app.css')
+        assert os.path.join('static', 'css', 'app.css') in (
+            watcher.wait(settle=0.05))
+        assert watcher.poll(0.05) == set()
+    finally:
+        watcher.close()
+
+
+def test_plan_rebuild():
+    """
+    Changes only rerun the steps they affect, and changes to the deploy file
+    cause a full build.
+    """
+    deploy = Deploy(pip=['-r requirements.txt', 'django'],
+                    postinstall='scripts/postinst.sh')
+
+    assert plan_rebuild(['scripts/postinst.sh'], deploy, '.deploy.yaml') == (
+        set(['postinstall']))
+    assert plan_rebuild(['app/views.py', 'scripts/postinst.sh'], deploy,
+                        '.deploy.yaml') == set(['build', 'postinstall'])
+    assert plan_rebuild(['requirements.txt'], deploy, '.deploy.yaml') == (
+        set(['pip', 'build']))
+    assert plan_rebuild(['.deploy.yaml'], deploy, '.deploy.yaml') == (
+        set(['full']))
+    assert plan_rebuild([RESCAN], deploy, '.deploy.yaml') == set(['full'])
+    assert plan_rebuild(['app/views.py'], deploy, '.deploy.yaml',
+                        builds_wheel=True) == set(['full'])
@@ -0,0 +1,124 @@
+import os
+import sys
+import zipfile
+
+from sideloader.build.utils import cmd
+from sideloader.build.wheels import (
+    DEFAULT_REQUIRES, LEGACY_BACKEND, build_wheel, install_wheel,
+    parse_toml_table, read_build_system)
+
+
+PYPROJECT = """
+[tool.black]
+line-length = 79
+
+[build-system]
+# The backend lives in the repo
+requires = [
+    "flit_core >=2,<4",  # comment
+]
+build-backend = "backend"
+backend-path = ['.']
+"""
+
+BACKEND = """
+import os
+import zipfile
+
+
+def build_wheel(wheel_directory, config_settings=None,
+                metadata_directory=None):
+    name = 'app-1.0-py2.py3-none-any.whl'
+    with zipfile.ZipFile(os.path.join(wheel_directory, name), 'w') as wheel:
+        wheel.write('app.py', 'app.py')
+        wheel.writestr('app-1.0.dist-info/WHEEL', 'Wheel-Version: 1.0\\n')
+    print('Built %s' % name)
+    return name
+"""
+
+
+def test_parse_toml_table():
+    """ The keys of a table are parsed from a TOML document. """
+    assert parse_toml_table(PYPROJECT, 'build-system') == {
+        'requires': ['flit_core >=2,<4'],
+        'build-backend': 'backend',
+        'backend-path': ['.'],
+    }
+    assert parse_toml_table(PYPROJECT, 'missing') == {}
+
+
+def test_read_build_system_defaults(tmpdir):
+    """ Projects without a build backend use the setuptools defaults. """
+    assert read_build_system(str(tmpdir)) == (
+        DEFAULT_REQUIRES, LEGACY_BACKEND, [])
+
+
+def test_build_wheel(tmpdir):
+    """
+    Wheels are built by calling the build backend's hooks in the build
+    environment.
+    """
+    source_dir = tmpdir.mkdir('source')
+    source_dir.join('pyproject.toml').write(
+        '[build-system]\nrequires = []\nbuild-backend = "backend"\n'
+        'backend-path = ["."]\n')
+    source_dir.join('backend.py').write(BACKEND)
+    source_dir.join('app.py').write('print("hello")\n')
+    wheel_dir = tmpdir.mkdir('wheels')
+
+    cmds = []
+
+    def fake_virtualenv_cmd(args, cwd=None):
+        cmds.append(args[:2])
+        if args[0] == 'virtualenv':
+            os.makedirs(os.path.join(args[1], 'bin'))
+            os.symlink(sys.executable, os.path.join(args[1], 'bin', 'python'))
+            return ''
+        return cmd(args, cwd=cwd)
+
+    env_dir = str(tmpdir.join('env'))
+    wheel_path = build_wheel(str(source_dir), str(wheel_dir), env_dir,
+                             fake_virtualenv_cmd)
+
+    assert wheel_path == str(wheel_dir.join('app-1.0-py2.py3-none-any.whl'))
+    assert zipfile.ZipFile(wheel_path).read('app.py') == 'print("hello")\n'
+    python = os.path.join(env_dir, 'bin', 'python')
+    assert cmds == [['virtualenv', env_dir], [python, '-c'],
+                    [python, '-c']]
+
+
+def test_install_wheel(tmpdir):
+    """
+    Wheel contents are installed into the package tree, with scripts for the
+    entry points and the data directory spread over the install schemes.
+    """
+    wheel_path = str(tmpdir.join('app-1.0-py2-none-any.whl'))
+    with zipfile.ZipFile(wheel_path, 'w') as wheel:
+        wheel.writestr('app/__init__.py', '')
+        wheel.writestr('app-1.0.dist-info/WHEEL', 'Wheel-Version: 1.0\n')
+        wheel.writestr('app-1.0.dist-info/entry_points.txt',
+                       '[console_scripts]\napp-cli = app.cli:main.run\n')
+        wheel.writestr('app-1.0.data/scripts/tool', '#!python\nprint(1)\n')
+        wheel.writestr('app-1.0.data/data/share/app/app.conf', 'conf\n')
+
+    root = str(tmpdir.join('package'))
+    lib = '/usr/lib/python2.7/dist-packages'
+    installed = install_wheel(wheel_path, root, lib, '/usr/bin/python2')
+
+    assert [os.path.relpath(path, root) for path in installed] == [
+        'usr/bin/app-cli',
+        'usr/bin/tool',
+        'usr/lib/python2.7/dist-packages/app-1.0.dist-info/INSTALLER',
+        'usr/lib/python2.7/dist-packages/app-1.0.dist-info/WHEEL',
+        'usr/lib/python2.7/dist-packages/app-1.0.dist-info/'
+        'entry_points.txt',
+        'usr/lib/python2.7/dist-packages/app/__init__.py',
+        'usr/share/app/app.conf',
+    ]
+    tool = tmpdir.join('package', 'usr', 'bin', 'tool')
+    assert tool.read() == '#!/usr/bin/python2\nprint(1)\n'
+    assert os.access(str(tool), os.X_OK)
+    script = tmpdir.join('package', 'usr', 'bin', 'app-cli').read()
+    assert script.startswith('#!/usr/bin/python2\n')
+    assert 'from app.cli import main\n' in script
+    assert 'sys.exit(main.run())' in script
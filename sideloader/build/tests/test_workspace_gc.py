@@ -0,0 +1,110 @@
+import os
+import time
+
+from sideloader.build.workspace_gc import (
+    WorkspaceGC, get_staging_name, is_in_use, mark_in_use, touch_last_use)
+
+
+def _make_entry(path, size, last_use):
+    """ Create a directory containing a file of the given size. """
+    path.ensure(dir=True)
+    path.join('data').write('x' * size)
+    touch_last_use(str(path))
+    os.utime(str(path.join('.sideloader-last-use')), (last_use, last_use))
+    return path
+
+
+def test_collect_evicts_least_recently_used(tmpdir):
+    """
+    When the workspace base is over budget, the least recently used entries
+    are evicted until it is within the budget.
+    """
+    old = _make_entry(tmpdir.join('old'), 1000, 100)
+    cache = _make_entry(tmpdir.join('.cache', 'wheels', 'abc'), 1000, 200)
+    new = _make_entry(tmpdir.join('new'), 1000, 300)
+
+    evicted = WorkspaceGC(str(tmpdir), 2500).collect()
+
+    assert [entry.path for entry in evicted] == [str(old)]
+    assert not old.check()
+    assert cache.check()
+    assert new.check()
+
+
+def test_collect_evicts_cache_entries(tmpdir):
+    """ Cache entries are evicted in least recently used order too. """
+    cache = _make_entry(tmpdir.join('.cache', 'wheels', 'abc'), 1000, 100)
+    workspace = _make_entry(tmpdir.join('ws'), 1000, 200)
+
+    evicted = WorkspaceGC(str(tmpdir), 1500).collect()
+
+    assert [entry.kind for entry in evicted] == ['cache:wheels']
+    assert not cache.check()
+    assert workspace.check()
+
+
+def test_collect_skips_workspaces_in_use(tmpdir):
+    """ Workspaces that are in use are never evicted. """
+    busy = _make_entry(tmpdir.join('busy'), 1000, 100)
+    mark_in_use(str(busy))
+    idle = _make_entry(tmpdir.join('idle'), 1000, 200)
+
+    WorkspaceGC(str(tmpdir), 0).collect()
+
+    assert busy.check()
+    assert not idle.check()
+
+
+def test_collect_removes_orphaned_staging(tmpdir):
+    """
+    Builds staged in memory by workspaces that are no longer in use are
+    removed whatever the budget, as they were left behind by killed runs.
+    """
+    base = tmpdir.mkdir('base')
+    shm = tmpdir.mkdir('shm')
+    busy = _make_entry(base.join('busy'), 10, 100)
+    mark_in_use(str(busy))
+    idle = _make_entry(base.join('idle'), 10, 200)
+    busy_staged = shm.ensure(get_staging_name(str(busy)), 'build', dir=True)
+    idle_staged = shm.ensure(get_staging_name(str(idle)), 'build', dir=True)
+
+    evicted = WorkspaceGC(str(base), 10 ** 6, str(shm)).collect()
+
+    assert [entry.kind for entry in evicted] == ['staging']
+    assert busy_staged.check()
+    assert not idle_staged.check()
+    assert idle.check()
+
+
+def test_is_in_use_ignores_dead_processes(tmpdir):
+    """
+    An in-use marker left by a process that is no longer running is
+    ignored.
+    """
+    tmpdir.join('.sideloader-in-use').write('999999999')
+    assert not is_in_use(str(tmpdir))
+
+    mark_in_use(str(tmpdir))
+    assert is_in_use(str(tmpdir))
+
+
+def test_start_background_collects_until_stopped(tmpdir):
+    """
+    The background collector evicts entries periodically until it is
+    stopped.
+    """
+    _make_entry(tmpdir.join('old'), 1000, 100)
+    stop = WorkspaceGC(str(tmpdir), 0).start_background(interval=0.01)
+    try:
+        for _ in range(500):
+            if not tmpdir.join('old').check():
+                break
+            time.sleep(0.01)
+        assert not tmpdir.join('old').check()
+    finally:
+        stop.set()
+
+    time.sleep(0.05)
+    _make_entry(tmpdir.join('new'), 1000, 200)
+    time.sleep(0.05)
+    assert tmpdir.join('new').check()
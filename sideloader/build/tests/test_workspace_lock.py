@@ -0,0 +1,164 @@
+import fcntl
+import os
+import threading
+import time
+
+import pytest
+
+from sideloader.build.cancellation import BuildCancelled, CancelToken
+from sideloader.build.workspace_gc import WorkspaceGC
+from sideloader.build.workspace_lock import (
+    LOCK_DIR, WorkspaceLease, is_leased, lease_workspace)
+
+
+def test_acquire_and_release(tmpdir):
+    """ A lease can be taken again once it has been released. """
+    lease = WorkspaceLease(str(tmpdir), 'app')
+    assert lease.acquire()
+    assert is_leased(str(tmpdir), 'app')
+    assert lease.get_holder() == os.getpid()
+
+    lease.release()
+    assert not is_leased(str(tmpdir), 'app')
+    assert os.listdir(str(tmpdir.join(LOCK_DIR, 'app.queue'))) == []
+
+    other = WorkspaceLease(str(tmpdir), 'app')
+    assert other.acquire(blocking=False)
+    other.release()
+
+
+def test_acquire_nonblocking_fails_while_leased(tmpdir):
+    """
+    A lease that another run holds can't be taken without waiting, and the
+    failed attempt leaves no ticket in the queue.
+    """
+    lease = WorkspaceLease(str(tmpdir), 'app')
+    lease.acquire()
+
+    other = WorkspaceLease(str(tmpdir), 'app')
+    assert not other.acquire(blocking=False)
+    assert len(os.listdir(str(tmpdir.join(LOCK_DIR, 'app.queue')))) == 1
+    assert WorkspaceLease(str(tmpdir), 'other').acquire(blocking=False)
+    lease.release()
+
+
+def test_stale_tickets_are_removed(tmpdir):
+    """
+    Tickets that aren't locked were left behind by runs that died, and
+    don't hold up the queue.
+    """
+    queue = tmpdir.join(LOCK_DIR, 'app.queue').ensure(dir=True)
+    queue.join('0000000000.000000-deadbeef').write('12345')
+    # A stale lease is a lock file that nobody holds a lock on
+    tmpdir.join(LOCK_DIR, 'app.lock').write('12345')
+
+    lease = WorkspaceLease(str(tmpdir), 'app')
+    assert lease.acquire(blocking=False)
+    assert not queue.join('0000000000.000000-deadbeef').check()
+    lease.release()
+
+
+def test_waiting_runs_are_served_in_order(tmpdir):
+    """ Runs waiting for a lease take it in the order they asked for it. """
+    lease = WorkspaceLease(str(tmpdir), 'app')
+    lease.acquire()
+
+    order = []
+
+    def wait_for_lease(name):
+        waiter = WorkspaceLease(str(tmpdir), 'app')
+        waiter.poll_interval = 0.01
+        waiter.acquire()
+        order.append(name)
+        time.sleep(0.05)
+        waiter.release()
+
+    threads = []
+    queue = tmpdir.join(LOCK_DIR, 'app.queue')
+    for i in range(3):
+        thread = threading.Thread(target=wait_for_lease, args=(i,))
+        thread.start()
+        threads.append(thread)
+        # Wait for the thread to join the queue before starting the next
+        while len(queue.listdir()) < i + 2:
+            time.sleep(0.01)
+
+    lease.release()
+    for thread in threads:
+        thread.join()
+    assert order == [0, 1, 2]
+
+
+def test_cancel_while_waiting(tmpdir):
+    """
+    Cancelling a run that is waiting for a lease stops the wait and takes
+    the run out of the queue.
+    """
+    lease = WorkspaceLease(str(tmpdir), 'app')
+    lease.acquire()
+
+    token = CancelToken()
+    errors = []
+
+    def wait_for_lease():
+        try:
+            lease_workspace(str(tmpdir), 'app', cancel_token=token)
+        except BuildCancelled as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=wait_for_lease)
+    thread.start()
+    queue = tmpdir.join(LOCK_DIR, 'app.queue')
+    while len(queue.listdir()) < 2:
+        time.sleep(0.01)
+    token.cancel('Received signal 15')
+    thread.join()
+
+    assert [str(e) for e in errors] == ['Received signal 15']
+    assert len(queue.listdir()) == 1
+    lease.release()
+
+
+def test_lease_workspace_suffix(tmpdir):
+    """
+    In 'suffix' mode, a run whose workspace is leased uses the first free
+    suffixed workspace instead of waiting.
+    """
+    first = lease_workspace(str(tmpdir), 'app', 'suffix')
+    second = lease_workspace(str(tmpdir), 'app', 'suffix')
+    third = lease_workspace(str(tmpdir), 'app', 'suffix')
+    assert [first.workspace_id, second.workspace_id, third.workspace_id] == [
+        'app', 'app-2', 'app-3']
+
+    second.release()
+    assert lease_workspace(str(tmpdir), 'app', 'suffix').workspace_id == (
+        'app-2')
+
+
+def test_lease_workspace_unknown_mode(tmpdir):
+    with pytest.raises(ValueError):
+        lease_workspace(str(tmpdir), 'app', 'steal')
+
+
+def test_is_leased_ignores_locks_of_dead_runs(tmpdir):
+    """ A lock file that isn't locked doesn't count as a lease. """
+    assert not is_leased(str(tmpdir), 'app')
+    lock_path = tmpdir.join(LOCK_DIR, 'app.lock').ensure()
+    assert not is_leased(str(tmpdir), 'app')
+
+    with open(str(lock_path)) as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        assert is_leased(str(tmpdir), 'app')
+
+
+def test_gc_skips_leased_workspaces(tmpdir):
+    """ The garbage collector never evicts a workspace that is leased. """
+    tmpdir.join('app', 'data').write('x' * 1000, ensure=True)
+    lease = lease_workspace(str(tmpdir), 'app')
+
+    assert WorkspaceGC(str(tmpdir), 0).collect() == []
+    assert tmpdir.join('app').check()
+
+    lease.release()
+    evicted = WorkspaceGC(str(tmpdir), 0).collect()
+    assert [entry.path for entry in evicted] == [str(tmpdir.join('app'))]
@@ -1,15 +1,37 @@
+import errno
+import fcntl
+import hashlib
+import json
 import os
 import shutil
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
 import time
 
 from collections import namedtuple
 
+import buildlog
+import cancellation
 
-def log(message):
-    """ Log a timestamped message to stdout. """
-    sys.stdout.write('[%s] %s\n' % (time.ctime(), message))
+
+def log(message, **fields):
+    """
+    Log a message to the build log bound to the current thread, or to stdout
+    with a timestamp if there is none.
+
+    :param: fields:
+    Extra fields for the structured log record.
+    """
+    build_log = buildlog.current_log()
+    if build_log is not None:
+        build_log.emit(message, **fields)
+        return
+
+    record = buildlog.make_record(message, **fields)
+    sys.stdout.write(buildlog.ConsoleRenderer().render(record))
     sys.stdout.flush()
 
 
@@ -21,19 +43,122 @@ def args_str(args):
     return str(args)
 
 
-def cmd(args, debug=False):
-    """ Run the given command. """
+""" Callables notified with (args, duration) after every command runs. """
+command_observers = []
+
+
+def cmd(args, debug=False, env=None, cwd=None, timeout=None):
+    """
+    Run the given command in its own process group, so that it can be
+    killed along with everything it started if it times out or the build is
+    cancelled.
+
+    :param: env:
+    Extra environment variables to set for the command.
+
+    :param: cwd:
+    The directory to run the command in.
+
+    :param: timeout:
+    The number of seconds the command may run for. The deadline of the
+    current phase also applies.
+
+    :raises:
+    OSError if the command can't be found, CalledProcessError if it fails,
+    PhaseTimeout if it runs out of time and BuildCancelled if the build is
+    cancelled.
+    """
+    token = cancellation.current_token()
+    if token is not None:
+        token.check()
+    timeout = cancellation.get_timeout(timeout)
+
     if debug:
-        log(args_str(args))
+        log(args_str(args), command=args_str(args))
 
-    output = subprocess.check_output(args, shell=False)
+    if env is not None:
+        env = dict(os.environ, **env)
+
+    start = time.time()
+    try:
+        output = _run_process(args, env, cwd, timeout, token)
+    finally:
+        duration = time.time() - start
+        for observer in command_observers:
+            observer(args, duration)
 
     if debug:
-        log(output)
+        command = os.path.basename(str(args[0]))
+        log('Finished %s in %.2fs' % (command, duration),
+            command=args_str(args), duration=duration,
+            output=output.splitlines())
 
     return output
 
 
+""" Moves itself into its own process group and execs the command. """
+_PROCESS_GROUP_SHIM = (
+    'import os, sys; os.setpgid(0, 0); os.execv(sys.argv[1], sys.argv[2:])')
+
+
+def _find_executable(executable, env, cwd):
+    """
+    Find the path of an executable as execvp would, so that a missing one
+    raises OSError here rather than failing in the process group shim.
+    """
+    if os.sep in executable:
+        candidates = [os.path.join(cwd or os.getcwd(), executable)]
+    else:
+        path = (env or os.environ).get('PATH', os.defpath)
+        candidates = [os.path.join(directory or os.curdir, executable)
+                      for directory in path.split(os.pathsep)]
+    for candidate in candidates:
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), executable)
+
+
+def _run_process(args, env, cwd, timeout, token):
+    # A shim rather than a preexec_fn, which isn't safe to use while other
+    # threads are running. The command stays in this session, so it keeps
+    # the controlling terminal for gpg or git prompts.
+    args = [str(arg) for arg in args]
+    executable = _find_executable(args[0], env, cwd)
+    process = subprocess.Popen(
+        [sys.executable, '-S', '-c', _PROCESS_GROUP_SHIM, executable] + args,
+        stdout=subprocess.PIPE, env=env, cwd=cwd)
+    timed_out = threading.Event()
+
+    def expire():
+        timed_out.set()
+        cancellation.kill_process_group(process)
+
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, expire)
+        timer.daemon = True
+        timer.start()
+    if token is not None:
+        token.register(process)
+    try:
+        output, _ = process.communicate()
+    finally:
+        if timer is not None:
+            timer.cancel()
+        if token is not None:
+            token.unregister(process)
+
+    if timed_out.is_set():
+        raise cancellation.PhaseTimeout(
+            '%s timed out after %ds' % (args_str(args), timeout))
+    if token is not None:
+        token.check()
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, args,
+                                            output=output)
+    return output
+
+
 def rmtree_if_exists(tree_path):
     """
     Delete a directory and its contents if the directory exists.
@@ -50,6 +175,38 @@ def rmtree_if_exists(tree_path):
     return False
 
 
+def write_json(path, obj):
+    """ Write a JSON file atomically. """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as tmp_file:
+        json.dump(obj, tmp_file)
+    os.rename(tmp_path, path)
+
+
+def read_json(path):
+    """ Read a JSON file, returning None if it is missing or corrupt. """
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    except ValueError:
+        return None
+
+
+def try_flock(lock_file, operation):
+    """ Try to take a flock without blocking, returning whether it did. """
+    try:
+        fcntl.flock(lock_file, operation | fcntl.LOCK_NB)
+    except IOError as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        return False
+    return True
+
+
 def listdir_abs(path):
     """
     List the contents of a directory returning the absolute paths to the child
@@ -64,6 +221,258 @@ def listdir_abs(path):
     abspath = os.path.abspath(path)
     return [os.path.join(abspath, child) for child in os.listdir(abspath)]
 
+
+def dir_size(path):
+    """
+    Calculate the total size of the files in a directory tree. Symlinks are
+    not followed.
+
+    :param: path:
+    The path to the directory.
+
+    :returns:
+    The size in bytes.
+    """
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files + dirs:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                # The file disappeared while we were walking the tree
+                pass
+    return total
+
+
+def walk_sorted(path, exclude=()):
+    """
+    Walk a directory tree in a stable order, yielding the relative path of
+    every file and symlink. Directories named in exclude are skipped.
+    """
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if d not in exclude)
+        links = [d for d in dirs if os.path.islink(os.path.join(root, d))]
+        for name in sorted(files + links):
+            yield os.path.relpath(os.path.join(root, name), path)
+
+
+def hash_file(path, algorithm='sha256', chunk_size=65536):
+    """ Calculate the hex digest of a file's contents. """
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_tree(path, exclude=('.git',)):
+    """
+    Calculate a content hash for a directory tree. The hash covers the
+    relative path, executable bit and contents of every file (and the targets
+    of symlinks) so it is independent of timestamps and ownership.
+
+    :param: path:
+    The path to the directory.
+
+    :param: exclude:
+    Names of directories to leave out of the hash.
+
+    :returns:
+    The hex sha256 digest.
+    """
+    digest = hashlib.sha256()
+    for relpath in walk_sorted(path, exclude):
+        file_path = os.path.join(path, relpath)
+        digest.update(relpath + '\0')
+        if os.path.islink(file_path):
+            digest.update('l' + os.readlink(file_path))
+        else:
+            executable = os.stat(file_path).st_mode & 0o111
+            digest.update('x' if executable else 'f')
+            digest.update(hash_file(file_path))
+        digest.update('\0')
+    return digest.hexdigest()
+
+
+def _is_within(path, root):
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+
+def extract_tarball(src_path, dst_dir, external_symlinks=False):
+    """
+    Extract a tarball into a directory, refusing to write anything outside
+    of it: members must have relative paths that don't leave the directory,
+    including through symlinks extracted before them, and links must point
+    inside the directory.
+
+    :param: external_symlinks:
+    Allow symlinks that point outside of the directory, e.g. a virtualenv's
+    links to the system Python. Nothing is ever extracted through them.
+    """
+    root = os.path.realpath(dst_dir)
+
+    def check(member):
+        if os.path.isabs(member.name):
+            raise ValueError('Refusing to extract \'%s\' outside of %s' % (
+                member.name, dst_dir))
+        # Resolved at the time the member is extracted, so that symlinks
+        # extracted earlier are followed
+        name = os.path.normpath(member.name)
+        parent = os.path.realpath(os.path.join(root, os.path.dirname(name)))
+        path = os.path.join(parent, os.path.basename(name))
+        if not _is_within(os.path.realpath(path), root):
+            raise ValueError('Refusing to extract \'%s\' outside of %s' % (
+                member.name, dst_dir))
+
+        if member.islnk():
+            target = os.path.realpath(os.path.join(root, member.linkname))
+        elif member.issym() and not external_symlinks:
+            target = os.path.realpath(os.path.join(parent, member.linkname))
+        else:
+            return member
+        if not _is_within(target, root):
+            raise ValueError(
+                'Refusing to extract link \'%s\' to \'%s\' outside of %s'
+                % (member.name, member.linkname, dst_dir))
+        return member
+
+    with tarfile.open(src_path) as tarball:
+        # Members are checked lazily, just before each is extracted
+        tarball.extractall(dst_dir, (check(member) for member in tarball))
+
+
+def reflink_tree(src, dst):
+    """
+    Copy a directory tree using copy-on-write clones where the filesystem
+    supports them.
+
+    :returns:
+    True if the tree was cloned. False if cloning isn't supported, in which
+    case nothing is left behind at dst.
+    """
+    with open(os.devnull, 'w') as devnull:
+        returncode = subprocess.call(
+            ['cp', '-a', '--reflink=always', src, dst],
+            stdout=devnull, stderr=devnull)
+    if returncode != 0:
+        rmtree_if_exists(dst)
+        return False
+    return True
+
+
+def link_tree(src, dst):
+    """
+    Copy a directory tree by hard linking the files, falling back to copying
+    files that can't be linked (e.g. because they are on another device).
+    """
+    for root, dirs, files in os.walk(src):
+        dst_root = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(dst_root)
+        shutil.copystat(root, dst_root)
+
+        # Symlinks to directories are listed in dirs and not walked
+        for name in dirs + files:
+            src_path = os.path.join(root, name)
+            dst_path = os.path.join(dst_root, name)
+            if os.path.islink(src_path):
+                os.symlink(os.readlink(src_path), dst_path)
+            elif os.path.isfile(src_path):
+                link_or_copy(src_path, dst_path)
+
+
+def link_or_copy(src, dst):
+    """
+    Hard link a file, falling back to copying it if it can't be linked.
+    """
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(src, dst)
+
+
+def normalize_tree(path, timestamp):
+    """
+    Normalise the metadata of a directory tree so that archiving it gives the
+    same result every time: every file and directory gets the same mtime,
+    directories and executables get mode 0755 and other files get mode 0644.
+
+    :param: path:
+    The path to the directory.
+
+    :param: timestamp:
+    The mtime to set, as seconds since the epoch.
+    """
+    def normalize(entry_path, mode):
+        os.chmod(entry_path, mode)
+        os.utime(entry_path, (timestamp, timestamp))
+
+    for root, dirs, files in os.walk(path, topdown=False):
+        for name in files + dirs:
+            entry_path = os.path.join(root, name)
+            if os.path.islink(entry_path):
+                continue
+            if os.path.isdir(entry_path):
+                normalize(entry_path, 0o755)
+            else:
+                executable = os.stat(entry_path).st_mode & 0o111
+                normalize(entry_path, 0o755 if executable else 0o644)
+    normalize(path, 0o755)
+
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+              'T': 1024 ** 4}
+
+
+def parse_size(value):
+    """
+    Parse a human-readable size such as '512M' or '10G' into bytes.
+
+    :param: value:
+    A string with an optional K, M, G or T suffix, or a number of bytes.
+
+    :returns:
+    The size in bytes, or None if value is None.
+    """
+    if value is None or isinstance(value, (int, long)):
+        return value
+
+    value = str(value).strip().upper().rstrip('B')
+    unit = value[-1:] if value[-1:] in SIZE_UNITS else ''
+    number = value[:len(value) - len(unit)]
+    try:
+        return int(float(number) * SIZE_UNITS[unit])
+    except ValueError:
+        raise ValueError('Invalid size \'%s\'' % value)
+
+
+DURATION_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60,
+                  'w': 7 * 24 * 60 * 60}
+
+
+def parse_duration(value):
+    """
+    Parse a human-readable duration such as '30m' or '7d' into seconds.
+
+    :param: value:
+    A string with an optional s, m, h, d or w suffix, or a number of seconds.
+
+    :returns:
+    The duration in seconds, or None if value is None.
+    """
+    if value is None or isinstance(value, (int, long, float)):
+        return value
+
+    value = str(value).strip().lower()
+    unit = value[-1:] if value[-1:] in DURATION_UNITS else ''
+    number = value[:len(value) - len(unit)]
+    try:
+        return float(number) * DURATION_UNITS[unit]
+    except ValueError:
+        raise ValueError('Invalid duration \'%s\'' % value)
+
+
 """ A tuple of common virtualenv paths. """
 VenvPaths = namedtuple('VenvPath',
                        ['venv', 'bin', 'activate', 'pip', 'python'])
@@ -92,3 +501,39 @@ def create_venv_paths(root_path, name='ve'):
         pip=os.path.join(venv_bin_path, 'pip'),
         python=os.path.join(venv_bin_path, 'python')
     )
+
+
+def relocate_venv(venv_path, old_path, new_path):
+    """
+    Rewrite the absolute paths in a virtualenv's scripts (shebangs and
+    activate scripts) and path files so that it works from another location.
+    Files are replaced rather than modified, so a virtualenv made with
+    link_tree can be relocated without touching the original.
+
+    :param: venv_path:
+    The path to the virtualenv to rewrite.
+
+    :param: old_path:
+    The path the virtualenv was created at.
+
+    :param: new_path:
+    The path the virtualenv will be used from.
+    """
+    candidates = listdir_abs(os.path.join(venv_path, 'bin'))
+    for root, _, files in os.walk(os.path.join(venv_path, 'lib')):
+        candidates += [os.path.join(root, name) for name in files
+                       if name.endswith(('.pth', '.egg-link'))]
+
+    for path in candidates:
+        if os.path.islink(path) or not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as src_file:
+            content = src_file.read()
+        if '\0' in content or old_path not in content:
+            continue
+
+        tmp_path = path + '.relocate'
+        with open(tmp_path, 'wb') as dst_file:
+            dst_file.write(content.replace(old_path, new_path))
+        shutil.copymode(path, tmp_path)
+        os.rename(tmp_path, path)
@@ -0,0 +1,147 @@
+"""
+A pool of blank, pip-upgraded virtualenvs for new workspaces, so that builds
+don't wait for virtualenv and pip to bootstrap. The pool lives in the
+workspace base, with a directory per interpreter. Builds take a virtualenv
+by renaming it into their workspace (renames are atomic, so a virtualenv is
+never taken twice) and the pool is refilled in the background.
+"""
+import errno
+import fcntl
+import hashlib
+import os
+import tempfile
+import threading
+import uuid
+
+from utils import cmd, log, relocate_venv, rmtree_if_exists
+
+
+""" The directory in the workspace base for the pool. """
+VENV_POOL_DIR = '.venv-pool'
+
+
+class VenvPool(object):
+
+    debug = False
+
+    def _cmd(self, *args, **kwargs):
+        return cmd(*args, debug=self.debug, **kwargs)
+
+    def __init__(self, root, size, python=None):
+        """
+        :param: root:
+        The directory for the pools.
+
+        :param: size:
+        The number of virtualenvs to keep ready.
+
+        :param: python:
+        The interpreter for the virtualenvs, or None for virtualenv's
+        default.
+        """
+        self.size = size
+        self.python = python
+        name = ('default' if python is None
+                else hashlib.sha1(python).hexdigest()[:12])
+        self.path = os.path.join(root, name)
+
+    def _ready(self):
+        """ List the ready virtualenvs, skipping ones being created. """
+        try:
+            names = os.listdir(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+        return sorted(os.path.join(self.path, name) for name in names
+                      if not name.startswith('.'))
+
+    def count(self):
+        """ Count the virtualenvs that are ready to be taken. """
+        return len(self._ready())
+
+    def take(self, dst):
+        """
+        Move a virtualenv from the pool to dst.
+
+        :returns:
+        True if a virtualenv was taken, False if the pool is empty.
+        """
+        for venv_path in self._ready():
+            try:
+                os.rename(venv_path, dst)
+            except OSError as e:
+                # Another build took it first
+                if e.errno == errno.ENOENT:
+                    continue
+                raise
+            relocate_venv(dst, venv_path, dst)
+            return True
+        return False
+
+    def refill(self):
+        """
+        Create virtualenvs until the pool is full. Does nothing if another
+        process is already refilling the pool.
+        """
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        with open(os.path.join(self.path, '.refill.lock'), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return
+
+            self._remove_partial()
+            while self.count() < self.size:
+                self._create()
+
+    def refill_in_background(self):
+        """
+        Refill the pool on a daemon thread, so that exiting or cancelling a
+        build doesn't wait for it. A virtualenv that is cut short is never
+        taken, as it only appears in the pool once it is complete, and the
+        next refill removes it.
+        """
+        thread = threading.Thread(target=self._refill_logging_errors,
+                                  name='sideloader-venv-pool')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _refill_logging_errors(self):
+        try:
+            self.refill()
+        except Exception as e:
+            log('WARNING: Refilling the virtualenv pool failed: %s' % e)
+
+    def _remove_partial(self):
+        """ Remove virtualenvs left half-created by a refill that died. """
+        for name in os.listdir(self.path):
+            if name.startswith('.tmp-'):
+                rmtree_if_exists(os.path.join(self.path, name))
+
+    def _create(self):
+        tmp_path = tempfile.mkdtemp(prefix='.tmp-', dir=self.path)
+        try:
+            virtualenv = ['virtualenv']
+            if self.python is not None:
+                virtualenv += ['-p', self.python]
+            self._cmd(virtualenv + [tmp_path])
+            self._cmd([os.path.join(tmp_path, 'bin', 'pip'), 'install',
+                       '--upgrade', 'pip'])
+            # Point it at its place in the pool before it appears there
+            venv_path = os.path.join(self.path, uuid.uuid4().hex)
+            relocate_venv(tmp_path, tmp_path, venv_path)
+        except BaseException:
+            rmtree_if_exists(tmp_path)
+            raise
+
+        os.rename(tmp_path, venv_path)
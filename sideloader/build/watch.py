@@ -0,0 +1,300 @@
+"""
+Watching local source directories for changes, for watch mode: after a
+full build, each change to the source reruns only the steps of the build
+that it affects and repackages. Changes are read from inotify where it is
+available and found by polling the directory tree otherwise.
+"""
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import os
+import select
+import struct
+import time
+
+from utils import log
+
+
+""" Names of files and directories that changes are ignored in. """
+DEFAULT_IGNORE = ('.git', '.hg', '.svn', '__pycache__', '*.pyc', '*.swp',
+                  '*.swx', '*~', '.#*', '4913')
+
+""" The path reported when changes were lost and everything may have. """
+RESCAN = ''
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+# struct inotify_event {int wd; uint32_t mask, cookie, len; char name[];}
+EVENT_FORMAT = 'iIII'
+EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+
+
+class Watcher(object):
+    """ Watches a directory tree for changes to its files. """
+
+    def __init__(self, root, ignore=DEFAULT_IGNORE):
+        """
+        :param: root:
+        The directory to watch.
+
+        :param: ignore:
+        Patterns for the names of files and directories to ignore changes
+        in.
+        """
+        self.root = os.path.abspath(root)
+        self.ignore = ignore
+
+    def is_ignored(self, relpath):
+        """ Check whether any part of a relative path is ignored. """
+        return any(fnmatch.fnmatch(part, pattern)
+                   for part in relpath.split(os.sep)
+                   for pattern in self.ignore)
+
+    def poll(self, timeout=None):
+        """
+        Wait up to timeout seconds (forever if None) for changes.
+
+        :returns:
+        A set of the paths that changed, relative to the root. It may be
+        empty if nothing changed before the timeout.
+        """
+        raise NotImplementedError()
+
+    def wait(self, settle=0.2):
+        """
+        Wait for something to change, then for the changes to settle: until
+        nothing more changes for settle seconds, so that saving several files
+        at once (or switching branches) causes a single rebuild.
+
+        :returns:
+        A sorted list of the paths that changed, relative to the root.
+        RESCAN is among them if changes were lost.
+        """
+        changed = set()
+        while not changed:
+            changed = self.poll()
+        while True:
+            more = self.poll(settle)
+            if not more:
+                return sorted(changed)
+            changed |= more
+
+    def close(self):
+        """ Stop watching. """
+        pass
+
+
+class PollingWatcher(Watcher):
+    """
+    Finds changes by comparing the modification times, sizes and modes of
+    the files in the tree, for systems without inotify.
+    """
+
+    def __init__(self, root, ignore=DEFAULT_IGNORE, interval=1.0):
+        """
+        :param: interval:
+        The number of seconds between scans of the tree.
+        """
+        super(PollingWatcher, self).__init__(root, ignore)
+        self.interval = interval
+        self._snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        for dir_path, dirs, files in os.walk(self.root):
+            dirs[:] = [name for name in dirs if not self.is_ignored(name)]
+            for name in dirs + files:
+                path = os.path.join(dir_path, name)
+                relpath = os.path.relpath(path, self.root)
+                if self.is_ignored(name):
+                    continue
+                try:
+                    stat = os.lstat(path)
+                except OSError:
+                    # Removed while we were scanning
+                    continue
+                if name in dirs and not os.path.islink(path):
+                    # Only the creation and removal of directories matter
+                    snapshot[relpath] = None
+                else:
+                    snapshot[relpath] = (
+                        stat.st_mtime, stat.st_size, stat.st_mode)
+        return snapshot
+
+    def poll(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            snapshot = self._scan()
+            changed = set(
+                relpath for relpath in set(snapshot) | set(self._snapshot)
+                if relpath not in snapshot or relpath not in self._snapshot or
+                snapshot[relpath] != self._snapshot[relpath])
+            self._snapshot = snapshot
+            if changed:
+                return changed
+
+            delay = self.interval
+            if deadline is not None:
+                delay = min(delay, deadline - time.time())
+                if delay <= 0:
+                    return changed
+            time.sleep(delay)
+
+
+class InotifyWatcher(Watcher):
+    """ Reads changes from inotify, watching every directory in the tree. """
+
+    def __init__(self, root, ignore=DEFAULT_IGNORE):
+        super(InotifyWatcher, self).__init__(root, ignore)
+        self._libc = _load_libc()
+        self._fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, 'inotify_init1: %s' % os.strerror(error))
+        # Watch descriptors mapped to directories relative to the root
+        self._watches = {}
+        try:
+            self._watch_tree(self.root)
+        except OSError:
+            self.close()
+            raise
+
+    def _watch_tree(self, path):
+        """
+        Watch a directory and the directories in it.
+
+        :returns:
+        The paths of the files in the tree, relative to the root.
+        """
+        files = set()
+        for dir_path, dirs, names in os.walk(path):
+            dirs[:] = [name for name in dirs if not self.is_ignored(name)]
+            wd = self._libc.inotify_add_watch(self._fd, dir_path, WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOENT:
+                    # Removed while we were walking the tree
+                    continue
+                raise OSError(error, 'Could not watch %s: %s' % (
+                    dir_path, os.strerror(error)))
+
+            rel_dir = os.path.relpath(dir_path, self.root)
+            rel_dir = '' if rel_dir == '.' else rel_dir
+            self._watches[wd] = rel_dir
+            files.update(os.path.join(rel_dir, name) for name in names
+                         if not self.is_ignored(name))
+        return files
+
+    def poll(self, timeout=None):
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        data = os.read(self._fd, 64 * 1024)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = struct.unpack_from(EVENT_FORMAT, data,
+                                                     offset)
+            name = data[offset + EVENT_SIZE:offset + EVENT_SIZE + length]
+            name = name.rstrip('\0')
+            offset += EVENT_SIZE + length
+
+            if mask & IN_Q_OVERFLOW:
+                changed.add(RESCAN)
+                continue
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            rel_dir = self._watches.get(wd)
+            if rel_dir is None or not name:
+                continue
+
+            relpath = os.path.join(rel_dir, name)
+            if self.is_ignored(relpath):
+                continue
+            changed.add(relpath)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # Files may have been added before the directory was watched
+                changed |= self._watch_tree(os.path.join(self.root, relpath))
+        return changed
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def _load_libc():
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                       use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        raise OSError(errno.ENOSYS, 'inotify is not available')
+    libc.inotify_add_watch.argtypes = [
+        ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+def create_watcher(root, ignore=DEFAULT_IGNORE):
+    """ Create an inotify watcher, or a polling one if that fails. """
+    try:
+        return InotifyWatcher(root, ignore)
+    except OSError as e:
+        log('Could not use inotify (%s), polling for changes instead' % e)
+        return PollingWatcher(root, ignore)
+
+
+def plan_rebuild(changed, deploy, deploy_file, builds_wheel=False):
+    """
+    Work out which steps of a build a change to the source affects. The
+    package is always rebuilt.
+
+    :param: changed:
+    The paths that changed, relative to the repo.
+
+    :param: deploy_file:
+    The path to the deploy file, relative to the repo.
+
+    :param: builds_wheel:
+    Whether the deploy type builds a wheel of the repo, which depends on
+    the whole repo.
+
+    :returns:
+    A set of the steps to rerun: 'full' for a full build, or any of 'pip'
+    (a requirements file changed), 'build' (the build directory needs
+    rebuilding) and 'postinstall' (the postinstall script changed).
+    """
+    changed = set(os.path.normpath(relpath) if relpath else relpath
+                  for relpath in changed)
+    if (RESCAN in changed or os.path.normpath(deploy_file) in changed or
+            builds_wheel):
+        return set(['full'])
+
+    steps = set()
+    for dep in deploy.pip:
+        if dep.startswith('-r'):
+            requirements = os.path.normpath(dep[len('-r'):].strip())
+            if requirements in changed:
+                steps.add('pip')
+
+    postinstall = (os.path.normpath(deploy.postinstall)
+                   if deploy.postinstall else None)
+    if postinstall in changed:
+        steps.add('postinstall')
+    if changed - set([postinstall]):
+        steps.add('build')
+    return steps
@@ -0,0 +1,285 @@
+"""
+Building wheels through the PEP 517 build backend hooks and installing them
+straight into a package tree.
+
+Wheels are built in an isolated virtualenv containing only the project's
+build requirements (from the [build-system] table of pyproject.toml, or the
+setuptools defaults for projects without one), so projects that only have a
+pyproject.toml are supported as well as setup.py projects.
+"""
+import ast
+import ConfigParser
+import json
+import os
+import re
+import StringIO
+import tempfile
+import zipfile
+
+from utils import create_venv_paths, rmtree_if_exists
+
+
+""" Build requirements for projects without a [build-system] table. """
+DEFAULT_REQUIRES = ['setuptools>=40.8.0', 'wheel']
+""" The build backend for projects that don't name one. """
+LEGACY_BACKEND = 'setuptools.build_meta:__legacy__'
+
+""" Runs a build backend hook, writing its return value to a JSON file. """
+HOOK_RUNNER = """
+import importlib
+import json
+import os
+import sys
+
+hook_name, backend_name, backend_path, args, result_path = sys.argv[1:]
+# Only the build environment and the backend path should be importable, not
+# the rest of the source tree
+sys.path = [path for path in sys.path if path not in ('', os.getcwd())]
+sys.path[:0] = [os.path.abspath(path) for path in json.loads(backend_path)]
+
+module_name, _, object_path = backend_name.partition(':')
+backend = importlib.import_module(module_name)
+for name in filter(None, object_path.split('.')):
+    backend = getattr(backend, name)
+
+hook = getattr(backend, hook_name, None)
+result = hook(*json.loads(args)) if hook is not None else []
+with open(result_path, 'w') as result_file:
+    json.dump(result, result_file)
+"""
+
+SCRIPT_TEMPLATE = """#!{python}
+# -*- coding: utf-8 -*-
+import re
+import sys
+
+from {module} import {name}
+
+if __name__ == '__main__':
+    sys.argv[0] = re.sub(r'(-script\\.pyw?|\\.exe)?$', '', sys.argv[0])
+    sys.exit({call}())
+"""
+
+
+def _strip_toml_comment(line):
+    quote = None
+    for i, char in enumerate(line):
+        if quote is not None:
+            if char == quote:
+                quote = None
+        elif char in ('"', "'"):
+            quote = char
+        elif char == '#':
+            return line[:i]
+    return line
+
+
+def parse_toml_table(text, table_name):
+    """
+    Parse the keys of a single table from a TOML document. Only the simple
+    values found in a [build-system] table (strings and arrays of strings)
+    are supported.
+
+    :returns:
+    A dict of the table's keys and values, empty if there is no such table.
+    """
+    table = {}
+    in_table = False
+    statement = ''
+    for line in text.splitlines():
+        line = _strip_toml_comment(line).strip()
+        if not statement:
+            header = re.match(r'^\[([^\[\]]+)\]$', line)
+            if header:
+                in_table = header.group(1).strip() == table_name
+                continue
+        if not in_table or not line:
+            continue
+
+        statement += ' ' + line
+        if statement.count('[') > statement.count(']'):
+            # An array continued on the next line
+            continue
+
+        key, _, value = statement.partition('=')
+        statement = ''
+        try:
+            table[key.strip().strip('"\'')] = ast.literal_eval(value.strip())
+        except (SyntaxError, ValueError):
+            raise ValueError('Unsupported value for %s in [%s]: %s' % (
+                key.strip(), table_name, value.strip()))
+    return table
+
+
+def read_build_system(source_dir):
+    """
+    Read the build system of a project from its pyproject.toml.
+
+    :returns:
+    A (requires, backend, backend_path) tuple.
+    """
+    table = {}
+    pyproject_path = os.path.join(source_dir, 'pyproject.toml')
+    if os.path.exists(pyproject_path):
+        with open(pyproject_path) as pyproject_file:
+            table = parse_toml_table(pyproject_file.read(), 'build-system')
+
+    if 'build-backend' not in table:
+        return (table.get('requires', DEFAULT_REQUIRES), LEGACY_BACKEND, [])
+    return (table.get('requires', []), table['build-backend'],
+            table.get('backend-path', []))
+
+
+def build_wheel(source_dir, wheel_dir, env_dir, cmd):
+    """
+    Build a wheel of a project with its build backend in a fresh virtualenv.
+
+    :param: env_dir:
+    The path to create the build environment at (any existing environment
+    there is removed).
+
+    :param: cmd:
+    The function to run commands with.
+
+    :returns:
+    The path to the wheel.
+    """
+    requires, backend, backend_path = read_build_system(source_dir)
+
+    rmtree_if_exists(env_dir)
+    env_paths = create_venv_paths(os.path.dirname(env_dir),
+                                  os.path.basename(env_dir))
+    cmd(['virtualenv', env_paths.venv])
+    if requires:
+        cmd([env_paths.pip, 'install'] + list(requires))
+
+    def run_hook(name, *args):
+        fd, result_path = tempfile.mkstemp(dir=env_dir)
+        os.close(fd)
+        try:
+            cmd([env_paths.python, '-c', HOOK_RUNNER, name, backend,
+                 json.dumps(backend_path), json.dumps(args), result_path],
+                cwd=source_dir)
+            with open(result_path) as result_file:
+                return json.load(result_file)
+        finally:
+            os.remove(result_path)
+
+    extra_requires = run_hook('get_requires_for_build_wheel')
+    if extra_requires:
+        cmd([env_paths.pip, 'install'] + extra_requires)
+
+    return os.path.join(wheel_dir, run_hook('build_wheel', wheel_dir))
+
+
+def _parse_entry_point(value):
+    """ Split 'module:attrs [extras]' into the module and attributes. """
+    value = re.sub(r'\[.*\]\s*$', '', value).strip()
+    module, _, attrs = value.partition(':')
+    return module.strip(), attrs.strip()
+
+
+def _write_file(path, content, mode):
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    with open(path, 'wb') as dst_file:
+        dst_file.write(content)
+    os.chmod(path, mode)
+
+
+def install_wheel(wheel_path, root, install_lib, python,
+                  scripts_dir='/usr/bin', data_dir='/usr'):
+    """
+    Install a wheel into a package tree, the way pip would install it on the
+    target machine.
+
+    :param: root:
+    The root of the package tree.
+
+    :param: install_lib:
+    The directory the target's Python imports libraries from, e.g.
+    '/usr/lib/python2.7/dist-packages'.
+
+    :param: python:
+    The path to the target's Python interpreter, for script shebangs.
+
+    :returns:
+    A sorted list of the paths written to.
+    """
+    written = []
+
+    def install(target_dir, relpath, content, mode):
+        path = os.path.normpath(
+            os.path.join(root, target_dir.lstrip('/'), relpath))
+        if not path.startswith(os.path.join(root, '')):
+            raise ValueError('Refusing to install %s outside of %s' % (
+                relpath, root))
+        _write_file(path, content, mode)
+        written.append(path)
+
+    with zipfile.ZipFile(wheel_path) as wheel:
+        names = wheel.namelist()
+        dist_info = [name.split('/')[0] for name in names
+                     if re.match(r'^[^/]+\.dist-info/WHEEL$', name)]
+        if len(dist_info) != 1:
+            raise ValueError('%s has no .dist-info directory' % wheel_path)
+        dist_info = dist_info[0]
+        dist_name = dist_info[:-len('.dist-info')]
+        data_prefix = dist_name + '.data/'
+        schemes = {
+            'purelib': install_lib,
+            'platlib': install_lib,
+            'scripts': scripts_dir,
+            'data': data_dir,
+            'headers': os.path.join(data_dir, 'include',
+                                    dist_name.split('-')[0]),
+        }
+
+        for info in sorted(wheel.infolist(), key=lambda info: info.filename):
+            if info.filename.endswith('/'):
+                continue
+
+            content = wheel.read(info.filename)
+            executable = (info.external_attr >> 16) & 0o111
+            if info.filename.startswith(data_prefix):
+                scheme, _, relpath = (
+                    info.filename[len(data_prefix):].partition('/'))
+                if scheme == 'scripts':
+                    executable = True
+                    if content.startswith('#!python'):
+                        content = '#!' + python + content[len('#!python'):]
+                install(schemes[scheme], relpath, content,
+                        0o755 if executable else 0o644)
+            else:
+                install(install_lib, info.filename, content,
+                        0o755 if executable else 0o644)
+
+        install(install_lib, dist_info + '/INSTALLER', 'sideloader\n', 0o644)
+
+        entry_points_name = dist_info + '/entry_points.txt'
+        if entry_points_name in names:
+            entry_points = ConfigParser.RawConfigParser()
+            entry_points.optionxform = str
+            entry_points.readfp(
+                StringIO.StringIO(wheel.read(entry_points_name)))
+            for section in ('console_scripts', 'gui_scripts'):
+                if not entry_points.has_section(section):
+                    continue
+                for script, value in sorted(entry_points.items(section)):
+                    module, attrs = _parse_entry_point(value)
+                    name = attrs.split('.')[0]
+                    install(scripts_dir, script, SCRIPT_TEMPLATE.format(
+                        python=python, module=module, name=name, call=attrs),
+                        0o755)
+
+    return sorted(written)
+
+
+def find_wheel(wheel_dir):
+    """ Get the path to the only wheel in a directory. """
+    wheels = [name for name in os.listdir(wheel_dir) if name.endswith('.whl')]
+    if len(wheels) != 1:
+        raise ValueError('Expected one wheel in %s, found %d' % (
+            wheel_dir, len(wheels)))
+    return os.path.join(wheel_dir, wheels[0])
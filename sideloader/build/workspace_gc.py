@@ -0,0 +1,246 @@
+import errno
+import hashlib
+import os
+import threading
+
+from utils import dir_size, log, rmtree_if_exists
+from workspace_lock import is_leased
+
+""" Marker file whose mtime records when a workspace/cache was last used. """
+LAST_USE_FILE = '.sideloader-last-use'
+
+""" Marker file containing the pid of the process using a workspace. """
+IN_USE_FILE = '.sideloader-in-use'
+
+""" Directory within the workspace base that holds the caches. """
+CACHE_DIR = '.cache'
+
+
+def touch_last_use(path):
+    """ Record that the workspace or cache entry at path was just used. """
+    marker = os.path.join(path, LAST_USE_FILE)
+    with open(marker, 'a'):
+        os.utime(marker, None)
+
+
+def get_last_use(path):
+    """
+    Get the time a workspace or cache entry was last used. Falls back to the
+    modification time of the directory if it has never been marked.
+    """
+    marker = os.path.join(path, LAST_USE_FILE)
+    if os.path.exists(marker):
+        return os.path.getmtime(marker)
+    return os.path.getmtime(path)
+
+
+def mark_in_use(path):
+    """ Mark the workspace at path as in use by this process. """
+    with open(os.path.join(path, IN_USE_FILE), 'w') as in_use_file:
+        in_use_file.write(str(os.getpid()))
+
+
+def clear_in_use(path):
+    """ Remove the in-use marker for the workspace at path. """
+    try:
+        os.remove(os.path.join(path, IN_USE_FILE))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def get_staging_name(path):
+    """
+    Get the name of the directory that the workspace at path stages its
+    build in, within the staging directory.
+    """
+    workspace_hash = hashlib.sha1(os.path.abspath(path)).hexdigest()[:12]
+    return 'sideloader-%s' % workspace_hash
+
+
+def pid_is_alive(pid):
+    """ Check whether a process with the given pid is running. """
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def is_in_use(path):
+    """
+    Check whether the workspace at path is in use. Markers left behind by
+    processes that are no longer running are ignored.
+    """
+    try:
+        with open(os.path.join(path, IN_USE_FILE)) as in_use_file:
+            pid = int(in_use_file.read().strip())
+    except (IOError, ValueError):
+        return False
+    return pid_is_alive(pid)
+
+
+class GCEntry(object):
+    """
+    A workspace or cache entry that can be evicted by the garbage collector.
+    """
+    def __init__(self, path, kind, last_use, size):
+        self.path = path
+        self.kind = kind
+        self.last_use = last_use
+        self.size = size
+
+
+class WorkspaceGC(object):
+    """
+    Evicts the least recently used workspaces (including their virtualenvs)
+    and cache entries under the workspace base once their total size exceeds
+    a budget.
+    """
+
+    def __init__(self, workspace_base, budget, staging_dir=None):
+        """
+        :param: workspace_base:
+        The directory that holds the workspaces and caches.
+
+        :param: budget:
+        The maximum number of bytes the workspaces and caches may use.
+
+        :param: staging_dir:
+        The directory the workspaces stage their builds in, if any. Staged
+        builds left behind by runs that were killed are always removed, as
+        they are held in memory.
+        """
+        self.workspace_base = workspace_base
+        self.budget = budget
+        self.staging_dir = staging_dir
+
+    def list_entries(self):
+        """
+        List the workspaces and cache entries under the workspace base. Each
+        directory in the workspace base (other than hidden ones) is a
+        workspace and each directory in a cache namespace is a cache entry.
+        """
+        entries = [self._create_entry(path, 'workspace')
+                   for path in self._list_workspaces()]
+
+        cache_base = os.path.join(self.workspace_base, CACHE_DIR)
+        if os.path.isdir(cache_base):
+            for namespace in sorted(os.listdir(cache_base)):
+                namespace_path = os.path.join(cache_base, namespace)
+                if not os.path.isdir(namespace_path):
+                    continue
+                for name in sorted(os.listdir(namespace_path)):
+                    path = os.path.join(namespace_path, name)
+                    if os.path.isdir(path) and not name.startswith('.'):
+                        entries.append(
+                            self._create_entry(path, 'cache:%s' % namespace))
+
+        return entries
+
+    def _list_workspaces(self):
+        if not os.path.isdir(self.workspace_base):
+            return []
+        return [os.path.join(self.workspace_base, name)
+                for name in sorted(os.listdir(self.workspace_base))
+                if not name.startswith('.') and
+                os.path.isdir(os.path.join(self.workspace_base, name))]
+
+    def _create_entry(self, path, kind):
+        return GCEntry(path, kind, get_last_use(path), dir_size(path))
+
+    def collect(self):
+        """
+        Evict entries, least recently used first, until the total size is
+        within the budget. Workspaces that are in use or leased by a run are
+        never evicted.
+
+        :returns:
+        A list of the evicted entries.
+        """
+        evicted = self.collect_staging()
+        entries = self.list_entries()
+        total = sum(entry.size for entry in entries)
+
+        for entry in sorted(entries, key=lambda entry: entry.last_use):
+            if total <= self.budget:
+                break
+            if entry.kind == 'workspace' and (
+                    is_in_use(entry.path) or is_leased(
+                        self.workspace_base, os.path.basename(entry.path))):
+                continue
+
+            log('Evicting %s %s (%d bytes)' % (
+                entry.kind, entry.path, entry.size))
+            rmtree_if_exists(entry.path)
+            if entry.kind == 'workspace':
+                self._remove_staging(entry.path)
+            total -= entry.size
+            evicted.append(entry)
+
+        if total > self.budget:
+            log('WARNING: Workspace base is still over budget (%d > %d '
+                'bytes)' % (total, self.budget))
+
+        return evicted
+
+    def collect_staging(self):
+        """
+        Remove the staged builds of workspaces that are no longer in use,
+        which were left behind by runs that were killed before they could
+        move them to disk.
+
+        :returns:
+        A list of the removed staged builds.
+        """
+        removed = []
+        for path in self._list_workspaces():
+            if is_in_use(path) or is_leased(self.workspace_base,
+                                            os.path.basename(path)):
+                continue
+            staged = self._remove_staging(path)
+            if staged is not None:
+                removed.append(staged)
+        return removed
+
+    def _remove_staging(self, path):
+        """
+        Remove the staged build of the workspace at path, if there is one.
+
+        :returns:
+        A GCEntry for the staged build, or None.
+        """
+        if self.staging_dir is None:
+            return None
+        staged_path = os.path.join(self.staging_dir, get_staging_name(path))
+        if not os.path.isdir(staged_path):
+            return None
+
+        entry = self._create_entry(staged_path, 'staging')
+        log('Removing staged build %s of %s (%d bytes)' % (
+            staged_path, path, entry.size))
+        rmtree_if_exists(staged_path)
+        return entry
+
+    def start_background(self, interval=300):
+        """
+        Run collection periodically on a daemon thread. Intended for
+        long-running modes.
+
+        :returns:
+        A threading.Event that stops the collector when set.
+        """
+        stop = threading.Event()
+
+        def run():
+            while not stop.is_set():
+                try:
+                    self.collect()
+                except Exception as e:
+                    log('WARNING: Garbage collection failed: %s' % e)
+                stop.wait(interval)
+
+        thread = threading.Thread(target=run, name='sideloader-gc')
+        thread.daemon = True
+        thread.start()
+        return stop
@@ -0,0 +1,242 @@
+"""
+Leases on workspaces, so that runs with the same workspace id don't clean
+out each other's trees. A lease is an exclusive flock on a file named after
+the workspace in the workspace base's lock directory. Runs waiting for a
+lease queue for it with ticket files that they hold flocks on, and are
+served in the order they arrived. Because the kernel drops the flocks of
+processes that die, leases and tickets left behind by dead processes are
+recognised as stale and ignored.
+"""
+import errno
+import fcntl
+import os
+import tempfile
+import time
+import uuid
+
+from utils import log, try_flock
+
+
+""" The directory in the workspace base for workspace leases. """
+LOCK_DIR = '.locks'
+
+""" What to do when a workspace is leased by another run. """
+CONFLICT_MODES = ('wait', 'suffix')
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _set_cloexec(fd):
+    """ Keep commands run during the build from inheriting a lock. """
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+class WorkspaceLease(object):
+    """ A lease on a workspace, taken in turn by the runs that want it. """
+
+    # Seconds between checks for the lease while waiting
+    poll_interval = 0.5
+
+    def __init__(self, workspace_base, workspace_id):
+        self.workspace_id = workspace_id
+        lock_dir = os.path.join(workspace_base, LOCK_DIR)
+        self._lock_path = os.path.join(lock_dir, '%s.lock' % workspace_id)
+        self._queue_dir = os.path.join(lock_dir, '%s.queue' % workspace_id)
+        self._lock_file = None
+        self._ticket_file = None
+        self._ticket = None
+
+    def acquire(self, blocking=True, cancel_token=None):
+        """
+        Take the lease, waiting for the runs that asked for it first.
+
+        :param: blocking:
+        Whether to wait if the lease is taken or other runs are waiting.
+
+        :param: cancel_token:
+        The CancelToken of the run, which stops the wait (raising
+        BuildCancelled) if the run is cancelled.
+
+        :returns:
+        True if the lease was taken, False if it is busy and blocking is
+        False.
+        """
+        self._join_queue()
+        try:
+            waiting = False
+            while True:
+                ahead = self._tickets_ahead()
+                if not ahead and self._try_lock():
+                    if waiting:
+                        log('Took the lease on workspace %s'
+                            % self.workspace_id)
+                    return True
+                if not blocking:
+                    self._leave_queue()
+                    return False
+                if not waiting:
+                    holder = self.get_holder()
+                    log('Workspace %s is in use%s, waiting behind %d runs' % (
+                        self.workspace_id,
+                        ' by pid %d' % holder if holder else '',
+                        max(len(ahead), 1)))
+                    waiting = True
+                if cancel_token is not None:
+                    cancel_token.wait(self.poll_interval)
+                    cancel_token.check()
+                else:
+                    time.sleep(self.poll_interval)
+        except BaseException:
+            self._leave_queue()
+            raise
+
+    def release(self):
+        """ Give up the lease (or the place in the queue for it). """
+        if self._lock_file is not None:
+            # The lock file is left in place: removing it would let a run
+            # that has it open lock a file that a new run can't see
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+        self._leave_queue()
+
+    def get_holder(self):
+        """ Get the pid of the process holding the lease, or None. """
+        try:
+            with open(self._lock_path) as lock_file:
+                return int(lock_file.read().strip())
+        except (IOError, ValueError):
+            return None
+
+    def _try_lock(self):
+        _makedirs(os.path.dirname(self._lock_path))
+        lock_file = open(self._lock_path, 'a+')
+        _set_cloexec(lock_file.fileno())
+        if not try_flock(lock_file, fcntl.LOCK_EX):
+            lock_file.close()
+            return False
+
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(str(os.getpid()))
+        lock_file.flush()
+        self._lock_file = lock_file
+        return True
+
+    def _join_queue(self):
+        """
+        Add a ticket to the queue. Tickets are named by arrival time and
+        locked before they are moved into the queue, so a ticket in the queue
+        that isn't locked belongs to a process that has died.
+        """
+        _makedirs(self._queue_dir)
+        fd, tmp_path = tempfile.mkstemp(prefix='.', dir=self._queue_dir)
+        _set_cloexec(fd)
+        self._ticket_file = os.fdopen(fd, 'w')
+        fcntl.flock(self._ticket_file, fcntl.LOCK_EX)
+        self._ticket_file.write(str(os.getpid()))
+        self._ticket_file.flush()
+
+        self._ticket = '%017.6f-%s' % (time.time(), uuid.uuid4().hex[:8])
+        os.rename(tmp_path, os.path.join(self._queue_dir, self._ticket))
+
+    def _leave_queue(self):
+        if self._ticket_file is None:
+            return
+        try:
+            os.remove(os.path.join(self._queue_dir, self._ticket))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self._ticket_file.close()
+        self._ticket_file = None
+        self._ticket = None
+
+    def _tickets_ahead(self):
+        """
+        List the live tickets that arrived before ours, removing stale ones.
+        """
+        ahead = []
+        for name in sorted(os.listdir(self._queue_dir)):
+            if name >= self._ticket:
+                break
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self._queue_dir, name)
+            if self._is_stale(path):
+                log('Removing stale workspace ticket %s' % name)
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                continue
+            ahead.append(name)
+        return ahead
+
+    def _is_stale(self, ticket_path):
+        try:
+            ticket_file = open(ticket_path)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        with ticket_file:
+            return try_flock(ticket_file, fcntl.LOCK_SH)
+
+
+def lease_workspace(workspace_base, workspace_id, conflict='wait',
+                    cancel_token=None):
+    """
+    Take a lease on a workspace.
+
+    :param: conflict:
+    What to do if another run has the lease: 'wait' for it in turn, or
+    'suffix' to use the first free workspace of '<id>-2', '<id>-3' and so on
+    instead (which won't have the original workspace's virtualenv).
+
+    :param: cancel_token:
+    The CancelToken of the run, to stop waiting if the run is cancelled.
+
+    :returns:
+    The WorkspaceLease, whose workspace_id is the workspace to use.
+    """
+    if conflict not in CONFLICT_MODES:
+        raise ValueError('Unknown workspace conflict mode \'%s\' (expected '
+                         'one of %s)' % (conflict, ', '.join(CONFLICT_MODES)))
+
+    lease = WorkspaceLease(workspace_base, workspace_id)
+    if conflict == 'wait':
+        lease.acquire(cancel_token=cancel_token)
+        return lease
+
+    suffix = 1
+    while not lease.acquire(blocking=False):
+        suffix += 1
+        lease = WorkspaceLease(workspace_base,
+                               '%s-%d' % (workspace_id, suffix))
+    if suffix > 1:
+        log('Workspace %s is in use, using %s' % (
+            workspace_id, lease.workspace_id))
+    return lease
+
+
+def is_leased(workspace_base, workspace_id):
+    """ Check whether a run has the lease on a workspace. """
+    lock_path = os.path.join(workspace_base, LOCK_DIR,
+                             '%s.lock' % workspace_id)
+    try:
+        lock_file = open(lock_path)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return False
+        raise
+    with lock_file:
+        return not try_flock(lock_file, fcntl.LOCK_SH)